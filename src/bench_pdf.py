@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+PDF 解析链路的本地性能基准（不调用任何模型，图片解析用桩代替）。
+
+用法（在 src 目录下运行）：
+    python bench_pdf.py extract path/to/file.pdf [--repeat 3]
+    python bench_pdf.py async-tools [--threads 4] [--chunks 5] [--delay 0.2]
+    python bench_pdf.py notes-tail [--steps 2000] [--delta-chars 600]
+    python bench_pdf.py chunk-storage [--from storage/pdf_extracted/<DOC_ID>/chunks.jsonl] [--pages 300]
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+# 基准关注“解析本身”的耗时：放开图片页数/耗时预算，并关闭落盘
+os.environ.setdefault("PDF_IMAGE_MAX_PAGES", "0")
+os.environ.setdefault("PDF_IMAGE_MAX_IMAGES", "-1")
+os.environ.setdefault("PDF_IMAGE_MAX_SECONDS", "0")
+os.environ.setdefault("PDF_PERSIST_UPLOADS", "0")
+os.environ.setdefault("PDF_STORE_CHUNKS", "0")
+# 桩模型不需要限流，也不走响应缓存（否则第二轮全部命中，比较失真）
+os.environ.setdefault("PDF_RATE_DEEPSEEK_QPS", "0")
+os.environ.setdefault("PDF_LLM_CACHE", "0")
+# 文档目录的库路径在 import 时就按 PDF_EXTRACT_DIR 解析，基准里改临时目录管不到它：直接关掉，免得写进真实目录
+os.environ.setdefault("PDF_CATALOG", "0")
+
+import tools  # noqa: E402
+from langchain_core.document_loaders import BaseBlobParser, Blob  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.messages import AIMessage  # noqa: E402
+
+
+class _StubImageParser(BaseBlobParser):
+    """不发网络请求的图片解析器：只返回固定文本，用来隔离 CPU 开销。"""
+
+    def lazy_parse(self, blob: Blob):
+        yield Document(page_content="[image]", metadata=dict(blob.metadata or {}))
+
+
+def _timeit(fn, repeat: int) -> list[float]:
+    samples: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _report(name: str, samples: list[float]) -> float:
+    median = statistics.median(samples)
+    print(f"{name:<28} median={median:8.3f}s  min={min(samples):8.3f}s  runs={len(samples)}")
+    return median
+
+
+def bench_extract(pdf_path: Path, repeat: int) -> None:
+    """旧实现（文本一遍 + 带图片再一遍） vs 单遍抽取。"""
+    from langchain_pymupdf4llm import PyMuPDF4LLMLoader, PyMuPDF4LLMParser
+
+    stub = _StubImageParser()
+    tools._pdf_images_parser = stub
+
+    def two_pass() -> None:
+        blob = Blob.from_path(str(pdf_path), mime_type="application/pdf")
+        for _ in PyMuPDF4LLMParser(mode="page").lazy_parse(blob):
+            pass
+        loader = PyMuPDF4LLMLoader(str(pdf_path), mode="page", extract_images=True, images_parser=stub)
+        for _ in loader.lazy_load():
+            pass
+
+    def single_pass() -> None:
+        tools._extract_pdf_markdown("", pdf_path.name, enable_images=True, persisted_pdf_path=pdf_path)
+
+    before = _report("two-pass (legacy)", _timeit(two_pass, repeat))
+    after = _report("single-pass", _timeit(single_pass, repeat))
+    if after > 0:
+        print(f"speedup: {before / after:.2f}x")
+
+
+class _SlowStubModel:
+    """模拟每次耗时 delay 秒的模型调用：invoke 阻塞当前线程，ainvoke 让出事件循环。"""
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+
+    def invoke(self, messages):
+        time.sleep(self.delay)
+        return AIMessage(content="- stub")
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.delay)
+        return AIMessage(content="- stub")
+
+
+def bench_async_tools(threads: int, chunks: int, delay: float) -> None:
+    """多个会话同时在事件循环上跑 pdf_analyze_doc：同步工具 vs 异步工具。
+
+    同步工具在事件循环里直接执行（等价于 LANGGRAPH_ALLOW_BLOCKING=true 时的行为），
+    各会话只能排队；异步工具下各会话交替推进，事件循环的最大卡顿应接近 0。
+    """
+    os.environ["PDF_ANALYZE_PACK_TOKENS"] = "0"
+    tools.get_default_model = lambda: _SlowStubModel(delay)
+
+    with TemporaryDirectory(prefix="bench_pdf_") as tmp:
+        tools._PDF_EXTRACT_DIR = tmp
+        doc_ids: list[str] = []
+        for t in range(threads):
+            doc_id = hashlib.sha256(f"bench-{t}".encode()).hexdigest()
+            chunks_path = tools._chunks_jsonl_path(doc_id)
+            chunks_path.parent.mkdir(parents=True, exist_ok=True)
+            writer = tools._ChunksWriter(chunks_path)
+            for page in range(chunks):
+                writer.write_chunk({"kind": "text", "page": page, "content": f"会话 {t} 第 {page} 页"})
+            writer.close()
+            doc_ids.append(doc_id)
+
+        async def run(use_async: bool) -> None:
+            max_lag = 0.0
+            stop = asyncio.Event()
+
+            async def ticker() -> None:
+                nonlocal max_lag
+                while not stop.is_set():
+                    before = time.perf_counter()
+                    await asyncio.sleep(0.01)
+                    max_lag = max(max_lag, time.perf_counter() - before - 0.01)
+
+            spans: list[tuple[float, float]] = []
+            start = time.perf_counter()
+
+            async def session(doc_id: str) -> None:
+                began = time.perf_counter() - start
+                args = {"doc_id": doc_id, "question": "从头总结"}
+                if use_async:
+                    await tools.pdf_analyze_doc.ainvoke(args)
+                else:
+                    tools.pdf_analyze_doc.invoke(args)
+                spans.append((began, time.perf_counter() - start))
+
+            tick = asyncio.create_task(ticker())
+            await asyncio.sleep(0)
+            await asyncio.gather(*(session(d) for d in doc_ids))
+            stop.set()
+            await tick
+
+            name = "async tools" if use_async else "sync tools (blocking)"
+            total = time.perf_counter() - start
+            print(f"{name:<28} total={total:8.3f}s  max loop lag={max_lag:8.3f}s")
+            for i, (began, ended) in enumerate(sorted(spans)):
+                print(f"  session {i}: {began:7.3f}s -> {ended:7.3f}s")
+
+        asyncio.run(run(use_async=False))
+        asyncio.run(run(use_async=True))
+
+
+def bench_notes_tail(steps: int, delta_chars: int) -> None:
+    """逐片分析每一步的笔记开销（不含模型调用）：每步读盘取尾部 + stat vs 进程内滚动尾部。"""
+    tail_chars = 2000
+    max_bytes = 300000
+    delta = ("需求要点：优先级、数量限制与埋点字段。" * (delta_chars // 19 + 1))[:delta_chars]
+
+    def legacy(path: Path) -> None:
+        for i in range(steps):
+            tools._read_file_tail(path, tail_chars)
+            to_write = f"\n\n## 分片 {i + 1}\n{delta}\n"
+            if path.exists() and path.stat().st_size > max_bytes:
+                to_write = "\n\n[警告] notes.md 已超过上限\n"
+            with open(path, "a", encoding="utf-8") as out_fp:
+                out_fp.write(to_write)
+
+    def rolling(path: Path) -> None:
+        view = tools._NotesTail(path, tail_chars)
+        for i in range(steps):
+            view.tail(tail_chars)
+            to_write = f"\n\n## 分片 {i + 1}\n{delta}\n"
+            if view.size_bytes > max_bytes:
+                to_write = "\n\n[警告] notes.md 已超过上限\n"
+            view.append(to_write)
+
+    with TemporaryDirectory(prefix="bench_notes_") as tmp:
+        for name, fn in (("read tail + stat (legacy)", legacy), ("rolling tail buffer", rolling)):
+            path = Path(tmp) / f"{fn.__name__}.md"
+            start = time.perf_counter()
+            fn(path)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<28} steps={steps}  total={elapsed * 1000:8.1f}ms  per step={elapsed / steps * 1e6:7.1f}us")
+
+
+def _synthetic_chunks(pages: int) -> list[dict]:
+    """造一份接近真实抽取结果的分片：每行带同一份 PDF 元数据，正文是中英混排的 Markdown。"""
+    meta = {
+        "source": "storage/pdf_uploads/demo/需求文档.pdf",
+        "file_path": "storage/pdf_uploads/demo/需求文档.pdf",
+        "title": "会员积分与优惠券系统需求说明书",
+        "author": "产品部",
+        "creator": "Microsoft Word",
+        "producer": "macOS Quartz PDFContext",
+        "creationDate": "D:20240101120000+08'00'",
+        "total_pages": pages,
+        "format": "PDF 1.7",
+    }
+    rng = random.Random(pages)
+    phrases = [
+        "用户每消费 {n} 元累计积分，单日上限 {m} 分",
+        "退款时按原路径扣回已发放的积分与优惠券",
+        "优惠券与积分不可叠加使用，优先级：券 > 积分 > 余额",
+        "会员等级 L{n} 享受 {m}% 的积分加成",
+        "埋点 points_earn_{n} 上报渠道、会员等级与订单金额",
+        "看板按日/周/月拆分，支持按城市 {n} 下钻",
+        "接口 /api/v{n}/points 超时 {m}ms 后降级为本地缓存",
+        "The order service retries {n} times with exponential backoff up to {m}s.",
+        "Admin can export up to {m} rows per request in CSV format.",
+        "字段 user_id_{n} 为必填，长度不超过 {m} 个字符",
+    ]
+    chunks = []
+    for page in range(pages):
+        lines = [f"## 3.{page} 积分规则", ""]
+        for _ in range(rng.randint(8, 60)):
+            lines.append("- " + rng.choice(phrases).format(n=rng.randint(1, 9999), m=rng.randint(10, 99999)) + "。")
+        text = "\n".join(lines)
+        parts = tools._split_text(text, tools._PDF_CHUNK_MAX_CHARS)
+        for part_index, part_text in enumerate(parts):
+            chunks.append(
+                {
+                    "doc_id": "bench",
+                    "kind": "text",
+                    "page": page,
+                    "part_index": part_index,
+                    "part_total": len(parts),
+                    "content": part_text,
+                    "metadata": {**meta, "page": page},
+                }
+            )
+    return chunks
+
+
+def bench_chunk_storage(source: Path | None, pages: int, repeat: int) -> None:
+    """分片存储格式对比：jsonl vs 块压缩 jsonz（不同块大小）——体积、顺序读吞吐、按行号随机读延迟。
+
+    另附 notes 压缩前后的体积（用分片正文拼一份近似的笔记）。
+    """
+    if source is not None:
+        chunks = [json.loads(line) for line in source.read_text(encoding="utf-8").splitlines() if line.strip()]
+    else:
+        chunks = _synthetic_chunks(pages)
+    rng = random.Random(0)
+
+    with TemporaryDirectory(prefix="bench_chunks_") as tmp:
+        variants = [("jsonl", 0)] + [("jsonz", size) for size in (0, 16 * 1024, 64 * 1024, 256 * 1024)]
+        for fmt, block_bytes in variants:
+            chunks_path = Path(tmp) / f"{fmt}-{block_bytes}" / "chunks.jsonl"
+            chunks_path.parent.mkdir(parents=True)
+            tools._PDF_CHUNK_BLOCK_BYTES = block_bytes
+            writer_cls = tools._ChunksWriter if fmt == "jsonl" else tools._BlockChunksWriter
+            writer = writer_cls(chunks_path)
+            last_page = None
+            for chunk in chunks:
+                # 与抽取时一致：每页 flush 一次
+                if last_page is not None and chunk["page"] != last_page:
+                    writer.flush()
+                last_page = chunk["page"]
+                writer.write_chunk(chunk)
+            writer.close()
+
+            size = sum(p.stat().st_size for p in chunks_path.parent.iterdir())
+            raw_bytes = 0
+            seq_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                raw_bytes = sum(len(line.encode("utf-8")) for _, line in tools._iter_chunk_lines(chunks_path))
+                seq_times.append(time.perf_counter() - start)
+            seq = min(seq_times)
+
+            lines = len(chunks)
+            probes = [rng.randrange(lines) for _ in range(200)]
+            start = time.perf_counter()
+            for line_no in probes:
+                next(tools._iter_chunk_lines(chunks_path, line_no))
+            random_ms = (time.perf_counter() - start) / len(probes) * 1000
+
+            name = "jsonl" if fmt == "jsonl" else f"jsonz block={block_bytes // 1024 or 'page'}{'K' if block_bytes else ''}"
+            print(
+                f"{name:<22} size={size / 1024:9.1f}KB  seq read={raw_bytes / seq / 1e6:7.1f}MB/s "
+                f"({lines / seq:9.0f} lines/s)  random line={random_ms:6.3f}ms"
+            )
+
+        notes = "\n\n".join(f"## 分片 {i + 1}\n{chunk['content'][:600]}" for i, chunk in enumerate(chunks)).encode("utf-8")
+        print(f"notes.md {len(notes) / 1024:9.1f}KB -> notes.md.gz {len(gzip.compress(notes, 6)) / 1024:9.1f}KB")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="PDF 解析链路性能基准")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_extract = sub.add_parser("extract", help="单遍抽取 vs 旧的两遍抽取")
+    p_extract.add_argument("pdf", type=Path)
+    p_extract.add_argument("--repeat", type=int, default=3)
+
+    p_async = sub.add_parser("async-tools", help="多个会话并发调用 pdf_analyze_doc：同步 vs 异步工具")
+    p_async.add_argument("--threads", type=int, default=4)
+    p_async.add_argument("--chunks", type=int, default=5)
+    p_async.add_argument("--delay", type=float, default=0.2, help="桩模型单次调用耗时（秒）")
+
+    p_notes = sub.add_parser("notes-tail", help="逐片分析每步的笔记读写开销：读盘取尾部 vs 进程内滚动尾部")
+    p_notes.add_argument("--steps", type=int, default=2000)
+    p_notes.add_argument("--delta-chars", type=int, default=600, help="每步追加的增量笔记长度（字符）")
+
+    p_storage = sub.add_parser("chunk-storage", help="分片存储格式对比：jsonl vs 块压缩 jsonz（体积 / 读吞吐）")
+    p_storage.add_argument("--from", dest="source", type=Path, default=None, help="用现成的 chunks.jsonl（默认合成一份）")
+    p_storage.add_argument("--pages", type=int, default=300, help="合成分片的页数")
+    p_storage.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "extract":
+        bench_extract(args.pdf, args.repeat)
+    elif args.cmd == "async-tools":
+        bench_async_tools(args.threads, args.chunks, args.delay)
+    elif args.cmd == "notes-tail":
+        bench_notes_tail(args.steps, args.delta_chars)
+    elif args.cmd == "chunk-storage":
+        bench_chunk_storage(args.source, args.pages, args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
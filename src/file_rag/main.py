@@ -6,6 +6,9 @@
   转成可读文本后再喂给模型；
 
 PDF 解析/分片/多模态图片识别等“工具逻辑”统一放在 `src/tools.py`，避免 main.py 变成“大杂烩”。
+
+pdf_analyze_doc / pdf_read_report / pdf_search 同时带同步与异步（coroutine）实现：图在事件循环上异步执行时
+走 ainvoke + 工作线程文件 I/O，一个会话的长时间分析不会卡住其他会话。
 """
 
 import os
@@ -16,7 +19,7 @@ from langchain.agents.middleware import before_model
 from langgraph.runtime import Runtime
 
 from file_rag.core.llms import get_default_model, get_doubao_seed_model
-from tools import build_pdf_message_updates, pdf_analyze_doc, pdf_read_report
+from tools import build_pdf_message_updates, pdf_analyze_doc, pdf_read_report, pdf_search
 
 
 _PDF_TOOL_PROMPT: str = (
@@ -26,6 +29,10 @@ _PDF_TOOL_PROMPT: str = (
     "2) 再基于工具输出回答用户问题；\n"
     "3) 不要自己猜测PDF内容。\n"
     "\n"
+    "当用户针对已上传的 PDF 只问一个具体问题（某条规则/字段/数字/在哪一页），而不是要整体分析时：\n"
+    "1) 先调用 pdf_search(doc_id, query, k) 检索相关分片，再基于检索结果回答，并注明页码；\n"
+    "2) 检索结果不足以回答时，再改用 pdf_analyze_doc 做完整阅读。\n"
+    "\n"
     "当用户说“继续/接着/继续解析”且上下文里已有 DOC_ID: ... 时：\n"
     "1) 继续调用 pdf_analyze_doc(doc_id, question)，它会从断点续跑，不会从头开始（除非用户明确说“从头/重来/reset”）。\n"
     "\n"
@@ -80,14 +87,14 @@ def log_before_model(state: AgentState, _runtime: Runtime) -> dict[str, Any] | N
 
 image_agent = create_agent(
     model=_pick_image_agent_model(),
-    tools=[pdf_analyze_doc, pdf_read_report],
+    tools=[pdf_analyze_doc, pdf_read_report, pdf_search],
     middleware=[log_before_model],
     system_prompt=_PDF_TOOL_PROMPT,
 )
 
 agent = create_agent(
     model=get_default_model(),
-    tools=[pdf_analyze_doc, pdf_read_report],
+    tools=[pdf_analyze_doc, pdf_read_report, pdf_search],
     middleware=[log_before_model],
     system_prompt=_PDF_TOOL_PROMPT,
 )
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+PDF 落盘数据的维护命令。
+
+用法（在 src 目录下运行）：
+    python pdf_storage.py import-chunks [--extract-dir storage/pdf_extracted]
+    python pdf_storage.py backfill-catalog [--extract-dir storage/pdf_extracted]
+    python pdf_storage.py sweep [--quota BYTES] [--dry-run]
+"""
+
+import argparse
+import sys
+
+
+def cmd_import_chunks(extract_dir: str | None) -> int:
+    """把已有的 <doc_id>/chunks.jsonl 导入 SQLite 分片库（已导入的文档跳过）。"""
+    import tools
+
+    imported = tools.import_pdf_chunks_to_store(extract_dir)
+    total = 0
+    for doc_id, lines in imported.items():
+        status = f"{lines} 行" if lines else "已存在，跳过"
+        print(f"{doc_id}  {status}")
+        total += lines
+    print(f"共 {len(imported)} 个文档，导入 {total} 行 -> {tools._PDF_CHUNK_DB}")
+    return 0
+
+
+def cmd_backfill_catalog(extract_dir: str | None) -> int:
+    """把已有的落盘目录登记进文档目录（升级后首次使用，或目录库被删后重建）。"""
+    import tools
+
+    if tools._get_doc_catalog() is None:
+        print("文档目录未开启（PDF_CATALOG=0）")
+        return 1
+    registered = tools.backfill_doc_catalog(extract_dir)
+    print(f"已登记 {registered} 个文档 -> {tools._PDF_CATALOG_DB}")
+    return 0
+
+
+def cmd_sweep(quota: int | None, dry_run: bool) -> int:
+    """按配额淘汰落盘数据（默认取 PDF_STORAGE_QUOTA_BYTES）；--dry-run 只列出会删除的内容。"""
+    import tools
+
+    before, after, evicted = tools.sweep_pdf_storage(quota, dry_run=dry_run)
+    for label, freed in evicted:
+        print(f"{'[dry-run] ' if dry_run else ''}{label}  {freed} bytes")
+    limit = tools._PDF_STORAGE_QUOTA_BYTES if quota is None else quota
+    print(f"用量 {before} -> {after} bytes（配额 {limit if limit > 0 else '不限制'}）")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="PDF 落盘数据维护")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_import = sub.add_parser("import-chunks", help="把已有的 chunks.jsonl 导入 SQLite 分片库")
+    p_import.add_argument("--extract-dir", default=None, help="默认取 PDF_EXTRACT_DIR")
+
+    p_catalog = sub.add_parser("backfill-catalog", help="把已有的落盘目录登记进文档目录（SQLite）")
+    p_catalog.add_argument("--extract-dir", default=None, help="默认取 PDF_EXTRACT_DIR")
+
+    p_sweep = sub.add_parser("sweep", help="超出配额时按保留层级 + 最近访问时间淘汰落盘数据")
+    p_sweep.add_argument("--quota", type=int, default=None, help="配额（bytes），默认取 PDF_STORAGE_QUOTA_BYTES")
+    p_sweep.add_argument("--dry-run", action="store_true", help="只列出会删除的内容")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "import-chunks":
+        return cmd_import_chunks(args.extract_dir)
+    if args.cmd == "backfill-catalog":
+        return cmd_backfill_catalog(args.extract_dir)
+    if args.cmd == "sweep":
+        return cmd_sweep(args.quota, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""pdf_analyze_doc 异步工具的并发回归测试（桩模型，不发网络请求）。
+
+在 src 目录下运行：
+    python -m pytest -q tests/test_async_tools.py
+"""
+
+import asyncio
+import hashlib
+import importlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("pymupdf")
+
+from langchain_core.messages import AIMessage  # noqa: E402
+
+SRC_DIR = Path(__file__).resolve().parents[1]
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+SESSIONS = 4
+CHUNKS = 3
+DELAY = 0.2
+
+
+class _SlowStubModel:
+    """每次调用耗时 DELAY 秒；ainvoke 让出事件循环，invoke 会阻塞（测试里不应被调用到）。"""
+
+    def invoke(self, messages, **kwargs):
+        time.sleep(DELAY)
+        return AIMessage(content="- stub")
+
+    async def ainvoke(self, messages, **kwargs):
+        await asyncio.sleep(DELAY)
+        return AIMessage(content="- stub")
+
+
+@pytest.fixture(scope="module")
+def tools(tmp_path_factory):
+    # 路径类配置在 import 时解析，必须在导入 tools 之前指向临时目录
+    extract_dir = tmp_path_factory.mktemp("pdf_extracted")
+    env = {
+        "PDF_EXTRACT_DIR": str(extract_dir),
+        "PDF_PERSIST_UPLOADS": "0",
+        "PDF_RATE_DEEPSEEK_QPS": "0",
+        "PDF_LLM_CACHE": "0",
+        "PDF_ANSWER_CACHE": "0",
+        "PDF_CATALOG": "0",
+        "PDF_ANALYZE_PACK_TOKENS": "0",
+    }
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    sys.modules.pop("tools", None)
+    try:
+        module = importlib.import_module("tools")
+        module.get_default_model = lambda: _SlowStubModel()
+        yield module
+    finally:
+        sys.modules.pop("tools", None)
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def _write_doc(tools, index: int) -> str:
+    doc_id = hashlib.sha256(f"async-tools-{index}".encode()).hexdigest()
+    chunks_path = tools._chunks_jsonl_path(doc_id)
+    chunks_path.parent.mkdir(parents=True, exist_ok=True)
+    writer = tools._ChunksWriter(chunks_path)
+    for page in range(CHUNKS):
+        writer.write_chunk({"kind": "text", "page": page, "content": f"会话 {index} 第 {page} 页"})
+    writer.close()
+    return doc_id
+
+
+def test_concurrent_sessions_overlap_without_blocking_loop(tools):
+    doc_ids = [_write_doc(tools, i) for i in range(SESSIONS)]
+
+    async def run() -> tuple[list[tuple[float, float]], float, float]:
+        max_lag = 0.0
+        stop = asyncio.Event()
+
+        async def ticker() -> None:
+            nonlocal max_lag
+            while not stop.is_set():
+                before = time.perf_counter()
+                await asyncio.sleep(0.01)
+                max_lag = max(max_lag, time.perf_counter() - before - 0.01)
+
+        spans: list[tuple[float, float]] = []
+        start = time.perf_counter()
+
+        async def session(doc_id: str) -> None:
+            began = time.perf_counter()
+            result = await tools.pdf_analyze_doc.ainvoke({"doc_id": doc_id, "question": "从头总结"})
+            assert isinstance(result, str) and result
+            spans.append((began, time.perf_counter()))
+
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        await asyncio.gather(*(session(d) for d in doc_ids))
+        total = time.perf_counter() - start
+        stop.set()
+        await tick
+        return spans, total, max_lag
+
+    spans, total, max_lag = asyncio.run(run())
+
+    assert len(spans) == SESSIONS
+    # 所有会话的执行区间两两重叠：最晚开始的会话在最早结束的会话之前就已开始
+    assert max(began for began, _ in spans) < min(ended for _, ended in spans)
+    # 每个会话至少等待 CHUNKS 次模型调用；并发推进时总耗时应远小于各会话耗时之和
+    durations = [ended - began for began, ended in spans]
+    assert min(durations) >= CHUNKS * DELAY * 0.9
+    assert total < 0.5 * sum(durations)
+    # 模型调用期间事件循环不被阻塞（同步执行时卡顿会达到 DELAY 的量级）
+    assert max_lag < DELAY / 2
+
+
+def test_sessions_beyond_executor_capacity_do_not_deadlock(tools, tmp_path, monkeypatch):
+    # 打开响应缓存，并把默认线程池压到会话数的一半：每个会话占一个工作线程跑分析流程，
+    # 模型调用协程若再向同一个线程池要线程（如 to_thread 查缓存），所有会话会互相等死
+    monkeypatch.setattr(tools, "_PDF_LLM_CACHE", True)
+    monkeypatch.setattr(tools, "_PDF_LLM_CACHE_DB", str(tmp_path / "llm_cache.sqlite3"))
+    monkeypatch.setattr(tools, "_llm_cache", None)
+    doc_ids = [_write_doc(tools, 100 + i) for i in range(SESSIONS)]
+    results: list[str] = []
+    loops: list[asyncio.AbstractEventLoop] = []
+
+    async def run() -> list[str]:
+        loop = asyncio.get_running_loop()
+        loops.append(loop)
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=SESSIONS // 2))
+        return await asyncio.gather(
+            *(tools.pdf_analyze_doc.ainvoke({"doc_id": d, "question": "从头总结"}) for d in doc_ids)
+        )
+
+    # 卡死时 asyncio.run 收尾也会等线程池，放到守护线程里跑，超时即判失败
+    runner = threading.Thread(target=lambda: results.extend(asyncio.run(run())), daemon=True)
+    runner.start()
+    runner.join(timeout=30)
+
+    if runner.is_alive():
+        # 取消 loop 上的全部任务，让卡在 future.result() 的工作线程退出，否则解释器退出时还会等它们
+        loop = loops[0]
+        loop.call_soon_threadsafe(lambda: [task.cancel() for task in asyncio.all_tasks(loop)])
+        runner.join(timeout=10)
+        pytest.fail("并发会话数超过默认线程池大小时 pdf_analyze_doc 卡死")
+    assert len(results) == SESSIONS
+    assert all(isinstance(r, str) and r for r in results)
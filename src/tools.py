@@ -344,21 +344,48 @@ def save_and_generate_report(
 #
 
 import base64
+import bisect
+import codecs
 import gc
+import gzip
 import hashlib
+import heapq
+import importlib
 import json
+import math
+import multiprocessing
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import threading
 import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from tempfile import TemporaryDirectory
-from typing import Any
+from typing import Any, Awaitable, Callable, Iterable, TextIO
 from uuid import uuid4
 
 from langchain_core.documents import Document
 from langchain_core.document_loaders import BaseBlobParser, Blob
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_pymupdf4llm import PyMuPDF4LLMLoader, PyMuPDF4LLMParser
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.tools import StructuredTool
+import pymupdf
+import pymupdf4llm
 
-from langchain.tools import tool
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖：没有时 pdf_search 只做 BM25 词法检索
+    np = None
+
+try:
+    from langgraph.config import get_config
+except ImportError:  # 只用于取当前会话的 thread_id（阅读进度按会话记录）；取不到时所有调用共用一份进度
+    get_config = None
 
 from file_rag.core.llms import get_default_model, get_doubao_seed_model
 
@@ -388,6 +415,7 @@ def _env_float(name: str, default: float) -> float:
 # - PDF_IMAGE_MAX_IMAGES=10     最多解析前 N 张图片（默认 10）
 # - PDF_IMAGE_MAX_SECONDS=20    图片解析总耗时上限（秒，默认 20s）
 # - PDF_IMAGE_MAX_BYTES=2500000 单张图片最大 bytes（默认 2.5MB）
+# - PDF_IMAGE_CONCURRENCY=4     图片多模态解析的并发请求数（默认 4）
 # - PDF_TEXT_MAX_CHARS=30000    注入到对话的文本最大字符数（默认 30000）
 # - PDF_TEXT_MAX_PAGES=20       文本最多解析前 N 页（默认 20）
 #
@@ -404,6 +432,8 @@ _PDF_IMAGE_MAX_PAGES: int = _env_int("PDF_IMAGE_MAX_PAGES", 5)
 _PDF_IMAGE_MAX_IMAGES: int = _env_int("PDF_IMAGE_MAX_IMAGES", 10)
 _PDF_IMAGE_MAX_SECONDS: float = _env_float("PDF_IMAGE_MAX_SECONDS", 20.0)
 _PDF_IMAGE_MAX_BYTES: int = _env_int("PDF_IMAGE_MAX_BYTES", 2_500_000)
+# 图片多模态解析的并发度（同时在途的请求数上限，默认 4；1 表示逐张串行）
+_PDF_IMAGE_CONCURRENCY: int = _env_int("PDF_IMAGE_CONCURRENCY", 4)
 _PDF_TEXT_MAX_CHARS: int = _env_int("PDF_TEXT_MAX_CHARS", 30000)
 _PDF_TEXT_MAX_PAGES: int = _env_int("PDF_TEXT_MAX_PAGES", 20)
 
@@ -440,6 +470,30 @@ _PDF_OVERWRITE_EXTRACTED: bool = os.getenv("PDF_OVERWRITE_EXTRACTED", "0").lower
 _PDF_UPLOAD_DIR = os.getenv("PDF_UPLOAD_DIR", "storage/pdf_uploads")
 _PDF_EXTRACT_DIR = os.getenv("PDF_EXTRACT_DIR", "storage/pdf_extracted")
 
+# 图片解析结果缓存（按图片内容寻址，跨文档共享：同一张截图/Logo 只请求一次多模态模型）
+_PDF_IMAGE_CACHE: bool = os.getenv("PDF_IMAGE_CACHE", "1").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+_PDF_IMAGE_CACHE_DIR = os.getenv("PDF_IMAGE_CACHE_DIR", "storage/pdf_image_cache")
+# 缓存目录总大小上限（bytes，默认 200MB）；超出后按最近访问时间淘汰最旧的条目
+_PDF_IMAGE_CACHE_MAX_BYTES: int = _env_int("PDF_IMAGE_CACHE_MAX_BYTES", 200 * 1024 * 1024)
+
+# 同一文档内的重复图片抑制（页眉 Logo / 水印等每页都出现的图片只会白白耗掉 PDF_IMAGE_MAX_IMAGES）
+# - PDF_IMAGE_DEDUP=1                 开启（默认）：相同/近似图片只解析一次，后续引用首次结果
+# - PDF_IMAGE_BOILERPLATE_RATIO=0.6   出现在超过该比例页面上的图片视为“样板图片”，直接跳过
+# - PDF_IMAGE_PHASH_DISTANCE=6        感知哈希（64 位 dHash）汉明距离不超过该值视为近似重复
+_PDF_IMAGE_DEDUP: bool = os.getenv("PDF_IMAGE_DEDUP", "1").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+_PDF_IMAGE_BOILERPLATE_RATIO: float = _env_float("PDF_IMAGE_BOILERPLATE_RATIO", 0.6)
+_PDF_IMAGE_PHASH_DISTANCE: int = _env_int("PDF_IMAGE_PHASH_DISTANCE", 6)
+
 # 是否复用已落盘的抽取结果（chunks/meta）（默认开启，避免重复解析/重复写入导致“从头再来”）
 _PDF_REUSE_EXTRACTED: bool = os.getenv("PDF_REUSE_EXTRACTED", "1").lower() in {
     "1",
@@ -467,6 +521,104 @@ _PDF_EXTRACT_MAX_CHARS: int = _env_int("PDF_EXTRACT_MAX_CHARS", 0)
 # 落盘 jsonl 的单条最大字符数（把“按页”再切小一点，便于断点续跑）
 _PDF_CHUNK_MAX_CHARS: int = _env_int("PDF_CHUNK_MAX_CHARS", 4000)
 
+# 分片存储后端：
+# - jsonl：每个 doc_id 一个 chunks.jsonl（默认）
+# - sqlite：所有文档共用一个 SQLite 库，(doc_id, kind, page, part_index, 内容哈希) 建索引，
+#   按页/按行号区间查询不再扫文件；已有的 chunks.jsonl 首次读取时自动导入，无需重新抽取
+# - jsonz：每个 doc_id 一个块压缩的 chunks.jsonz（若干行一个 zlib 块 + 块索引，按行号定位到块再解压），
+#   体积通常只有 jsonl 的几分之一；读取时有 chunks.jsonz 就用它，否则回退到 chunks.jsonl
+# - PDF_CHUNK_DB=...            SQLite 库路径（默认 <PDF_EXTRACT_DIR>/chunks.sqlite3）
+# - PDF_CHUNK_BLOCK_BYTES=65536 jsonz 每块攒够多少字节（压缩前）再写出；<=0 每页一块
+# - PDF_CHUNK_BLOCK_LEVEL=6     jsonz 的 zlib 压缩级别
+_PDF_CHUNK_STORE: str = (os.getenv("PDF_CHUNK_STORE", "jsonl") or "jsonl").strip().lower()
+_PDF_CHUNK_DB = os.getenv("PDF_CHUNK_DB", "") or os.path.join(_PDF_EXTRACT_DIR, "chunks.sqlite3")
+_PDF_CHUNK_BLOCK_BYTES: int = _env_int("PDF_CHUNK_BLOCK_BYTES", 64 * 1024)
+_PDF_CHUNK_BLOCK_LEVEL: int = _env_int("PDF_CHUNK_BLOCK_LEVEL", 6)
+
+# 分析完成后把 notes.md 压缩成 notes.md.gz（报告生成 / pdf_read_report 直接流式读取；重新分析前自动解压回来）
+# notes.md.gz 由若干独立的 gzip member 拼成（每个 member 固定字符数），member 的压缩偏移记在
+# notes.md.gz.members.json：分页读取时 seek 到所在 member 再解压，不必从头解压
+_PDF_NOTES_COMPRESS: bool = os.getenv("PDF_NOTES_COMPRESS", "0").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+
+# 最终报告的答案缓存（同一 doc_id + 近似问题 + 同模型/提示词版本直接复用，不再重跑七个章节）
+# - PDF_ANSWER_CACHE=1                       开启（默认）；用户明确说“重来/reset”时总是绕过
+# - PDF_ANSWER_CACHE_TTL_SECONDS=604800      条目有效期（秒，默认 7 天；<=0 不过期）
+# - PDF_ANSWER_CACHE_MAX_BYTES=5000000       每个文档的缓存目录大小上限（超出按最近访问时间淘汰）
+_PDF_ANSWER_CACHE: bool = os.getenv("PDF_ANSWER_CACHE", "1").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+_PDF_ANSWER_CACHE_TTL_SECONDS: float = _env_float("PDF_ANSWER_CACHE_TTL_SECONDS", 7 * 24 * 3600.0)
+_PDF_ANSWER_CACHE_MAX_BYTES: int = _env_int("PDF_ANSWER_CACHE_MAX_BYTES", 5_000_000)
+
+# 文档目录（SQLite）：doc_id / 文件名 / 大小 / 页数 / 状态 / 最近活动时间 + 会话关联，
+# “最近的文档”查询走索引，不再遍历落盘目录
+# - PDF_CATALOG=1                            开启（默认）
+# - PDF_CATALOG_DB=...                       库路径（默认 <PDF_EXTRACT_DIR>/catalog.sqlite3）
+_PDF_CATALOG: bool = os.getenv("PDF_CATALOG", "1").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+_PDF_CATALOG_DB = os.getenv("PDF_CATALOG_DB", "") or os.path.join(_PDF_EXTRACT_DIR, "catalog.sqlite3")
+
+# 存储配额：上传的 PDF 与抽取产物默认永久保留，设置配额后按保留层级 + 最近访问时间淘汰
+# - PDF_STORAGE_QUOTA_BYTES=0                上传目录 + 抽取目录 + 图片缓存的总配额（bytes；<=0 不限制，默认）
+# - PDF_STORAGE_SWEEP_SECONDS=600            后台定期清理的间隔（秒；<=0 不启动后台清理，只能用 CLI）
+_PDF_STORAGE_QUOTA_BYTES: int = _env_int("PDF_STORAGE_QUOTA_BYTES", 0)
+_PDF_STORAGE_SWEEP_SECONDS: float = _env_float("PDF_STORAGE_SWEEP_SECONDS", 600.0)
+
+# 模型响应缓存（逐片分析/笔记合并：相同模型 + 相同消息直接复用上次的回复，重跑时不再重复调用 deepseek）
+# - PDF_LLM_CACHE=1                          开启（默认）
+# - PDF_LLM_CACHE_DB=...                     缓存库路径（默认 <PDF_EXTRACT_DIR>/llm_cache.sqlite3）
+# - PDF_LLM_CACHE_MAX_BYTES=200000000        回复内容总大小上限（超出按最近使用时间淘汰；<=0 不限制）
+_PDF_LLM_CACHE: bool = os.getenv("PDF_LLM_CACHE", "1").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+_PDF_LLM_CACHE_DB = os.getenv("PDF_LLM_CACHE_DB", "") or os.path.join(_PDF_EXTRACT_DIR, "llm_cache.sqlite3")
+_PDF_LLM_CACHE_MAX_BYTES: int = _env_int("PDF_LLM_CACHE_MAX_BYTES", 200_000_000)
+
+# 后台异步抽取（上传后立刻返回 DOC_ID，不阻塞首轮对话）
+# - PDF_ASYNC_INGEST=1          开启（默认）：before_model 只提交后台任务 + 注入已完成页面的节选
+# - PDF_INGEST_WORKERS=2        后台抽取线程数（同时处理的 PDF 数上限）
+# - PDF_INGEST_POLL_SECONDS=0.5 pdf_analyze_doc 追上抽取进度后，等待新分片的轮询间隔
+# - PDF_INGEST_MAX_ATTEMPTS=3   同一文档抽取失败的最多尝试次数（达到后不再自动重抽）
+# - PDF_INGEST_RETRY_SECONDS=60 失败后重试的退避基数（第 n 次失败后至少等待 base * 2^(n-1) 秒）
+_PDF_ASYNC_INGEST: bool = os.getenv("PDF_ASYNC_INGEST", "1").lower() in {
+    "1",
+    "true",
+    "yes",
+    "y",
+}
+_PDF_INGEST_WORKERS: int = _env_int("PDF_INGEST_WORKERS", 2)
+_PDF_INGEST_POLL_SECONDS: float = _env_float("PDF_INGEST_POLL_SECONDS", 0.5)
+_PDF_INGEST_MAX_ATTEMPTS: int = _env_int("PDF_INGEST_MAX_ATTEMPTS", 3)
+_PDF_INGEST_RETRY_SECONDS: float = _env_float("PDF_INGEST_RETRY_SECONDS", 60.0)
+
+# 多进程按页分片抽取（pymupdf4llm 转换是纯 CPU 活，单线程会长时间占满一个核）
+# - PDF_EXTRACT_WORKERS=4       工作进程数（<=1 表示在当前线程顺序抽取，默认 1）
+# - PDF_EXTRACT_SHARD_PAGES=8   每个工作进程一次处理的连续页数
+_PDF_EXTRACT_WORKERS: int = _env_int("PDF_EXTRACT_WORKERS", 1)
+_PDF_EXTRACT_SHARD_PAGES: int = _env_int("PDF_EXTRACT_SHARD_PAGES", 8)
+
+
+# pymupdf4llm 输出的内嵌图片：![](data:image/png;base64,....)
+_MD_EMBEDDED_IMAGE_RE = re.compile(r"!\[[^\]]*\]\(data:(image/[\w.+-]+);base64,([^)]+)\)")
+
+# PyMuPDF 不是线程安全的（langchain_pymupdf4llm 内部同样用一把类锁串行化）
+_PYMUPDF_LOCK = threading.RLock()
+
 
 def _should_extract_images(user_text: str) -> bool:
     """根据配置决定是否解析图片（多模态）。"""
@@ -495,49 +647,300 @@ def _should_extract_images(user_text: str) -> bool:
     )
 
 
-def _compute_pdf_id(pdf_bytes: bytes) -> str:
-    """为一份 PDF 生成稳定的 id（用于去重、持久化目录命名）。"""
-    return hashlib.sha256(pdf_bytes).hexdigest()
+# ==========================
+# 文档目录（catalog）
+# ==========================
+# 所有文档的元信息集中记在一个 SQLite 库里：doc_id / 文件名 / 大小 / 页数 / 抽取状态 / 最近活动时间，
+# 以及“哪个会话用过哪个文档”。pdf_read_report(doc_id="auto") 等“最近的文档”查询走索引，
+# 不再遍历 storage/pdf_extracted 下的每个目录逐个 stat。
+
+
+class _DocCatalog:
+    """文档目录（SQLite，所有文档共用一个库文件；每个线程各用一个连接）。"""
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS docs (
+            doc_id        TEXT PRIMARY KEY,
+            filename      TEXT,
+            bytes         INTEGER,
+            pages         INTEGER,
+            status        TEXT,
+            created_at    REAL NOT NULL,
+            last_activity REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_docs_activity ON docs (last_activity);
+        CREATE TABLE IF NOT EXISTS doc_threads (
+            thread_id     TEXT NOT NULL,
+            doc_id        TEXT NOT NULL,
+            last_activity REAL NOT NULL,
+            PRIMARY KEY (thread_id, doc_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_doc_threads_activity ON doc_threads (thread_id, last_activity);
+        CREATE INDEX IF NOT EXISTS idx_doc_threads_doc ON doc_threads (doc_id);
+    """
+
+    _FIELDS = ("filename", "bytes", "pages", "status")
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._local = threading.local()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def touch(self, doc_id: str, *, thread_id: str | None = None, at: float | None = None, **fields: Any) -> None:
+        """登记/更新一个文档：只覆盖传入的字段，并刷新最近活动时间；给了 thread_id 时顺带记下会话关联。"""
+        now = time.time() if at is None else at
+        values = [fields.get(name) for name in self._FIELDS]
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO docs (doc_id, filename, bytes, pages, status, created_at, last_activity)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (doc_id) DO UPDATE SET"
+                " filename = COALESCE(excluded.filename, filename),"
+                " bytes = COALESCE(excluded.bytes, bytes),"
+                " pages = COALESCE(excluded.pages, pages),"
+                " status = COALESCE(excluded.status, status),"
+                " last_activity = MAX(last_activity, excluded.last_activity)",
+                (doc_id, *values, now, now),
+            )
+            if thread_id:
+                conn.execute(
+                    "INSERT INTO doc_threads (thread_id, doc_id, last_activity) VALUES (?, ?, ?)"
+                    " ON CONFLICT (thread_id, doc_id) DO UPDATE SET"
+                    " last_activity = MAX(last_activity, excluded.last_activity)",
+                    (thread_id, doc_id, now),
+                )
+
+    def get(self, doc_id: str) -> dict[str, Any] | None:
+        row = self._connect().execute(
+            "SELECT doc_id, filename, bytes, pages, status, created_at, last_activity FROM docs WHERE doc_id = ?",
+            (doc_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("doc_id", *self._FIELDS, "created_at", "last_activity"), row))
+
+    def recent(self, thread_id: str | None = None, limit: int = 1) -> list[str]:
+        """按最近活动倒序的文档；给了 thread_id 时只在该会话用过的文档里找。"""
+        conn = self._connect()
+        if thread_id:
+            rows = conn.execute(
+                "SELECT doc_id FROM doc_threads WHERE thread_id = ? ORDER BY last_activity DESC LIMIT ?",
+                (thread_id, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT doc_id FROM docs ORDER BY last_activity DESC LIMIT ?", (limit,)).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self) -> int:
+        return int(self._connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0])
+
+    def forget(self, doc_id: str) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+            conn.execute("DELETE FROM doc_threads WHERE doc_id = ?", (doc_id,))
+
+
+_doc_catalog: _DocCatalog | None = None
+_doc_catalog_lock = threading.Lock()
+
+
+def _get_doc_catalog() -> _DocCatalog | None:
+    """PDF_CATALOG=1 时返回共享的文档目录；关闭时返回 None。"""
+    global _doc_catalog
+    if not _PDF_CATALOG:
+        return None
+    if _doc_catalog is None:
+        with _doc_catalog_lock:
+            if _doc_catalog is None:
+                _doc_catalog = _DocCatalog(Path(_PDF_CATALOG_DB))
+    return _doc_catalog
+
+
+def _catalog_touch(doc_id: str | None, *, thread_id: str | None = None, **fields: Any) -> None:
+    """更新文档目录；目录只是加速用的索引，写失败不影响主流程。"""
+    catalog = _get_doc_catalog()
+    if catalog is None or not doc_id:
+        return
+    try:
+        catalog.touch(doc_id, thread_id=thread_id, **fields)
+    except sqlite3.Error:
+        pass
+
+
+def _has_any_file(doc_dir: Path, names: tuple[str, ...]) -> bool:
+    return not names or any((doc_dir / name).exists() for name in names)
+
+
+def _scan_latest_doc_id(base: Path, require: tuple[str, ...] = ()) -> str | None:
+    """旧方式：遍历落盘目录，按产物文件的修改时间找最近的文档（目录关闭或尚未登记任何文档时使用）。"""
+    best_doc_id: str | None = None
+    best_ts: float = -1.0
+    for child in base.iterdir():
+        if not child.is_dir() or not _DOC_ID_HEX_RE.fullmatch(child.name):
+            continue
+        if not _has_any_file(child, require):
+            continue
+        ts = -1.0
+        for p in (
+            child / "answer.md",
+            child / "notes.md",
+            child / "analysis_state.json",
+            child / "report_read_state",
+        ):
+            try:
+                ts = max(ts, p.stat().st_mtime)
+            except OSError:
+                continue
+        if ts > best_ts:
+            best_ts = ts
+            best_doc_id = child.name
+    return best_doc_id
+
+
+def backfill_doc_catalog(extract_dir: str | None = None) -> int:
+    """把已有的落盘目录登记进文档目录（升级后首次使用 / 手动重建），返回登记的文档数。
+
+    最近活动时间取各产物文件的最大 mtime；文件名/大小取上传目录的 meta.json。
+    """
+    catalog = _get_doc_catalog()
+    base = Path(extract_dir or _PDF_EXTRACT_DIR)
+    if catalog is None or not base.exists():
+        return 0
+    registered = 0
+    for child in base.iterdir():
+        if not child.is_dir() or not _DOC_ID_HEX_RE.fullmatch(child.name):
+            continue
+        doc_id = child.name
+        ts = -1.0
+        for p in child.iterdir():
+            try:
+                ts = max(ts, p.stat().st_mtime)
+            except OSError:
+                continue
+        upload_meta: dict[str, Any] = {}
+        try:
+            upload_meta = json.loads((Path(_PDF_UPLOAD_DIR) / doc_id / "meta.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            pass
+        if not isinstance(upload_meta, dict):
+            upload_meta = {}
+        ingest_status = _read_ingest_state(doc_id).get("status")
+        catalog.touch(
+            doc_id,
+            at=ts if ts > 0 else None,
+            filename=upload_meta.get("filename"),
+            bytes=upload_meta.get("bytes"),
+            status="extracted" if ingest_status in {None, "done"} and _chunks_available(doc_id) else ingest_status,
+        )
+        registered += 1
+    return registered
 
 
-def _persist_pdf_upload(pdf_bytes: bytes, filename: str) -> tuple[str | None, Path | None]:
-    """把原始 PDF bytes 落盘保存，避免“预算限制”导致信息不可恢复。
+# auto 解析 DOC_ID 时，每一级（本会话 / 全局）最多往回看多少个文档去找带所需产物的那个
+_LATEST_DOC_CANDIDATES = 32
+
+
+def _latest_doc_id(thread_id: str | None = None, require: tuple[str, ...] = ()) -> str | None:
+    """最近活动的文档：优先当前会话用过的文档，其次全局最近；目录里还没有任何文档时回退到目录扫描。
+
+    require 非空时只认落盘目录里至少有其中一个文件的文档（例如读报告时要求已有 answer.md）：
+    上传也算活动，“分析完 A 再上传 B”之后最近的 B 还没有报告，应当顺延到 A。
+    """
+    catalog = _get_doc_catalog()
+    base = Path(_PDF_EXTRACT_DIR)
+    if catalog is not None:
+        try:
+            if catalog.count() == 0:
+                backfill_doc_catalog()
+            for scope in ((thread_id,) if thread_id else ()) + (None,):
+                for found in catalog.recent(scope, _LATEST_DOC_CANDIDATES):
+                    if (base / found).is_dir() and _has_any_file(base / found, require):
+                        return found
+        except sqlite3.Error:
+            pass
+    return _scan_latest_doc_id(base, require) if base.exists() else None
+
+
+def _persist_pdf_upload(data: str, filename: str) -> tuple[str | None, Path | None]:
+    """把前端上传的 base64 PDF 流式解码落盘，避免“预算限制”导致信息不可恢复。
 
     返回：
     - (doc_id, pdf_path)
-      - doc_id: sha256(pdf_bytes)
+      - doc_id: sha256(pdf_bytes)（解码过程中增量计算，不需要整份 bytes 在内存里）
       - pdf_path: 保存后的真实路径
 
     说明：
+    - 先写到 <PDF_UPLOAD_DIR>/.incoming/ 下的临时文件，算出 doc_id 后再原子 rename 到
+      <PDF_UPLOAD_DIR>/<doc_id>/，中途失败不会留下半截 PDF；
     - 如果关闭了 PDF_PERSIST_UPLOADS，则返回 (None, None)
     """
     if not _PDF_PERSIST_UPLOADS:
         return None, None
+    _ensure_storage_sweeper()
 
-    doc_id = _compute_pdf_id(pdf_bytes)
-    base_dir = Path(_PDF_UPLOAD_DIR) / doc_id
-    base_dir.mkdir(parents=True, exist_ok=True)
+    incoming_dir = Path(_PDF_UPLOAD_DIR) / ".incoming"
+    incoming_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = incoming_dir / f"{uuid4().hex}.part"
+    try:
+        doc_id, size = _decode_base64_to_file(data, tmp_path)
 
-    pdf_path = base_dir / _safe_pdf_filename(filename)
-    if not pdf_path.exists():
-        pdf_path.write_bytes(pdf_bytes)
+        base_dir = Path(_PDF_UPLOAD_DIR) / doc_id
+        base_dir.mkdir(parents=True, exist_ok=True)
+        pdf_path = base_dir / _safe_pdf_filename(filename)
+        if not pdf_path.exists():
+            os.replace(tmp_path, pdf_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
     meta_path = base_dir / "meta.json"
     if _PDF_OVERWRITE_EXTRACTED or not meta_path.exists():
         meta = {
             "doc_id": doc_id,
             "filename": _safe_pdf_filename(filename),
-            "bytes": len(pdf_bytes),
+            "bytes": size,
             "pdf_path": pdf_path.as_posix(),
             "created_at": datetime.now().isoformat(timespec="seconds"),
         }
         meta_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
 
+    # 重复上传已抽取/抽取中的文档：只刷新活动时间与会话关联，不把状态退回 uploaded
+    fresh = not (_pdf_ingest_running(doc_id) or _extracted_ready(doc_id))
+    _catalog_touch(
+        doc_id,
+        thread_id=_current_thread_id(),
+        filename=_safe_pdf_filename(filename),
+        bytes=size,
+        status="uploaded" if fresh else None,
+    )
     return doc_id, pdf_path
 
 
-def _open_chunks_writer(doc_id: str, *, filename: str, pdf_path: Path) -> tuple[Path, Any] | tuple[None, None]:
-    """打开 jsonl 分片写入器：每行一个 chunk（按页/按阶段）。"""
+def _open_chunks_writer(
+    doc_id: str,
+    *,
+    filename: str,
+    pdf_path: Path,
+    overwrite: bool = False,
+) -> tuple[Path, "_ChunksWriter | _BlockChunksWriter | _SqliteChunksWriter | None"] | tuple[None, None]:
+    """打开分片写入器：每行一个 chunk（按页/按阶段）；按 PDF_CHUNK_STORE 写 jsonl / jsonz 或 SQLite。
+
+    overwrite=True：丢弃已有分片重新写入（用于上次后台抽取被中断、分片不完整的情况）。
+    """
     if not _PDF_STORE_CHUNKS:
         return None, None
 
@@ -545,16 +948,21 @@ def _open_chunks_writer(doc_id: str, *, filename: str, pdf_path: Path) -> tuple[
     base_dir.mkdir(parents=True, exist_ok=True)
 
     chunks_path = base_dir / "chunks.jsonl"
-    if _PDF_OVERWRITE_EXTRACTED and chunks_path.exists():
-        chunks_path.write_text("", encoding="utf-8")
-    elif chunks_path.exists() and _PDF_REUSE_EXTRACTED:
+    store = _get_chunk_store()
+    overwrite = overwrite or _PDF_OVERWRITE_EXTRACTED
+    exists = _chunks_available(doc_id)
+    truncate = overwrite and exists
+    if not truncate and exists and _PDF_REUSE_EXTRACTED:
         # 关键：如果已经存在抽取结果，默认不再“追加写入”，避免：
         # - chunks.jsonl 被重复写入同样内容（导致分析阶段看起来“反复从头解析”）
         # - 文件越来越大，后续分析耗时越来越长
+        _catalog_touch(doc_id)
         return chunks_path, None
+    if truncate:
+        _invalidate_chunk_search_index(doc_id)
 
     meta_path = base_dir / "meta.json"
-    if _PDF_OVERWRITE_EXTRACTED or not meta_path.exists():
+    if overwrite or not meta_path.exists():
         meta = {
             "doc_id": doc_id,
             "filename": _safe_pdf_filename(filename),
@@ -574,15 +982,766 @@ def _open_chunks_writer(doc_id: str, *, filename: str, pdf_path: Path) -> tuple[
         }
         meta_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
 
+    _catalog_touch(doc_id, filename=_safe_pdf_filename(filename), status="extracting")
+
     # 新文件：写入分片（默认只写一次；后续命中同 doc_id 则复用，不再追加）
-    fp = open(chunks_path, "a", encoding="utf-8")
-    return chunks_path, fp
+    if store is not None:
+        return chunks_path, _SqliteChunksWriter(store, doc_id, truncate=truncate)
+    if truncate:
+        # 重写时删掉另一种格式的旧文件，避免读者读到过期的分片（读取时 chunks.jsonz 优先）
+        if _PDF_CHUNK_STORE == "jsonz":
+            stale = (chunks_path, *_chunks_index_paths(chunks_path))
+        else:
+            stale = _compressed_chunks_paths(chunks_path)
+        for p in stale:
+            p.unlink(missing_ok=True)
+    if _PDF_CHUNK_STORE == "jsonz":
+        return chunks_path, _BlockChunksWriter(chunks_path, truncate=truncate)
+    return chunks_path, _ChunksWriter(chunks_path, truncate=truncate)
 
 
 def _extracted_ready(doc_id: str) -> bool:
     """判断 doc_id 是否已经有可复用的落盘抽取结果。"""
     base_dir = Path(_PDF_EXTRACT_DIR) / doc_id
-    return (base_dir / "chunks.jsonl").exists() and (base_dir / "meta.json").exists()
+    return (base_dir / "meta.json").exists() and _chunks_available(doc_id)
+
+
+def _chunks_index_paths(chunks_path: Path) -> tuple[Path, Path]:
+    """chunks.jsonl 的索引 sidecar：(行号索引 chunks.idx, 页首行索引 chunks.pages.idx)。"""
+    return chunks_path.with_suffix(".idx"), chunks_path.with_suffix(".pages.idx")
+
+
+class _ChunksIndex:
+    """chunks.jsonl 的“行号 -> byte offset”索引，续跑/统计进度时直接 seek，不再从第 0 行数起。
+
+    - chunks.idx：每行一个 little-endian uint64，记录该行的结束位置（即下一行的起始位置）；
+    - chunks.pages.idx：每组两个 uint32 (page, 首行行号)，记录每页第一条分片所在行。
+
+    索引落后于数据文件时（后台抽取写入中），只对未覆盖的尾部做一次增量扫描；
+    索引缺失或与数据不一致时（旧数据/文件被重写），按需全量重建并落盘。
+    """
+
+    _ENTRY = struct.Struct("<Q")
+    _PAGE_ENTRY = struct.Struct("<II")
+
+    def __init__(self, chunks_path: Path, *, repair: bool = True) -> None:
+        self.chunks_path = chunks_path
+        self.idx_path, self.pages_path = _chunks_index_paths(chunks_path)
+        try:
+            self.data_size = chunks_path.stat().st_size
+        except OSError:
+            self.data_size = 0
+
+        self._persisted = 0
+        self._tail: list[int] = []
+        self._pages: dict[int, int] | None = None
+
+        try:
+            idx_size = self.idx_path.stat().st_size
+        except OSError:
+            idx_size = -1
+
+        valid = idx_size >= 0
+        covered = 0
+        if idx_size >= self._ENTRY.size:
+            count = idx_size // self._ENTRY.size
+            with open(self.idx_path, "rb") as fp:
+                fp.seek((count - 1) * self._ENTRY.size)
+                (last_end,) = self._ENTRY.unpack(fp.read(self._ENTRY.size))
+            if last_end <= self.data_size:
+                self._persisted = count
+                covered = last_end
+            else:
+                valid = False
+
+        if covered < self.data_size:
+            self._tail = self._scan_line_ends(covered)
+
+        if not valid and repair:
+            self._rebuild()
+
+    def _scan_line_ends(self, start: int) -> list[int]:
+        """从 start 扫描到文件末尾，返回每个完整行的结束 offset（不含末尾的半行）。"""
+        ends: list[int] = []
+        try:
+            with open(self.chunks_path, "rb") as fp:
+                fp.seek(start)
+                pos = start
+                for raw in fp:
+                    if not raw.endswith(b"\n"):
+                        break
+                    pos += len(raw)
+                    ends.append(pos)
+        except OSError:
+            pass
+        return ends
+
+    def _rebuild(self) -> None:
+        """全量重建索引文件（同时解析每行的 page 字段，重建页首行索引）。"""
+        ends: list[int] = []
+        pages: dict[int, int] = {}
+        try:
+            with open(self.chunks_path, "rb") as fp:
+                pos = 0
+                for line_no, raw in enumerate(fp):
+                    if not raw.endswith(b"\n"):
+                        break
+                    pos += len(raw)
+                    ends.append(pos)
+                    try:
+                        page = json.loads(raw).get("page")
+                    except Exception:
+                        page = None
+                    if isinstance(page, int) and page >= 0 and page not in pages:
+                        pages[page] = line_no
+        except OSError:
+            return
+
+        try:
+            self.idx_path.write_bytes(b"".join(self._ENTRY.pack(e) for e in ends))
+            self.pages_path.write_bytes(
+                b"".join(self._PAGE_ENTRY.pack(p, ln) for p, ln in pages.items())
+            )
+        except OSError:
+            pass
+        self._persisted = len(ends)
+        self._tail = []
+        self._pages = pages
+
+    def count(self) -> int:
+        """已完整写入的行数。"""
+        return self._persisted + len(self._tail)
+
+    def end_offset(self) -> int:
+        """索引覆盖到的位置（最后一个完整行的结束 offset）。"""
+        return self.line_start(self.count())
+
+    def line_start(self, line_no: int) -> int:
+        """第 line_no 行（从 0 开始）的起始 byte offset；超出范围时返回末尾。"""
+        line_no = max(0, min(line_no, self.count()))
+        if line_no == 0:
+            return 0
+        entry = line_no - 1
+        if entry >= self._persisted:
+            return self._tail[entry - self._persisted]
+        with open(self.idx_path, "rb") as fp:
+            fp.seek(entry * self._ENTRY.size)
+            (end,) = self._ENTRY.unpack(fp.read(self._ENTRY.size))
+        return end
+
+    def tail_entries(self) -> list[int]:
+        """尚未落盘到 chunks.idx 的行结束 offset。"""
+        return list(self._tail)
+
+    def page_first_lines(self) -> dict[int, int]:
+        """page -> 该页第一条分片的行号。"""
+        if self._pages is None:
+            pages: dict[int, int] = {}
+            try:
+                data = self.pages_path.read_bytes()
+            except OSError:
+                data = b""
+            usable = len(data) - len(data) % self._PAGE_ENTRY.size
+            for page, line_no in self._PAGE_ENTRY.iter_unpack(data[:usable]):
+                pages.setdefault(page, line_no)
+            self._pages = pages
+        return dict(self._pages)
+
+
+class _ChunksWriter:
+    """chunks.jsonl 追加写入器：写数据的同时维护 chunks.idx / chunks.pages.idx。
+
+    flush 时先落数据、再落索引，保证索引永远不会指向尚未写入的数据。
+    """
+
+    def __init__(self, chunks_path: Path, *, truncate: bool = False) -> None:
+        self.path = chunks_path
+        idx_path, pages_path = _chunks_index_paths(chunks_path)
+        if truncate:
+            chunks_path.write_bytes(b"")
+            idx_path.write_bytes(b"")
+            pages_path.write_bytes(b"")
+
+        index = _ChunksIndex(chunks_path)
+        tail = index.tail_entries()
+        if tail:
+            with open(idx_path, "ab") as fp:
+                fp.write(b"".join(_ChunksIndex._ENTRY.pack(e) for e in tail))
+
+        self._line_no = index.count()
+        self._offset = index.end_offset()
+        self._pages_seen = set(index.page_first_lines())
+        self._pending_idx: list[bytes] = []
+        self._pending_pages: list[bytes] = []
+
+        self._fp = open(chunks_path, "ab")
+        self._idx_fp = open(idx_path, "ab")
+        self._pages_fp = open(pages_path, "ab")
+
+    def write_chunk(self, chunk: dict[str, Any]) -> None:
+        data = (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+        self._fp.write(data)
+        self._offset += len(data)
+        self._pending_idx.append(_ChunksIndex._ENTRY.pack(self._offset))
+
+        page = chunk.get("page")
+        if isinstance(page, int) and page >= 0 and page not in self._pages_seen:
+            self._pages_seen.add(page)
+            self._pending_pages.append(_ChunksIndex._PAGE_ENTRY.pack(page, self._line_no))
+        self._line_no += 1
+
+    def flush(self) -> None:
+        self._fp.flush()
+        if self._pending_idx:
+            self._idx_fp.write(b"".join(self._pending_idx))
+            self._pending_idx.clear()
+            self._idx_fp.flush()
+        if self._pending_pages:
+            self._pages_fp.write(b"".join(self._pending_pages))
+            self._pending_pages.clear()
+            self._pages_fp.flush()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._fp.close()
+            self._idx_fp.close()
+            self._pages_fp.close()
+
+
+def _iter_chunk_lines(chunks_path: Path, start_line: int = 0):
+    """从第 start_line 行开始按序产出 (行号, 行文本)；借助索引直接 seek，不逐行跳过。
+
+    只产出以换行结尾的完整行（后台抽取写到一半的行留到下次再读）。
+    存在块压缩的 chunks.jsonz 时从它读：定位到行所在的块，逐块解压产出。
+    """
+    if _compressed_chunks_paths(chunks_path)[0].exists():
+        yield from _BlockChunksIndex(chunks_path).iter_lines(start_line)
+        return
+    index = _ChunksIndex(chunks_path)
+    start_line = max(0, min(start_line, index.count()))
+    with open(chunks_path, "rb") as fp:
+        fp.seek(index.line_start(start_line))
+        line_no = start_line
+        for raw in fp:
+            if not raw.endswith(b"\n"):
+                return
+            yield line_no, raw.decode("utf-8", errors="replace")
+            line_no += 1
+
+
+def _compressed_chunks_paths(chunks_path: Path) -> tuple[Path, Path, Path]:
+    """块压缩分片的文件：(数据 chunks.jsonz, 块索引 chunks.jsonz.idx, 页首行索引 chunks.jsonz.pages)。"""
+    data_path = chunks_path.with_suffix(".jsonz")
+    return data_path, data_path.with_name(data_path.name + ".idx"), data_path.with_name(data_path.name + ".pages")
+
+
+class _BlockChunksIndex:
+    """chunks.jsonz 的块索引：每块一条 (块结束 offset, 截至该块的累计行数)，按行号二分定位到块。
+
+    数据文件由若干独立的 zlib 块组成，块头是 (压缩后长度, 行数)：索引缺失/落后时只需沿块头跳读补齐，
+    不必解压；页首行索引缺失时才需要解压重建。
+    """
+
+    _HEADER = struct.Struct("<II")
+    _ENTRY = struct.Struct("<QQ")
+
+    def __init__(self, chunks_path: Path) -> None:
+        self.data_path, self.idx_path, self.pages_path = _compressed_chunks_paths(chunks_path)
+        try:
+            self.data_size = self.data_path.stat().st_size
+        except OSError:
+            self.data_size = 0
+        self.ends: list[int] = []
+        self.lines: list[int] = []
+        self._persisted = 0
+        self._pages: dict[int, int] | None = None
+
+        try:
+            data = self.idx_path.read_bytes()
+        except OSError:
+            data = b""
+        usable = len(data) - len(data) % self._ENTRY.size
+        for end, lines in self._ENTRY.iter_unpack(data[:usable]):
+            if end > self.data_size:
+                break
+            self.ends.append(end)
+            self.lines.append(lines)
+        self._persisted = len(self.ends)
+        # 数据已写、索引还没写的块（写入中途被打断）：沿块头补齐
+        self._scan_blocks(self.ends[-1] if self.ends else 0)
+
+    def _scan_blocks(self, start: int) -> None:
+        try:
+            with open(self.data_path, "rb") as fp:
+                pos = start
+                total = self.lines[-1] if self.lines else 0
+                while pos + self._HEADER.size <= self.data_size:
+                    fp.seek(pos)
+                    size, n_lines = self._HEADER.unpack(fp.read(self._HEADER.size))
+                    end = pos + self._HEADER.size + size
+                    if end > self.data_size:
+                        break
+                    total += n_lines
+                    self.ends.append(end)
+                    self.lines.append(total)
+                    pos = end
+        except OSError:
+            pass
+
+    def pending_entries(self) -> list[bytes]:
+        """尚未落盘到块索引的条目。"""
+        return [self._ENTRY.pack(e, n) for e, n in zip(self.ends[self._persisted :], self.lines[self._persisted :])]
+
+    def count(self) -> int:
+        return self.lines[-1] if self.lines else 0
+
+    def end_offset(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def locate(self, line_no: int) -> tuple[int, int]:
+        """第 line_no 行所在块的 (起始 offset, 块内首行行号)。"""
+        block = bisect.bisect_right(self.lines, line_no)
+        if block == 0:
+            return 0, 0
+        return self.ends[block - 1], self.lines[block - 1]
+
+    def iter_lines(self, start_line: int = 0):
+        start_line = max(0, min(start_line, self.count()))
+        offset, line_no = self.locate(start_line)
+        end = self.end_offset()
+        if offset >= end:
+            return
+        with open(self.data_path, "rb") as fp:
+            fp.seek(offset)
+            while offset < end:
+                size, _ = self._HEADER.unpack(fp.read(self._HEADER.size))
+                payload = fp.read(size)
+                offset += self._HEADER.size + size
+                for raw in zlib.decompress(payload).splitlines(keepends=True):
+                    if line_no >= start_line:
+                        yield line_no, raw.decode("utf-8", errors="replace")
+                    line_no += 1
+
+    def page_first_lines(self) -> dict[int, int]:
+        if self._pages is None:
+            pages: dict[int, int] = {}
+            try:
+                data = self.pages_path.read_bytes()
+            except OSError:
+                data = None
+            if data is not None:
+                usable = len(data) - len(data) % _ChunksIndex._PAGE_ENTRY.size
+                for page, line_no in _ChunksIndex._PAGE_ENTRY.iter_unpack(data[:usable]):
+                    pages.setdefault(page, line_no)
+            else:
+                for line_no, line in self.iter_lines():
+                    try:
+                        page = json.loads(line).get("page")
+                    except Exception:
+                        page = None
+                    if isinstance(page, int) and page >= 0 and page not in pages:
+                        pages[page] = line_no
+            self._pages = pages
+        return dict(self._pages)
+
+
+class _BlockChunksWriter:
+    """chunks.jsonz 追加写入器（PDF_CHUNK_STORE=jsonz）：行先攒在内存，凑够 PDF_CHUNK_BLOCK_BYTES 压成一块写出。
+
+    与 _ChunksWriter 相同：先落数据、再落索引。代价是后台抽取时读者最多落后一个块（close 时写出最后一块）；
+    PDF_CHUNK_BLOCK_BYTES<=0 时每次 flush（每页）都成块，读者不落后，但压缩率会下降。
+    """
+
+    def __init__(self, chunks_path: Path, *, truncate: bool = False) -> None:
+        self.path = chunks_path
+        data_path, idx_path, pages_path = _compressed_chunks_paths(chunks_path)
+        if truncate:
+            for p in (data_path, idx_path, pages_path):
+                p.write_bytes(b"")
+
+        index = _BlockChunksIndex(chunks_path)
+        # 丢掉末尾写了一半的块，新块接在最后一个完整块后面
+        if data_path.exists() and index.data_size > index.end_offset():
+            with open(data_path, "r+b") as fp:
+                fp.truncate(index.end_offset())
+        pending = index.pending_entries()
+        if pending:
+            with open(idx_path, "ab") as fp:
+                fp.write(b"".join(pending))
+
+        self._line_no = index.count()
+        self._pages_seen = set(index.page_first_lines())
+        self._lines: list[bytes] = []
+        self._buffered = 0
+        self._pending_pages: list[bytes] = []
+
+        self._fp = open(data_path, "ab")
+        self._idx_fp = open(idx_path, "ab")
+        self._pages_fp = open(pages_path, "ab")
+        self._offset = index.end_offset()
+
+    def write_chunk(self, chunk: dict[str, Any]) -> None:
+        data = (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+        self._lines.append(data)
+        self._buffered += len(data)
+
+        page = chunk.get("page")
+        if isinstance(page, int) and page >= 0 and page not in self._pages_seen:
+            self._pages_seen.add(page)
+            self._pending_pages.append(_ChunksIndex._PAGE_ENTRY.pack(page, self._line_no))
+        self._line_no += 1
+
+    def _write_block(self) -> None:
+        payload = zlib.compress(b"".join(self._lines), _PDF_CHUNK_BLOCK_LEVEL)
+        self._fp.write(_BlockChunksIndex._HEADER.pack(len(payload), len(self._lines)) + payload)
+        self._fp.flush()
+        self._offset += _BlockChunksIndex._HEADER.size + len(payload)
+        self._idx_fp.write(_BlockChunksIndex._ENTRY.pack(self._offset, self._line_no))
+        self._idx_fp.flush()
+        self._lines.clear()
+        self._buffered = 0
+        # 页首行索引只登记已经写出的行
+        if self._pending_pages:
+            self._pages_fp.write(b"".join(self._pending_pages))
+            self._pending_pages.clear()
+            self._pages_fp.flush()
+
+    def flush(self, *, force: bool = False) -> None:
+        if self._lines and (force or self._buffered >= _PDF_CHUNK_BLOCK_BYTES):
+            self._write_block()
+
+    def close(self) -> None:
+        try:
+            self.flush(force=True)
+        finally:
+            self._fp.close()
+            self._idx_fp.close()
+            self._pages_fp.close()
+
+
+def _chunk_file_exists(chunks_path: Path) -> bool:
+    """jsonl 或块压缩格式的分片文件是否存在。"""
+    return chunks_path.exists() or _compressed_chunks_paths(chunks_path)[0].exists()
+
+
+def _chunk_file_index(chunks_path: Path) -> "_ChunksIndex | _BlockChunksIndex":
+    """分片文件的索引：存在块压缩文件时优先用它，否则是 chunks.jsonl。"""
+    if _compressed_chunks_paths(chunks_path)[0].exists():
+        return _BlockChunksIndex(chunks_path)
+    return _ChunksIndex(chunks_path)
+
+
+class _SqliteChunkStore:
+    """SQLite 分片库（PDF_CHUNK_STORE=sqlite 时替代 chunks.jsonl，所有文档共用一个库文件）。
+
+    - 每条分片保留原始 JSON 行，读者拿到的内容与 jsonl 后端一致；
+    - kind / page / part_index / 内容哈希拆成单独的列并建索引：按页、按行号区间、去重读取都走索引；
+    - 每个线程各用一个连接；WAL 模式下后台抽取批量写入时，读者不会被阻塞。
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chunks (
+            doc_id       TEXT    NOT NULL,
+            line_no      INTEGER NOT NULL,
+            kind         TEXT,
+            page         INTEGER,
+            part_index   INTEGER,
+            content_hash TEXT    NOT NULL,
+            line         TEXT    NOT NULL,
+            PRIMARY KEY (doc_id, line_no)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_chunks_page ON chunks (doc_id, page, part_index);
+        CREATE INDEX IF NOT EXISTS idx_chunks_kind ON chunks (doc_id, kind, line_no);
+        CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks (doc_id, content_hash, line_no);
+    """
+
+    # 顺序读取时每次取出的行数（不长时间占着读事务，分析模型调用期间不影响写入）
+    _READ_BATCH = 256
+    _IMPORT_BATCH = 1000
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._local = threading.local()
+        self._import_lock = threading.Lock()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row(doc_id: str, line_no: int, line: str) -> tuple[Any, ...]:
+        line = line.strip()
+        try:
+            obj = json.loads(line)
+        except Exception:
+            obj = None
+        if not isinstance(obj, dict):
+            obj = {}
+        kind = obj.get("kind")
+        page = obj.get("page")
+        part_index = obj.get("part_index")
+        return (
+            doc_id,
+            line_no,
+            kind if isinstance(kind, str) else None,
+            page if isinstance(page, int) else None,
+            part_index if isinstance(part_index, int) else None,
+            # 与 jsonl 读取时的去重签名保持一致：整行 sha1
+            hashlib.sha1(line.encode("utf-8")).hexdigest(),
+            line,
+        )
+
+    def has_doc(self, doc_id: str) -> bool:
+        row = self._connect().execute("SELECT 1 FROM chunks WHERE doc_id = ? LIMIT 1", (doc_id,)).fetchone()
+        return row is not None
+
+    def count(self, doc_id: str) -> int:
+        """已写入的行数（行号连续，等于最大行号 + 1）。"""
+        row = self._connect().execute(
+            "SELECT COALESCE(MAX(line_no) + 1, 0) FROM chunks WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        return int(row[0])
+
+    def insert_lines(self, doc_id: str, start_line: int, lines: list[str]) -> None:
+        """批量插入：一次事务 + executemany。"""
+        if not lines:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self._row(doc_id, start_line + i, line) for i, line in enumerate(lines)],
+            )
+
+    def delete_doc(self, doc_id: str) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+
+    def iter_lines(self, doc_id: str, start_line: int = 0, *, dedup: bool = False):
+        """从 start_line 开始按序产出 (行号, 行文本)；dedup=True 时跳过与更早行内容相同的行。"""
+        sql = "SELECT line_no, line FROM chunks c WHERE doc_id = ? AND line_no >= ?"
+        if dedup:
+            sql += (
+                " AND NOT EXISTS (SELECT 1 FROM chunks d WHERE d.doc_id = c.doc_id"
+                " AND d.content_hash = c.content_hash AND d.line_no < c.line_no)"
+            )
+        sql += " ORDER BY line_no LIMIT ?"
+        next_line = max(0, start_line)
+        while True:
+            rows = self._connect().execute(sql, (doc_id, next_line, self._READ_BATCH)).fetchall()
+            if not rows:
+                return
+            for line_no, line in rows:
+                yield line_no, line
+            next_line = rows[-1][0] + 1
+
+    def page_first_lines(self, doc_id: str) -> dict[int, int]:
+        """page -> 该页第一条分片的行号。"""
+        rows = self._connect().execute(
+            "SELECT page, MIN(line_no) FROM chunks WHERE doc_id = ? AND page IS NOT NULL GROUP BY page",
+            (doc_id,),
+        ).fetchall()
+        return {int(page): int(line_no) for page, line_no in rows}
+
+    def query(
+        self,
+        doc_id: str,
+        *,
+        pages: tuple[int, int] | None = None,
+        kind: str | None = None,
+        lines: tuple[int, int] | None = None,
+    ) -> list[dict[str, Any]]:
+        """按页区间 [start, end)、kind、行号区间 [start, end) 查询分片（按写入顺序返回）。"""
+        sql = "SELECT line FROM chunks WHERE doc_id = ?"
+        params: list[Any] = [doc_id]
+        if pages is not None:
+            sql += " AND page >= ? AND page < ?"
+            params.extend(pages)
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        if lines is not None:
+            sql += " AND line_no >= ? AND line_no < ?"
+            params.extend(lines)
+        sql += " ORDER BY line_no"
+
+        out: list[dict[str, Any]] = []
+        for (line,) in self._connect().execute(sql, params):
+            try:
+                obj = json.loads(line)
+            except Exception:
+                continue
+            if isinstance(obj, dict):
+                out.append(obj)
+        return out
+
+    def import_jsonl(self, doc_id: str, chunks_path: Path) -> int:
+        """把已有的 chunks.jsonl 导入库中（整份一个事务：要么全部导入，要么不导入）。
+
+        库里已经有该 doc_id 时不重复导入，返回 0。
+        """
+        with self._import_lock:
+            if self.has_doc(doc_id) or not _chunk_file_exists(chunks_path):
+                return 0
+            conn = self._connect()
+            imported = 0
+            batch: list[tuple[Any, ...]] = []
+            with conn:
+                for line_no, line in _iter_chunk_lines(chunks_path):
+                    batch.append(self._row(doc_id, line_no, line))
+                    if len(batch) >= self._IMPORT_BATCH:
+                        conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                        imported += len(batch)
+                        batch.clear()
+                if batch:
+                    conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                    imported += len(batch)
+            return imported
+
+
+class _SqliteChunksWriter:
+    """_ChunksWriter 的 SQLite 版本：write_chunk 只进缓冲，flush 时一次事务批量插入。"""
+
+    def __init__(self, store: _SqliteChunkStore, doc_id: str, *, truncate: bool = False) -> None:
+        self._store = store
+        self._doc_id = doc_id
+        if truncate:
+            store.delete_doc(doc_id)
+        self._line_no = store.count(doc_id)
+        self._pending: list[str] = []
+
+    def write_chunk(self, chunk: dict[str, Any]) -> None:
+        self._pending.append(json.dumps(chunk, ensure_ascii=False))
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        self._store.insert_lines(self._doc_id, self._line_no, self._pending)
+        self._line_no += len(self._pending)
+        self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+_chunk_store: _SqliteChunkStore | None = None
+_chunk_store_lock = threading.Lock()
+
+
+def _get_chunk_store() -> _SqliteChunkStore | None:
+    """PDF_CHUNK_STORE=sqlite 时返回共享的分片库；默认 jsonl 后端返回 None。"""
+    global _chunk_store
+    if _PDF_CHUNK_STORE != "sqlite":
+        return None
+    if _chunk_store is None:
+        with _chunk_store_lock:
+            if _chunk_store is None:
+                _chunk_store = _SqliteChunkStore(Path(_PDF_CHUNK_DB))
+    return _chunk_store
+
+
+def _chunks_jsonl_path(doc_id: str) -> Path:
+    return Path(_PDF_EXTRACT_DIR) / doc_id / "chunks.jsonl"
+
+
+def _chunks_available(doc_id: str) -> bool:
+    """doc_id 是否已有落盘分片；sqlite 后端遇到旧的 chunks.jsonl 时顺带导入（不需要重新抽取）。"""
+    store = _get_chunk_store()
+    chunks_path = _chunks_jsonl_path(doc_id)
+    if store is None:
+        return _chunk_file_exists(chunks_path)
+    if store.has_doc(doc_id):
+        return True
+    if _chunk_file_exists(chunks_path):
+        store.import_jsonl(doc_id, chunks_path)
+        return store.has_doc(doc_id)
+    return False
+
+
+def _count_doc_chunks(doc_id: str) -> int:
+    """已完整写入的分片行数。"""
+    store = _get_chunk_store()
+    if store is not None:
+        return store.count(doc_id)
+    return _chunk_file_index(_chunks_jsonl_path(doc_id)).count()
+
+
+def _doc_page_first_lines(doc_id: str) -> dict[int, int]:
+    """page -> 该页第一条分片的行号。"""
+    store = _get_chunk_store()
+    if store is not None:
+        return store.page_first_lines(doc_id)
+    return _chunk_file_index(_chunks_jsonl_path(doc_id)).page_first_lines()
+
+
+def _iter_doc_chunks(doc_id: str, start_line: int = 0, *, dedup: bool = False):
+    """按序产出 doc_id 的 (行号, 行文本)，屏蔽存储后端差异。
+
+    dedup=True 时跳过内容完全相同的重复行：sqlite 后端按内容哈希索引在整份文档范围内去重，
+    jsonl 后端在本次读取范围内用 sha1 集合去重。
+    """
+    store = _get_chunk_store()
+    if store is not None:
+        yield from store.iter_lines(doc_id, start_line, dedup=dedup)
+        return
+
+    seen: set[str] = set()
+    for line_no, line in _iter_chunk_lines(_chunks_jsonl_path(doc_id), start_line):
+        if dedup:
+            stripped = line.strip()
+            if stripped:
+                sig = hashlib.sha1(stripped.encode("utf-8")).hexdigest()
+                if sig in seen:
+                    continue
+                seen.add(sig)
+        yield line_no, line
+
+
+def import_pdf_chunks_to_store(extract_dir: str | Path | None = None) -> dict[str, int]:
+    """把 <PDF_EXTRACT_DIR>/<doc_id>/chunks.jsonl（或 chunks.jsonz）批量导入 SQLite 分片库。
+
+    返回 {doc_id: 导入行数}；库中已存在的文档跳过（导入行数为 0）。
+    """
+    store = _get_chunk_store() or _SqliteChunkStore(Path(_PDF_CHUNK_DB))
+    root = Path(extract_dir or _PDF_EXTRACT_DIR)
+    imported: dict[str, int] = {}
+    if not root.is_dir():
+        return imported
+    for doc_dir in sorted(root.iterdir()):
+        doc_id = doc_dir.name
+        chunks_path = doc_dir / "chunks.jsonl"
+        if not _DOC_ID_HEX_RE.fullmatch(doc_id) or not _chunk_file_exists(chunks_path):
+            continue
+        imported[doc_id] = store.import_jsonl(doc_id, chunks_path)
+    return imported
+
+
+def _update_extract_meta(doc_id: str, **fields: Any) -> None:
+    """把抽取阶段的统计信息合并写入 storage/pdf_extracted/<doc_id>/meta.json。"""
+    meta_path = Path(_PDF_EXTRACT_DIR) / doc_id / "meta.json"
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8")) if meta_path.exists() else {}
+    except Exception:
+        meta = {}
+    if not isinstance(meta, dict):
+        meta = {}
+    meta.update(fields)
+    try:
+        meta_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    except OSError:
+        pass
 
 
 def _split_text(text: str, max_chars: int) -> list[str]:
@@ -601,9 +1760,8 @@ def _split_text(text: str, max_chars: int) -> list[str]:
 
 
 def _build_context_excerpt_from_chunks(doc_id: str) -> str:
-    """从已落盘的 chunks.jsonl 构造“注入上下文”的节选，避免重复解析 PDF。"""
-    chunks_path = Path(_PDF_EXTRACT_DIR) / doc_id / "chunks.jsonl"
-    if not chunks_path.exists():
+    """从已落盘的分片构造“注入上下文”的节选，避免重复解析 PDF。"""
+    if not _chunks_available(doc_id):
         return ""
 
     pages_seen: set[int] = set()
@@ -611,40 +1769,48 @@ def _build_context_excerpt_from_chunks(doc_id: str) -> str:
     chars = 0
     out_parts: list[str] = []
 
-    with open(chunks_path, "r", encoding="utf-8") as fp:
-        for line in fp:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except Exception:
-                continue
-            if not isinstance(obj, dict):
-                continue
-
-            content = obj.get("content", "")
-            if not isinstance(content, str) or not content.strip():
-                continue
+    # 借助页首行索引算出“第 PDF_CONTEXT_MAX_PAGES+1 页”从哪一行开始，读到那里就停
+    stop_line: int | None = None
+    if _PDF_CONTEXT_MAX_PAGES > 0:
+        first_lines = sorted(_doc_page_first_lines(doc_id).values())
+        if len(first_lines) > _PDF_CONTEXT_MAX_PAGES:
+            stop_line = first_lines[_PDF_CONTEXT_MAX_PAGES]
+
+    for line_no, line in _iter_doc_chunks(doc_id):
+        if stop_line is not None and line_no >= stop_line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = json.loads(line)
+        except Exception:
+            continue
+        if not isinstance(obj, dict):
+            continue
 
-            page = obj.get("page")
-            if isinstance(page, int):
-                if page not in pages_seen:
-                    pages_seen.add(page)
-                    pages_count += 1
-                if _PDF_CONTEXT_MAX_PAGES > 0 and pages_count > _PDF_CONTEXT_MAX_PAGES:
-                    break
+        content = obj.get("content", "")
+        if not isinstance(content, str) or not content.strip():
+            continue
 
-            if _PDF_CONTEXT_MAX_CHARS > 0 and chars >= _PDF_CONTEXT_MAX_CHARS:
+        page = obj.get("page")
+        if isinstance(page, int):
+            if page not in pages_seen:
+                pages_seen.add(page)
+                pages_count += 1
+            if _PDF_CONTEXT_MAX_PAGES > 0 and pages_count > _PDF_CONTEXT_MAX_PAGES:
                 break
 
-            remaining = _PDF_CONTEXT_MAX_CHARS - chars if _PDF_CONTEXT_MAX_CHARS > 0 else None
-            if remaining is not None and remaining <= 0:
-                break
+        if _PDF_CONTEXT_MAX_CHARS > 0 and chars >= _PDF_CONTEXT_MAX_CHARS:
+            break
+
+        remaining = _PDF_CONTEXT_MAX_CHARS - chars if _PDF_CONTEXT_MAX_CHARS > 0 else None
+        if remaining is not None and remaining <= 0:
+            break
 
-            text_to_add = content if remaining is None else content[:remaining]
-            out_parts.append(text_to_add)
-            chars += len(text_to_add)
+        text_to_add = content if remaining is None else content[:remaining]
+        out_parts.append(text_to_add)
+        chars += len(text_to_add)
 
     excerpt = "\n\n".join([p for p in out_parts if p.strip()]).strip()
     if excerpt:
@@ -668,6 +1834,209 @@ def _truncate_text(text: str, max_chars: int) -> tuple[str, bool]:
     )
 
 
+# ==========================
+# 模型调用限流（按 provider 共享）
+# ==========================
+# 令牌桶控制请求速率；遇到 429 类错误做指数退避（带随机抖动）重试；
+# 连续失败达到阈值后熔断（open），冷却期过后放行一个探测请求（half-open），成功即自动恢复。
+#
+# 可通过环境变量按 provider 调整（<P> 为 DOUBAO / DEEPSEEK）：
+# - PDF_RATE_<P>_QPS=2               每秒请求数（令牌补充速率，<=0 表示不限速）
+# - PDF_RATE_<P>_BURST=4             令牌桶容量（允许的瞬时突发请求数）
+# - PDF_RATE_<P>_RETRIES=3           429 类错误的最大重试次数
+# - PDF_RATE_<P>_BREAKER_FAILURES=3  连续多少次 429 后熔断
+# - PDF_RATE_<P>_COOLDOWN=30         熔断冷却时间（秒）；每次探测失败翻倍，最长 10 分钟
+#
+_RATE_LIMIT_DEFAULTS: dict[str, dict[str, float]] = {
+    "doubao": {"qps": 2.0, "burst": 4.0},
+    "deepseek": {"qps": 5.0, "burst": 10.0},
+}
+
+_RATE_LIMIT_ERROR_MARKERS: tuple[str, ...] = (
+    "SetLimitExceeded",
+    "Safe Experience Mode",
+    "TooManyRequests",
+    "RateLimitError",
+    "429",
+)
+
+
+def _is_rate_limit_error(exc: BaseException) -> bool:
+    """识别“账号推理额度被暂停/限流”的典型报错。"""
+    err = f"{type(exc).__name__}: {exc}"
+    return any(k in err for k in _RATE_LIMIT_ERROR_MARKERS)
+
+
+class _CircuitOpenError(RuntimeError):
+    """熔断中：在冷却期内直接拒绝请求（不打到模型服务）。"""
+
+
+class _ProviderRateLimiter:
+    """单个 provider 的令牌桶 + 指数退避 + 半开熔断器（线程安全）。"""
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        qps: float,
+        burst: float,
+        max_retries: int,
+        breaker_failures: int,
+        cooldown_seconds: float,
+        max_cooldown_seconds: float = 600.0,
+        backoff_base_seconds: float = 1.0,
+        backoff_max_seconds: float = 20.0,
+    ) -> None:
+        self.name = name
+        self._qps = qps
+        self._burst = max(1.0, burst)
+        self._max_retries = max(0, max_retries)
+        self._breaker_failures = max(1, breaker_failures)
+        self._base_cooldown = max(0.0, cooldown_seconds)
+        self._max_cooldown = max(self._base_cooldown, max_cooldown_seconds)
+        self._backoff_base = backoff_base_seconds
+        self._backoff_max = backoff_max_seconds
+
+        self._lock = threading.Lock()
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+
+        self._state = "closed"  # closed | open | half_open
+        self._failures = 0
+        self._cooldown = self._base_cooldown
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def _token_wait(self) -> float:
+        """尝试取一个令牌：取到返回 0，桶空时返回距离下一个令牌补充出来的秒数。"""
+        if self._qps <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._qps)
+            self._refilled_at = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self._qps
+
+    def _acquire_token(self) -> None:
+        """取一个令牌；桶空时睡到下一个令牌补充出来。"""
+        while (wait := self._token_wait()) > 0:
+            time.sleep(wait)
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self._cooldown:
+                    raise _CircuitOpenError(
+                        f"{self.name} 已熔断（连续触发 429），"
+                        f"{self._cooldown - (time.monotonic() - self._opened_at):.0f}s 后自动重试"
+                    )
+                self._state = "half_open"
+                self._probe_in_flight = False
+            if self._state == "half_open":
+                # 半开状态只放行一个探测请求，其余请求仍按熔断处理
+                if self._probe_in_flight:
+                    raise _CircuitOpenError(f"{self.name} 熔断恢复探测中，请稍后重试")
+                self._probe_in_flight = True
+
+    def _on_success(self) -> None:
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._cooldown = self._base_cooldown
+            self._probe_in_flight = False
+
+    def _on_rate_limited(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open":
+                # 探测失败：重新熔断，冷却时间翻倍
+                self._cooldown = min(self._max_cooldown, max(self._cooldown * 2, 1.0))
+                self._state = "open"
+                self._opened_at = time.monotonic()
+            elif self._failures >= self._breaker_failures:
+                self._state = "open"
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def _on_other_error(self) -> None:
+        with self._lock:
+            # 非限流错误不计入熔断，但半开探测需要释放，让下一个请求继续探测
+            self._probe_in_flight = False
+
+    def _retry_delay(self, exc: Exception, attempt: int) -> float:
+        """记录一次失败：还能重试时返回退避秒数（full jitter），否则把异常原样抛出。"""
+        if not _is_rate_limit_error(exc):
+            self._on_other_error()
+            raise exc
+        self._on_rate_limited()
+        if attempt >= self._max_retries or self._state == "open":
+            raise exc
+        delay = min(self._backoff_max, self._backoff_base * (2**attempt))
+        return random.uniform(0, delay)
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        """在限流/熔断保护下执行 fn()；非 429 类异常原样抛出。"""
+        attempt = 0
+        while True:
+            self._before_call()
+            self._acquire_token()
+            try:
+                result = fn()
+            except Exception as exc:
+                time.sleep(self._retry_delay(exc, attempt))
+                attempt += 1
+                continue
+            self._on_success()
+            return result
+
+    async def acall(self, afn: Callable[[], Awaitable[Any]]) -> Any:
+        """call 的异步版本：等令牌/退避都用 asyncio.sleep，不阻塞事件循环。"""
+        attempt = 0
+        while True:
+            self._before_call()
+            while (wait := self._token_wait()) > 0:
+                await asyncio.sleep(wait)
+            try:
+                result = await afn()
+            except Exception as exc:
+                await asyncio.sleep(self._retry_delay(exc, attempt))
+                attempt += 1
+                continue
+            self._on_success()
+            return result
+
+
+_rate_limiters: dict[str, _ProviderRateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _get_rate_limiter(provider: str) -> _ProviderRateLimiter:
+    """按 provider 取共享的限流器（进程内单例，所有调用方共用同一份配额）。"""
+    key = provider.lower()
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            defaults = _RATE_LIMIT_DEFAULTS.get(key, {"qps": 5.0, "burst": 10.0})
+            prefix = f"PDF_RATE_{key.upper()}_"
+            limiter = _ProviderRateLimiter(
+                key,
+                qps=_env_float(prefix + "QPS", defaults["qps"]),
+                burst=_env_float(prefix + "BURST", defaults["burst"]),
+                max_retries=_env_int(prefix + "RETRIES", 3),
+                breaker_failures=_env_int(prefix + "BREAKER_FAILURES", 3),
+                cooldown_seconds=_env_float(prefix + "COOLDOWN", 30.0),
+            )
+            _rate_limiters[key] = limiter
+        return limiter
+
+
 _IMAGE_TO_TEXT_PROMPT: str = (
     "你是一个用于PDF内容解析的助手，任务是把图片内容转成可检索的文本。\n"
     "1) 用尽可能精炼、信息密度高的方式描述图片（便于检索）。\n"
@@ -746,7 +2115,261 @@ def _try_get_image_size(raw: bytes, mimetype: str) -> tuple[int | None, int | No
         return None, None
 
 
-class _BudgetedImageBlobParser(BaseBlobParser):
+class _ImageCaptionCache:
+    """磁盘上的图片解析结果缓存（内容寻址 + 按总大小做 LRU 淘汰）。
+
+    - key = sha256(图片原始 bytes) + sha256(提示词 + 模型标识)：换提示词/换模型自动失效；
+    - 每个条目一个文本文件，命中时刷新 mtime，淘汰时按 mtime 从旧到新删除。
+    """
+
+    def __init__(self, root: Path, *, max_bytes: int) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes: int | None = None
+
+    @staticmethod
+    def make_key(raw: bytes, *, prompt: str, model_id: str) -> str:
+        image_digest = hashlib.sha256(raw).hexdigest()
+        identity_digest = hashlib.sha256(f"{model_id}\n{prompt}".encode("utf-8")).hexdigest()
+        return f"{image_digest}-{identity_digest[:16]}"
+
+    def _path(self, key: str) -> Path:
+        return self._root / key[:2] / f"{key}.md"
+
+    def get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            text = path.read_text(encoding="utf-8")
+        except (FileNotFoundError, OSError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        path = self._path(key)
+        data = text.encode("utf-8")
+        # 覆盖已有条目时先记下旧文件大小，计数只加差值
+        try:
+            old_size = path.stat().st_size
+        except OSError:
+            old_size = 0
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{uuid4().hex}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_total_bytes()
+            else:
+                self._total_bytes += len(data) - old_size
+            if self._max_bytes > 0 and self._total_bytes > self._max_bytes:
+                self._evict()
+
+    def _scan_total_bytes(self) -> int:
+        total = 0
+        for p in self._root.glob("*/*.md"):
+            try:
+                total += p.stat().st_size
+            except OSError:
+                continue
+        return total
+
+    def _evict(self) -> None:
+        """淘汰到上限的 90%，避免每次写入都触发一次全目录扫描。"""
+        entries: list[tuple[float, int, Path]] = []
+        for p in self._root.glob("*/*.md"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        target = int(self._max_bytes * 0.9)
+        for _, size, p in entries:
+            if total <= target:
+                break
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+        self._total_bytes = total
+
+
+def _image_dhash(raw: bytes) -> int | None:
+    """本地计算 64 位 dHash（差值感知哈希）：缩放到 9x8 灰度图，比较相邻像素明暗。
+
+    用 PyMuPDF 的 Pixmap 完成解码/缩放，不依赖 Pillow；无法解码时返回 None。
+    """
+    try:
+        with _PYMUPDF_LOCK:
+            pix = pymupdf.Pixmap(raw)
+            if pix.alpha:
+                pix = pymupdf.Pixmap(pix, 0)
+            if pix.n != 1:
+                pix = pymupdf.Pixmap(pymupdf.csGRAY, pix)
+            small = pymupdf.Pixmap(pix, 9, 8, None)
+            samples = small.samples
+            stride = small.stride
+    except Exception:
+        return None
+
+    value = 0
+    for y in range(8):
+        row = samples[y * stride : y * stride + 9]
+        if len(row) < 9:
+            return None
+        for x in range(8):
+            value = (value << 1) | (1 if row[x] > row[x + 1] else 0)
+    return value
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _scan_boilerplate_images(pdf_doc: Any, page_count: int) -> list[int]:
+    """抽取前的预扫描：统计每张图片出现在多少页上，返回“样板图片”的 dHash 列表。
+
+    只读取 PDF 内嵌的原始图片（按 xref 去重，不做页面渲染），开销远小于 Markdown 转换。
+    页数太少时不做判断（3 页的文档里每页都有的图未必是水印）。
+    """
+    if page_count < 3 or _PDF_IMAGE_BOILERPLATE_RATIO <= 0:
+        return []
+
+    xref_hash: dict[int, int | None] = {}
+    groups: list[list[Any]] = []  # [dhash, pages_set]
+    for page_no in range(page_count):
+        with _PYMUPDF_LOCK:
+            try:
+                xrefs = [img[0] for img in pdf_doc[page_no].get_images(full=True)]
+            except Exception:
+                continue
+        for xref in xrefs:
+            if xref not in xref_hash:
+                with _PYMUPDF_LOCK:
+                    try:
+                        raw = (pdf_doc.extract_image(xref) or {}).get("image") or b""
+                    except Exception:
+                        raw = b""
+                xref_hash[xref] = _image_dhash(raw) if raw else None
+            dhash = xref_hash[xref]
+            if dhash is None:
+                continue
+            for group in groups:
+                if _hamming(group[0], dhash) <= _PDF_IMAGE_PHASH_DISTANCE:
+                    group[1].add(page_no)
+                    break
+            else:
+                groups.append([dhash, {page_no}])
+
+    threshold = max(3, int(page_count * _PDF_IMAGE_BOILERPLATE_RATIO + 0.999))
+    return [dhash for dhash, pages in groups if len(pages) >= threshold]
+
+
+class _DedupImageBlobParser(BaseBlobParser):
+    """单文档内的图片去重（放在预算/缓存/模型之前）。
+
+    - 精确重复（sha256 相同）或近似重复（dHash 汉明距离小）：只解析第一次出现的图片，后续引用它；
+    - 样板图片（预扫描判定为几乎每页都有的 Logo/水印）：直接跳过，不占用 PDF_IMAGE_MAX_IMAGES。
+    """
+
+    def __init__(self, inner: BaseBlobParser, *, boilerplate_hashes: list[int]) -> None:
+        super().__init__()
+        self._inner = inner
+        self._boilerplate = list(boilerplate_hashes)
+        self._by_digest: dict[str, Any] = {}
+        self._by_dhash: list[tuple[int, Any]] = []
+        self.duplicate_images = 0
+        self.boilerplate_images = 0
+
+    def _classify(self, blob: Blob) -> tuple[str, Any]:
+        """返回 ("boilerplate" | "duplicate" | "new", 首次出现的页码)。"""
+        raw = blob.as_bytes()
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest in self._by_digest:
+            return "duplicate", self._by_digest[digest]
+
+        dhash = _image_dhash(raw)
+        if dhash is not None:
+            if any(_hamming(dhash, b) <= _PDF_IMAGE_PHASH_DISTANCE for b in self._boilerplate):
+                return "boilerplate", None
+            for known, first_page in self._by_dhash:
+                if _hamming(dhash, known) <= _PDF_IMAGE_PHASH_DISTANCE:
+                    self._by_digest[digest] = first_page
+                    return "duplicate", first_page
+
+        first_page = (blob.metadata or {}).get("page")
+        self._by_digest[digest] = first_page
+        if dhash is not None:
+            self._by_dhash.append((dhash, first_page))
+        return "new", first_page
+
+    def _reference_document(self, blob: Blob, verdict: str, first_page: Any) -> Document:
+        metadata = {**blob.metadata, **{"source": blob.source}}
+        if verdict == "boilerplate":
+            self.boilerplate_images += 1
+            # 样板图片返回空内容，避免在每一页的分片里重复出现
+            return Document(page_content="", metadata=metadata)
+        self.duplicate_images += 1
+        return Document(
+            page_content=f"[重复图片：与 page={first_page} 的图片相同，解析结果见该页]",
+            metadata=metadata,
+        )
+
+    def lazy_parse(self, blob: Blob):
+        verdict, first_page = self._classify(blob)
+        if verdict != "new":
+            yield self._reference_document(blob, verdict, first_page)
+            return
+        yield from self._inner.lazy_parse(blob)
+
+    def parse_many(self, blobs: list[Blob]) -> list[Document]:
+        results: list[Document | None] = [None] * len(blobs)
+        fresh: list[int] = []
+        for i, blob in enumerate(blobs):
+            verdict, first_page = self._classify(blob)
+            if verdict == "new":
+                fresh.append(i)
+            else:
+                results[i] = self._reference_document(blob, verdict, first_page)
+
+        if fresh:
+            parsed = _parse_image_blobs(self._inner, [blobs[i] for i in fresh])
+            for i, doc in zip(fresh, parsed):
+                results[i] = doc
+        return [doc for doc in results if doc is not None]
+
+
+def _parse_image_blobs(parser: BaseBlobParser, blobs: list[Blob]) -> list[Document]:
+    """批量解析图片：解析器支持 parse_many 时走并发路径，否则逐张 lazy_parse。
+
+    返回值与 blobs 一一对应（保持原顺序），便于按页序回填。
+    """
+    parse_many = getattr(parser, "parse_many", None)
+    if callable(parse_many):
+        return parse_many(blobs)
+    docs: list[Document] = []
+    for blob in blobs:
+        parsed = list(parser.lazy_parse(blob))
+        docs.append(
+            Document(
+                page_content="\n".join(d.page_content for d in parsed if d.page_content),
+                metadata={**blob.metadata, **{"source": blob.source}},
+            )
+        )
+    return docs
+
+
+class _BudgetedImageBlobParser(BaseBlobParser):
     """给图片多模态解析加“预算限制”，避免图片太多导致长时间阻塞。"""
 
     def __init__(self, inner: BaseBlobParser, *, max_images: int) -> None:
@@ -755,46 +2378,90 @@ class _BudgetedImageBlobParser(BaseBlobParser):
         self._max_images = max_images
         self.parsed_images = 0
         self.skipped_images = 0
-
-    def lazy_parse(self, blob: Blob):
+        # 本文档内的缓存命中统计（由内层解析器在 metadata["caption_cache"] 上标注）
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _count_cache(self, doc: Document) -> Document:
+        flag = (doc.metadata or {}).get("caption_cache")
+        if flag == "hit":
+            self.cache_hits += 1
+        elif flag == "miss":
+            self.cache_misses += 1
+        return doc
+
+    def _take_budget(self) -> bool:
         if self._max_images >= 0 and self.parsed_images >= self._max_images:
             self.skipped_images += 1
-            yield Document(
-                page_content=f"[图片过多，已跳过多模态解析：max_images={self._max_images}]",
-                metadata={**blob.metadata, **{"source": blob.source}},
-            )
+            return False
+        self.parsed_images += 1
+        return True
+
+    def _skipped_document(self, blob: Blob) -> Document:
+        return Document(
+            page_content=f"[图片过多，已跳过多模态解析：max_images={self._max_images}]",
+            metadata={**blob.metadata, **{"source": blob.source}},
+        )
+
+    def lazy_parse(self, blob: Blob):
+        if not self._take_budget():
+            yield self._skipped_document(blob)
             return
+        for doc in self._inner.lazy_parse(blob):
+            yield self._count_cache(doc)
+
+    def parse_many(self, blobs: list[Blob]) -> list[Document]:
+        """并发路径同样按顺序扣减预算：超出 max_images 的图片不会发出请求。"""
+        results: list[Document | None] = [None] * len(blobs)
+        allowed: list[int] = []
+        for i, blob in enumerate(blobs):
+            if self._take_budget():
+                allowed.append(i)
+            else:
+                results[i] = self._skipped_document(blob)
 
-        self.parsed_images += 1
-        yield from self._inner.lazy_parse(blob)
+        if allowed:
+            parsed = _parse_image_blobs(self._inner, [blobs[i] for i in allowed])
+            for i, doc in zip(allowed, parsed):
+                results[i] = self._count_cache(doc)
+        return [doc for doc in results if doc is not None]
 
 
 class _MultimodalImageBlobParser(BaseBlobParser):
     """把图片 Blob 交给多模态模型，输出图片描述/图片文字。"""
 
-    def __init__(self, *, model, prompt: str = _IMAGE_TO_TEXT_PROMPT) -> None:
+    def __init__(
+        self,
+        *,
+        model,
+        prompt: str = _IMAGE_TO_TEXT_PROMPT,
+        max_concurrency: int = 1,
+        cache: _ImageCaptionCache | None = None,
+    ) -> None:
         super().__init__()
         self._model = model
         self._prompt = prompt
-        # doubao 触发 429 时，后续图片不再继续打请求（避免刷屏 + 避免前端看起来“卡住”）
-        self._rate_limited = False
+        self._max_concurrency = max(1, max_concurrency)
+        self._cache = cache
+        self._model_id = str(
+            getattr(model, "model_name", None) or getattr(model, "model", None) or type(model).__name__
+        )
+        # doubao 触发 429 时由共享限流器退避/熔断；熔断期间只提示一次（避免刷屏），恢复后重置
+        self._limiter = _get_rate_limiter("doubao")
         self._rate_limit_notice_emitted = False
+        self._notice_lock = threading.Lock()
 
-    def lazy_parse(self, blob: Blob):
+    def _prepare(self, blob: Blob) -> tuple[str | None, tuple[str, bytes] | None]:
+        """本地预检查：返回 (直接输出的文本, None) 或 (None, (mimetype, raw))。"""
         with blob.as_bytes_io() as buf:
             raw = buf.read()
 
         if _PDF_IMAGE_MAX_BYTES > 0 and len(raw) > _PDF_IMAGE_MAX_BYTES:
             mb = len(raw) / (1024 * 1024)
-            content = (
+            return (
                 f"[图片过大（{mb:.2f}MB），已跳过多模态解析："
                 f"PDF_IMAGE_MAX_BYTES={_PDF_IMAGE_MAX_BYTES}]"
-            )
-            yield Document(
-                page_content=content,
-                metadata={**blob.metadata, **{"source": blob.source}},
-            )
-            return
+            ), None
 
         mimetype = blob.mimetype or "image/png"
         if mimetype == "application/octet-stream" and blob.source:
@@ -808,73 +2475,86 @@ class _MultimodalImageBlobParser(BaseBlobParser):
 
         width, height = _try_get_image_size(raw, mimetype)
         if width is not None and height is not None and min(width, height) < 14:
-            content = f"[图片尺寸过小（{width}x{height}），已跳过多模态解析]"
-            yield Document(
-                page_content=content,
-                metadata={**blob.metadata, **{"source": blob.source}},
-            )
-            return
+            return f"[图片尺寸过小（{width}x{height}），已跳过多模态解析]", None
 
-        img_base64 = base64.b64encode(raw).decode("utf-8")
+        return None, (mimetype, raw)
 
-        # 如果已经确认模型被限流/暂停，后续图片直接跳过（不再发请求）
-        if self._rate_limited:
-            if not self._rate_limit_notice_emitted:
-                self._rate_limit_notice_emitted = True
-                yield Document(
-                    page_content=(
-                        "[图片多模态解析已暂停：doubao 模型触发 429（Safe Experience Mode / SetLimitExceeded）。"
-                        "请在火山引擎模型控制台调整/关闭 Safe Experience Mode 或提升额度后重试。]"
-                    ),
-                    metadata={**blob.metadata, **{"source": blob.source}},
-                )
-            else:
-                # 返回空内容，避免把“重复提示”写进分片/上下文导致膨胀
-                yield Document(
-                    page_content="",
-                    metadata={**blob.metadata, **{"source": blob.source}},
-                )
-            return
+    def _rate_limited_content(self) -> str:
+        """熔断期间的占位输出：只提示一次，后续返回空内容避免分片膨胀。"""
+        with self._notice_lock:
+            if self._rate_limit_notice_emitted:
+                return ""
+            self._rate_limit_notice_emitted = True
+        return (
+            "[图片多模态解析已暂停：doubao 模型触发 429（Safe Experience Mode / SetLimitExceeded）。"
+            "请在火山引擎模型控制台调整/关闭 Safe Experience Mode 或提升额度后重试。]"
+        )
 
-        try:
-            msg = self._model.invoke(
-                [
-                    HumanMessage(
-                        content=[
-                            {"type": "text", "text": self._prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{mimetype};base64,{img_base64}"
-                                },
-                            },
-                        ]
-                    )
+    def _caption(self, mimetype: str, raw: bytes) -> tuple[str, bool]:
+        """调用多模态模型生成图片文本，返回 (文本, 是否成功)；异常会被转成占位文本，不向外抛。"""
+        img_base64 = base64.b64encode(raw).decode("utf-8")
+        messages = [
+            HumanMessage(
+                content=[
+                    {"type": "text", "text": self._prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mimetype};base64,{img_base64}"
+                        },
+                    },
                 ]
             )
-            content = msg.content if isinstance(msg.content, str) else str(msg.content)
+        ]
+        try:
+            msg = self._limiter.call(lambda: self._model.invoke(messages))
+        except _CircuitOpenError:
+            # 熔断中：不发请求，直接跳过（冷却期过后限流器会自动放行探测请求）
+            return self._rate_limited_content(), False
         except Exception as exc:
             err = str(exc)
-            # 识别“账号推理额度被暂停/限流”的典型报错，后续直接熔断，避免每张图片都打一遍 429。
-            if any(
-                k in err
-                for k in (
-                    "SetLimitExceeded",
-                    "Safe Experience Mode",
-                    "TooManyRequests",
-                    "RateLimitError",
-                    "429",
-                )
-            ):
-                self._rate_limited = True
+            if _is_rate_limit_error(exc) and self._limiter.state != "closed":
+                return self._rate_limited_content(), False
             if len(err) > 300:
                 err = err[:300] + "…"
-            content = f"[图片解析失败（已跳过该图片）：{err}]"
+            return f"[图片解析失败（已跳过该图片）：{err}]", False
+
+        with self._notice_lock:
+            self._rate_limit_notice_emitted = False
+        return (msg.content if isinstance(msg.content, str) else str(msg.content)), True
+
+    def _parse_one(self, blob: Blob) -> Document:
+        metadata = {**blob.metadata, **{"source": blob.source}}
+        content, request = self._prepare(blob)
+        if request is not None:
+            mimetype, raw = request
+            key = None
+            if self._cache is not None:
+                key = _ImageCaptionCache.make_key(raw, prompt=self._prompt, model_id=self._model_id)
+                cached = self._cache.get(key)
+                if cached is not None:
+                    # 命中缓存：完全跳过模型调用
+                    return Document(page_content=cached, metadata={**metadata, "caption_cache": "hit"})
+            content, ok = self._caption(mimetype, raw)
+            if key is not None:
+                metadata["caption_cache"] = "miss"
+                # 只缓存成功的结果；失败/限流的占位文本下次还要重试
+                if ok and content.strip():
+                    self._cache.put(key, content)
+        return Document(page_content=content or "", metadata=metadata)
 
-        yield Document(
-            page_content=content,
-            metadata={**blob.metadata, **{"source": blob.source}},
-        )
+    def lazy_parse(self, blob: Blob):
+        yield self._parse_one(blob)
+
+    def parse_many(self, blobs: list[Blob]) -> list[Document]:
+        """并发解析多张图片：最多 max_concurrency 个请求同时在途，结果按输入顺序返回。"""
+        if self._max_concurrency <= 1 or len(blobs) <= 1:
+            return [self._parse_one(blob) for blob in blobs]
+        with ThreadPoolExecutor(
+            max_workers=min(self._max_concurrency, len(blobs)),
+            thread_name_prefix="pdf_image_caption",
+        ) as executor:
+            return list(executor.map(self._parse_one, blobs))
 
 
 _pdf_images_parser: BaseBlobParser | None = None
@@ -891,25 +2571,65 @@ def _get_pdf_images_parser() -> BaseBlobParser | None:
         return None
 
     try:
-        _pdf_images_parser = _MultimodalImageBlobParser(model=get_doubao_seed_model())
+        cache = None
+        if _PDF_IMAGE_CACHE:
+            cache = _ImageCaptionCache(Path(_PDF_IMAGE_CACHE_DIR), max_bytes=_PDF_IMAGE_CACHE_MAX_BYTES)
+        _pdf_images_parser = _MultimodalImageBlobParser(
+            model=get_doubao_seed_model(),
+            max_concurrency=_PDF_IMAGE_CONCURRENCY,
+            cache=cache,
+        )
         return _pdf_images_parser
     except Exception as exc:
         _pdf_images_parser_init_error = exc
         return None
 
 
-def _decode_base64(data: str) -> bytes:
-    """把 base64 字符串解码为 bytes（兼容 data URL）。"""
-    raw = data.strip()
-    if raw.startswith("data:") and "," in raw:
-        raw = raw.split(",", 1)[1]
-    raw = re.sub(r"\s+", "", raw)
+_BASE64_LEADING_WS_RE = re.compile(r"\s*")
+_BASE64_WS_RE = re.compile(r"\s+")
 
-    missing_padding = len(raw) % 4
-    if missing_padding:
-        raw += "=" * (4 - missing_padding)
+# 流式解码窗口（字符数，4 的整数倍）：峰值内存只与窗口大小有关，与 PDF 大小无关
+_BASE64_DECODE_WINDOW: int = 1 << 20
 
-    return base64.b64decode(raw)
+
+def _decode_base64_to_file(data: str, dest: Path) -> tuple[str, int]:
+    """把 base64 字符串（兼容 data URL）按固定窗口流式解码写入 dest。
+
+    返回 (sha256 hex, 解码后的字节数)。不会对整串做 re.sub/补齐/一次性解码，
+    避免大 PDF 在内存里同时存在多份完整拷贝。
+    """
+    start = _BASE64_LEADING_WS_RE.match(data).end()
+    if data.startswith("data:", start):
+        comma = data.find(",", start)
+        if comma != -1:
+            start = comma + 1
+
+    hasher = hashlib.sha256()
+    size = 0
+    carry = ""
+    with open(dest, "wb") as fp:
+        for pos in range(start, len(data), _BASE64_DECODE_WINDOW):
+            piece = data[pos : pos + _BASE64_DECODE_WINDOW]
+            if _BASE64_WS_RE.search(piece):
+                piece = _BASE64_WS_RE.sub("", piece)
+            piece = carry + piece
+            usable = len(piece) - len(piece) % 4
+            carry = piece[usable:]
+            if not usable:
+                continue
+            chunk = base64.b64decode(piece[:usable])
+            hasher.update(chunk)
+            fp.write(chunk)
+            size += len(chunk)
+
+        carry = carry.rstrip("=")
+        if carry:
+            chunk = base64.b64decode(carry + "=" * (-len(carry) % 4))
+            hasher.update(chunk)
+            fp.write(chunk)
+            size += len(chunk)
+
+    return hasher.hexdigest(), size
 
 
 def _safe_pdf_filename(filename: str | None) -> str:
@@ -920,16 +2640,230 @@ def _safe_pdf_filename(filename: str | None) -> str:
     return name if name.lower().endswith(".pdf") else f"{name}.pdf"
 
 
+def _pdf_doc_metadata(pdf_doc: Any, pdf_path: Path, filename: str) -> dict[str, Any]:
+    """构造每页共享的 metadata（字段与 langchain_pymupdf4llm 产出的基本一致）。"""
+    meta: dict[str, Any] = {}
+    for key, value in (pdf_doc.metadata or {}).items():
+        if isinstance(value, (str, int, float, bool)) and value != "":
+            meta[key] = value
+    meta.update(
+        {
+            "filename": _safe_pdf_filename(filename),
+            "source": str(pdf_path),
+            "file_path": str(pdf_path),
+            "total_pages": pdf_doc.page_count,
+        }
+    )
+    return meta
+
+
+def _identify_pdf_headers(pdf_doc: Any) -> Any:
+    """整份文档只统计一次标题字号；不传的话 pymupdf4llm 每转一页都会全文档重新扫描一遍。"""
+    identify = getattr(pymupdf4llm, "IdentifyHeaders", None)
+    if identify is None:
+        return None
+    try:
+        return identify(pdf_doc)
+    except Exception:
+        return None
+
+
+def _pdf_headers_state(hdr_info: Any) -> dict[str, Any] | None:
+    """把标题识别结果拆成可 pickle 的字段（header_id 字号映射等），交给工作进程复用，不必各自再扫全文档。"""
+    if hdr_info is None:
+        return None
+    state = {
+        key: value
+        for key, value in vars(hdr_info).items()
+        if isinstance(value, (dict, list, tuple, str, int, float, bool)) or value is None
+    }
+    return state if "header_id" in state else None
+
+
+def _restore_pdf_headers(state: dict[str, Any] | None) -> Any:
+    """工作进程里按父进程算好的字段还原 IdentifyHeaders（跳过 __init__ 里的全文档扫描）。"""
+    identify = getattr(pymupdf4llm, "IdentifyHeaders", None)
+    if state is None or identify is None:
+        return None
+    hdr_info = identify.__new__(identify)
+    hdr_info.__dict__.update(state)
+    return hdr_info
+
+
+def _convert_pdf_page(pdf_doc: Any, page_no: int, *, hdr_info: Any, embed_images: bool) -> str:
+    """把单页转成 Markdown；embed_images=True 时图片以 data URL 形式内嵌在 Markdown 里。"""
+    kwargs: dict[str, Any] = {"pages": [page_no], "embed_images": embed_images}
+    if hdr_info is not None:
+        kwargs["hdr_info"] = hdr_info
+    with _PYMUPDF_LOCK:
+        return pymupdf4llm.to_markdown(pdf_doc, **kwargs)
+
+
+def _convert_pdf_page_range(
+    pdf_path: str,
+    start: int,
+    end: int,
+    embed_until: int,
+    headers_state: dict[str, Any] | None = None,
+) -> list[tuple[int, str, bool]]:
+    """工作进程入口：自行打开 PDF，转换 [start, end) 页；page_no < embed_until 的页内嵌图片。
+
+    headers_state 是父进程统计好的标题字号（_pdf_headers_state），各分段共用，不再每段全文档扫描一次。
+    """
+    results: list[tuple[int, str, bool]] = []
+    with _PYMUPDF_LOCK:
+        pdf_doc = pymupdf.open(pdf_path)
+    try:
+        if headers_state is not None:
+            hdr_info = _restore_pdf_headers(headers_state)
+        else:
+            with _PYMUPDF_LOCK:
+                hdr_info = _identify_pdf_headers(pdf_doc)
+        for page_no in range(start, end):
+            embed = page_no < embed_until
+            results.append((page_no, _convert_pdf_page(pdf_doc, page_no, hdr_info=hdr_info, embed_images=embed), embed))
+    finally:
+        with _PYMUPDF_LOCK:
+            pdf_doc.close()
+    return results
+
+
+_pdf_extract_pool: ProcessPoolExecutor | None = None
+_pdf_extract_pool_lock = threading.Lock()
+
+
+def _get_pdf_extract_pool() -> ProcessPoolExecutor | None:
+    """懒加载进程池（进程启动较慢，整个服务进程内复用同一个池）。"""
+    global _pdf_extract_pool
+
+    if _PDF_EXTRACT_WORKERS <= 1:
+        return None
+    with _pdf_extract_pool_lock:
+        if _pdf_extract_pool is None:
+            # 用 spawn 而不是 Linux 默认的 fork：服务进程里有多个线程在 _PYMUPDF_LOCK 下用 pymupdf，
+            # fork 出来的子进程会继承一把“已被别的线程持有”的锁，之后永远卡在 with _PYMUPDF_LOCK 上。
+            # 工作进程只需要 PDF 路径和页段，重新导入模块即可
+            _pdf_extract_pool = ProcessPoolExecutor(
+                max_workers=_PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pdf_extract_pool
+
+
+def _reset_pdf_extract_pool() -> None:
+    """进程池损坏（工作进程崩溃）时丢弃，下次使用时重建。"""
+    global _pdf_extract_pool
+
+    with _pdf_extract_pool_lock:
+        pool, _pdf_extract_pool = _pdf_extract_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _iter_pdf_pages_markdown(
+    pdf_doc: Any,
+    pdf_path: Path,
+    *,
+    page_count: int,
+    should_embed: Callable[[int], bool],
+    embed_until: int,
+):
+    """按页序产出 (page_no, page_md, embedded)。
+
+    - 配置了 PDF_EXTRACT_WORKERS>1 且页数足够多时：按连续页段分发到进程池，每个工作进程自行打开
+      落盘的 PDF，结果按页序合并；是否内嵌图片只能预先按 embed_until 决定。
+    - 否则在当前线程逐页转换，每页转换前调用 should_embed(page_no) 动态决定是否内嵌图片。
+    """
+    shard = max(1, _PDF_EXTRACT_SHARD_PAGES)
+    pool = _get_pdf_extract_pool() if page_count > shard else None
+    next_page = 0
+
+    # 标题字号整份文档只统计一次：进程池各分段和本线程的顺序抽取共用
+    hdr_info = None
+    if page_count > 0:
+        with _PYMUPDF_LOCK:
+            hdr_info = _identify_pdf_headers(pdf_doc)
+
+    if pool is not None:
+        futures = []
+        headers_state = _pdf_headers_state(hdr_info)
+        try:
+            for start in range(0, page_count, shard):
+                end = min(page_count, start + shard)
+                futures.append(
+                    pool.submit(_convert_pdf_page_range, str(pdf_path), start, end, embed_until, headers_state)
+                )
+            for future in futures:
+                for page_no, page_md, embedded in future.result():
+                    yield page_no, page_md, embedded
+                    next_page = page_no + 1
+        except BrokenProcessPool:
+            # 工作进程异常退出：剩余页面退回当前线程顺序抽取，不影响本次结果
+            _reset_pdf_extract_pool()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    for page_no in range(next_page, page_count):
+        embed = should_embed(page_no)
+        yield page_no, _convert_pdf_page(pdf_doc, page_no, hdr_info=hdr_info, embed_images=embed), embed
+
+
+def _strip_embedded_images(page_md: str) -> str:
+    """去掉内嵌图片，得到与“纯文本抽取”一致的页面 Markdown。"""
+    if "data:image/" not in page_md:
+        return page_md
+    return _MD_EMBEDDED_IMAGE_RE.sub("", page_md)
+
+
+def _embedded_image_blobs(page_md: str, metadata: dict[str, Any]) -> list[Blob | None]:
+    """按出现顺序取出页面里的内嵌图片（base64 解码失败的位置为 None）。"""
+    blobs: list[Blob | None] = []
+    for i, match in enumerate(_MD_EMBEDDED_IMAGE_RE.finditer(page_md), start=1):
+        try:
+            raw = base64.b64decode(match.group(2))
+        except Exception:
+            blobs.append(None)
+            continue
+        blobs.append(
+            Blob.from_data(
+                raw,
+                mime_type=match.group(1),
+                path=f"page{metadata.get('page')}_img{i}",
+                metadata=metadata,
+            )
+        )
+    return blobs
+
+
+def _fill_embedded_images(page_md: str, captions: list[str]) -> str:
+    """把页面里的内嵌图片按顺序替换为解析文本。"""
+    it = iter(captions)
+
+    def _replace(_match: re.Match) -> str:
+        caption = (next(it, "") or "").strip()
+        return f"\n\n{caption}\n\n" if caption else ""
+
+    return _MD_EMBEDDED_IMAGE_RE.sub(_replace, page_md)
+
+
 def _extract_pdf_markdown(
-    pdf_bytes: bytes,
+    pdf_base64: str,
     filename: str,
     *,
     enable_images: bool,
     doc_id: str | None = None,
     persisted_pdf_path: Path | None = None,
+    overwrite: bool = False,
+    on_page: Callable[[int, int], None] | None = None,
 ) -> str:
-    """PDF bytes -> Markdown（必要时包含图片多模态文本）。"""
-    images_parser = _get_pdf_images_parser()
+    """PDF（base64 或已落盘文件） -> Markdown（必要时包含图片多模态文本）。
+
+    单遍抽取：每页只打开/转换一次，同一份页面 Markdown 同时产出 kind="text" 与 kind="images"
+    两类分片（旧实现先按文本解析一遍、再带图片重新解析一遍，CPU 与峰值内存都翻倍）。
+    """
+    want_images = enable_images or _PDF_FORCE_EXTRACT_IMAGES
+    images_parser = _get_pdf_images_parser() if want_images else None
 
     # 说明：
     # - 如果调用方已经把 PDF 落盘（persisted_pdf_path），这里就复用该路径；
@@ -939,7 +2873,7 @@ def _extract_pdf_markdown(
         temp_dir_ctx = TemporaryDirectory(prefix="lc_pdf_", ignore_cleanup_errors=True)
         tmp_dir = temp_dir_ctx.__enter__()
         pdf_path = Path(tmp_dir) / _safe_pdf_filename(filename)
-        pdf_path.write_bytes(pdf_bytes)
+        _decode_base64_to_file(pdf_base64, pdf_path)
     else:
         pdf_path = persisted_pdf_path
 
@@ -950,16 +2884,36 @@ def _extract_pdf_markdown(
             doc_id,
             filename=filename,
             pdf_path=pdf_path,
+            overwrite=overwrite,
         )
 
-    try:
-        # 用文件路径打开：更稳定，也避免某些库在 stream 模式下 doc.name=None 的坑
-        blob = Blob.from_path(
-            str(pdf_path),
-            mime_type="application/pdf",
-            metadata={"filename": _safe_pdf_filename(filename)},
-        )
+    def write_chunks(kind: str, page_md: str, metadata: dict[str, Any]) -> None:
+        if chunks_fp is None:
+            return
+        parts = _split_text(page_md, _PDF_CHUNK_MAX_CHARS)
+        for part_index, part_text in enumerate(parts):
+            chunk = {
+                "doc_id": doc_id,
+                "kind": kind,
+                "page": metadata.get("page"),
+                "part_index": part_index,
+                "part_total": len(parts),
+                "content": part_text,
+                "metadata": metadata,
+            }
+            chunks_fp.write_chunk(chunk)
+        # 每页落盘一次：后台抽取时，读者（pdf_analyze_doc / 节选）能立刻看到已完成的页
+        chunks_fp.flush()
+
+    # 图片解析链：去重（可选） -> 预算 -> 缓存/多模态模型
+    budgeted_parser: _BudgetedImageBlobParser | None = None
+    dedup_parser: _DedupImageBlobParser | None = None
+    image_chain: BaseBlobParser | None = None
+    if images_parser is not None:
+        budgeted_parser = _BudgetedImageBlobParser(images_parser, max_images=_PDF_IMAGE_MAX_IMAGES)
+        image_chain = budgeted_parser
 
+    try:
         # 注意：这里把“落盘分片”和“注入上下文”分开控制：
         # - 分片落盘：尽量全量（默认不限制），避免信息丢失
         # - 注入上下文：严格预算（默认 20 页 / 30000 字符），避免一次请求把模型撑爆
@@ -968,157 +2922,380 @@ def _extract_pdf_markdown(
         context_text_pages = 0
         extracted_text_len = 0
         extracted_text_pages = 0
-        total_text_pages: int | None = None
-
-        for doc in PyMuPDF4LLMParser(mode="page").lazy_parse(blob):
-            if total_text_pages is None and isinstance(doc.metadata, dict):
-                total_text_pages = doc.metadata.get("total_pages")
-
-            # 按页分片写入（用于后续检索/RAG）
-            if chunks_fp is not None:
-                parts = _split_text(doc.page_content, _PDF_CHUNK_MAX_CHARS)
-                for part_index, part_text in enumerate(parts):
-                    chunk = {
-                        "doc_id": doc_id,
-                        "kind": "text",
-                        "page": doc.metadata.get("page")
-                        if isinstance(doc.metadata, dict)
-                        else None,
-                        "part_index": part_index,
-                        "part_total": len(parts),
-                        "content": part_text,
-                        "metadata": doc.metadata,
-                    }
-                    chunks_fp.write(json.dumps(chunk, ensure_ascii=False) + "\n")
-
-            # 注入上下文的预算：只把“前面的一部分”拼到 text_md 里
-            if _PDF_CONTEXT_MAX_PAGES <= 0 or context_text_pages < _PDF_CONTEXT_MAX_PAGES:
-                if _PDF_CONTEXT_MAX_CHARS <= 0 or context_text_len < _PDF_CONTEXT_MAX_CHARS:
-                    text_parts.append(doc.page_content)
-                    context_text_pages += 1
-                    context_text_len += len(doc.page_content)
-
-            # 落盘抽取的预算：默认不限制（<=0 表示不限制）
-            extracted_text_pages += 1
-            extracted_text_len += len(doc.page_content)
-            if _PDF_EXTRACT_MAX_PAGES > 0 and extracted_text_pages >= _PDF_EXTRACT_MAX_PAGES:
-                break
-            if _PDF_EXTRACT_MAX_CHARS > 0 and extracted_text_len >= _PDF_EXTRACT_MAX_CHARS:
-                break
+
+        image_page_contents: list[str] = []
+        image_pages = 0
+        image_start: float | None = None
+        timed_out = False
+        image_error: Exception | None = None
+
+        # 待解析图片的页面窗口：攒够一批图片后并发解析，再按页序写回 kind="images" 分片
+        pending_image_pages: list[tuple[str, dict[str, Any]]] = []
+        pending_images = 0
+
+        def flush_image_pages() -> None:
+            nonlocal pending_images, image_start, image_error, timed_out
+            if not pending_image_pages:
+                return
+            window = list(pending_image_pages)
+            pending_image_pages.clear()
+            pending_images = 0
+            if image_error is not None:
+                return
+            if image_start is None:
+                image_start = time.monotonic()
+
+            per_page = [_embedded_image_blobs(page_md, metadata) for page_md, metadata in window]
+            blobs = [blob for page_blobs in per_page for blob in page_blobs if blob is not None]
+            try:
+                docs = _parse_image_blobs(image_chain, blobs) if blobs else []
+            except Exception as exc:
+                image_error = exc
+                return
+
+            captions = iter([d.page_content for d in docs])
+            for (page_md, metadata), page_blobs in zip(window, per_page):
+                if not page_blobs:
+                    continue
+                page_captions = [next(captions, "") if blob is not None else "" for blob in page_blobs]
+                # 只有真正含图片的页才写 kind="images" 分片，避免把纯文本页重复写一遍
+                images_md_page = _fill_embedded_images(page_md, page_captions)
+                image_page_contents.append(images_md_page)
+                write_chunks("images", images_md_page, metadata)
+
+            # 约定：<= 0 表示“不限制”
+            if _PDF_IMAGE_MAX_SECONDS > 0 and time.monotonic() - image_start >= _PDF_IMAGE_MAX_SECONDS:
+                timed_out = True
+
+        with _PYMUPDF_LOCK:
+            pdf_doc = pymupdf.open(str(pdf_path))
+        try:
+            total_pages: int = pdf_doc.page_count
+            with _PYMUPDF_LOCK:
+                base_meta = _pdf_doc_metadata(pdf_doc, pdf_path, filename)
+
+            page_count = total_pages
+            if _PDF_EXTRACT_MAX_PAGES > 0:
+                page_count = min(page_count, _PDF_EXTRACT_MAX_PAGES)
+
+            if budgeted_parser is not None and _PDF_IMAGE_DEDUP:
+                dedup_parser = _DedupImageBlobParser(
+                    budgeted_parser,
+                    boilerplate_hashes=_scan_boilerplate_images(pdf_doc, page_count),
+                )
+                image_chain = dedup_parser
+
+            def should_embed(_page_no: int) -> bool:
+                # 图片预算（页数/耗时）用完后，后续页面不再内嵌图片，只做文本转换
+                return (
+                    budgeted_parser is not None
+                    and image_error is None
+                    and not timed_out
+                    and (_PDF_IMAGE_MAX_PAGES <= 0 or image_pages < _PDF_IMAGE_MAX_PAGES)
+                )
+
+            embed_until = 0
+            if budgeted_parser is not None:
+                embed_until = page_count if _PDF_IMAGE_MAX_PAGES <= 0 else min(page_count, _PDF_IMAGE_MAX_PAGES)
+
+            for page_no, page_md, embedded in _iter_pdf_pages_markdown(
+                pdf_doc,
+                pdf_path,
+                page_count=page_count,
+                should_embed=should_embed,
+                embed_until=embed_until,
+            ):
+                # 并行模式下图片是否内嵌是预先决定的：预算已用完的页只保留文本
+                embed = embedded and should_embed(page_no)
+                metadata = {**base_meta, "page": page_no}
+
+                text_md_page = _strip_embedded_images(page_md) if embedded else page_md
+                write_chunks("text", text_md_page, metadata)
+
+                # 注入上下文的预算：只把“前面的一部分”拼到 text_md 里
+                if _PDF_CONTEXT_MAX_PAGES <= 0 or context_text_pages < _PDF_CONTEXT_MAX_PAGES:
+                    if _PDF_CONTEXT_MAX_CHARS <= 0 or context_text_len < _PDF_CONTEXT_MAX_CHARS:
+                        text_parts.append(text_md_page)
+                        context_text_pages += 1
+                        context_text_len += len(text_md_page)
+
+                if embed:
+                    image_pages += 1
+                    pending_image_pages.append((page_md, metadata))
+                    pending_images += page_md.count("data:image/")
+                    if pending_images >= _PDF_IMAGE_CONCURRENCY:
+                        flush_image_pages()
+
+                # 落盘抽取的预算：默认不限制（<=0 表示不限制）
+                extracted_text_pages += 1
+                extracted_text_len += len(text_md_page)
+                if on_page is not None:
+                    on_page(extracted_text_pages, page_count)
+                if _PDF_EXTRACT_MAX_PAGES > 0 and extracted_text_pages >= _PDF_EXTRACT_MAX_PAGES:
+                    break
+                if _PDF_EXTRACT_MAX_CHARS > 0 and extracted_text_len >= _PDF_EXTRACT_MAX_CHARS:
+                    break
+            flush_image_pages()
+        finally:
+            with _PYMUPDF_LOCK:
+                pdf_doc.close()
+        if chunks_fp is not None:
+            _catalog_touch(doc_id, status="extracted", pages=total_pages)
 
         text_md = "\n\n".join(text_parts).strip()
-        if total_text_pages and extracted_text_pages < total_text_pages:
+        if total_pages and extracted_text_pages < total_pages:
             text_md += (
-                f"\n\n[提示：文本分片仅落盘解析前 {extracted_text_pages}/{total_text_pages} 页"
+                f"\n\n[提示：文本分片仅落盘解析前 {extracted_text_pages}/{total_pages} 页"
                 f"（PDF_EXTRACT_MAX_PAGES={_PDF_EXTRACT_MAX_PAGES}，PDF_EXTRACT_MAX_CHARS={_PDF_EXTRACT_MAX_CHARS}）]"
             )
-        if total_text_pages and context_text_pages < total_text_pages:
+        if total_pages and context_text_pages < total_pages:
             text_md += (
-                f"\n\n[提示：注入到对话上下文的正文为节选：{context_text_pages}/{total_text_pages} 页"
+                f"\n\n[提示：注入到对话上下文的正文为节选：{context_text_pages}/{total_pages} 页"
                 f"（PDF_CONTEXT_MAX_PAGES={_PDF_CONTEXT_MAX_PAGES}，PDF_CONTEXT_MAX_CHARS={_PDF_CONTEXT_MAX_CHARS}）]"
             )
 
-        if not enable_images and not _PDF_FORCE_EXTRACT_IMAGES:
+        if not want_images:
             final_text, _ = _truncate_text(text_md, _PDF_CONTEXT_MAX_CHARS)
             return (
                 final_text
                 + "\n\n[提示：如需解析PDF中的图片/流程图/图表，请在问题中说明“解析图片”，或设置环境变量 PDF_FORCE_EXTRACT_IMAGES=1]"
             )
 
-        if images_parser is not None:
-            try:
-                budgeted_parser = _BudgetedImageBlobParser(
-                    images_parser,
-                    max_images=_PDF_IMAGE_MAX_IMAGES,
+        if budgeted_parser is None:
+            final_text, _ = _truncate_text(text_md, _PDF_CONTEXT_MAX_CHARS)
+            return final_text
+
+        if image_error is not None and not image_page_contents:
+            final_text, _ = _truncate_text(text_md, _PDF_CONTEXT_MAX_CHARS)
+            return f"{final_text}\n\n[图片解析失败，已降级为仅文本提取：{image_error}]"
+
+        combined = text_md
+        images_md = "\n\n".join(image_page_contents).strip()
+        if images_md:
+            notes: list[str] = []
+            if total_pages and image_pages < total_pages:
+                notes.append(
+                    f"仅处理前 {image_pages}/{total_pages} 页图片（PDF_IMAGE_MAX_PAGES={_PDF_IMAGE_MAX_PAGES}）"
                 )
-                loader = PyMuPDF4LLMLoader(
-                    str(pdf_path),
-                    mode="page",
-                    extract_images=True,
-                    images_parser=budgeted_parser,
+            if budgeted_parser.skipped_images:
+                notes.append(
+                    f"图片超过上限，已跳过 {budgeted_parser.skipped_images} 张（PDF_IMAGE_MAX_IMAGES={_PDF_IMAGE_MAX_IMAGES}）"
                 )
+            if timed_out:
+                notes.append(
+                    f"达到耗时上限 {int(_PDF_IMAGE_MAX_SECONDS)}s（PDF_IMAGE_MAX_SECONDS={_PDF_IMAGE_MAX_SECONDS}）"
+                )
+            if dedup_parser is not None and (dedup_parser.duplicate_images or dedup_parser.boilerplate_images):
+                notes.append(
+                    f"重复图片 {dedup_parser.duplicate_images} 张已引用首次解析结果，"
+                    f"页眉/水印等样板图片 {dedup_parser.boilerplate_images} 张已跳过"
+                )
+            if image_error is not None:
+                notes.append(f"图片解析中途失败，后续页面已降级为仅文本提取：{image_error}")
 
-                start = time.monotonic()
-                page_contents: list[str] = []
-                processed_pages = 0
-                total_pages: int | None = None
-                timed_out = False
-
-                for doc in loader.lazy_load():
-                    if total_pages is None and isinstance(doc.metadata, dict):
-                        total_pages = doc.metadata.get("total_pages")
-                    page_contents.append(doc.page_content)
-                    processed_pages += 1
-
-                    if chunks_fp is not None:
-                        parts = _split_text(doc.page_content, _PDF_CHUNK_MAX_CHARS)
-                        for part_index, part_text in enumerate(parts):
-                            chunk = {
-                                "doc_id": doc_id,
-                                "kind": "images",
-                                "page": doc.metadata.get("page")
-                                if isinstance(doc.metadata, dict)
-                                else None,
-                                "part_index": part_index,
-                                "part_total": len(parts),
-                                "content": part_text,
-                                "metadata": doc.metadata,
-                            }
-                            chunks_fp.write(json.dumps(chunk, ensure_ascii=False) + "\n")
-
-                    # 约定：<= 0 表示“不限制”
-                    if _PDF_IMAGE_MAX_PAGES > 0 and processed_pages >= _PDF_IMAGE_MAX_PAGES:
-                        break
-                    if _PDF_IMAGE_MAX_SECONDS > 0 and time.monotonic() - start >= _PDF_IMAGE_MAX_SECONDS:
-                        timed_out = True
-                        break
-
-                images_md = "\n\n".join(page_contents).strip()
-                combined = text_md
-
-                has_images = "![" in images_md
-                if has_images:
-                    notes: list[str] = []
-                    if total_pages and processed_pages < total_pages:
-                        notes.append(
-                            f"仅处理前 {processed_pages}/{total_pages} 页图片（PDF_IMAGE_MAX_PAGES={_PDF_IMAGE_MAX_PAGES}）"
-                        )
-                    if budgeted_parser.skipped_images:
-                        notes.append(
-                            f"图片超过上限，已跳过 {budgeted_parser.skipped_images} 张（PDF_IMAGE_MAX_IMAGES={_PDF_IMAGE_MAX_IMAGES}）"
-                        )
-                    if timed_out:
-                        notes.append(
-                            f"达到耗时上限 {int(_PDF_IMAGE_MAX_SECONDS)}s（PDF_IMAGE_MAX_SECONDS={_PDF_IMAGE_MAX_SECONDS}）"
-                        )
-
-                    combined = (
-                        f"{text_md}\n\n---\n\n[图片多模态解析（节选）]\n{images_md}"
-                    )
-                    if notes:
-                        combined += "\n\n[" + "；".join(notes) + "]"
-
-                final_text, _ = _truncate_text(combined, _PDF_CONTEXT_MAX_CHARS)
-                return final_text
-            except Exception as exc:
-                final_text, _ = _truncate_text(text_md, _PDF_CONTEXT_MAX_CHARS)
-                return f"{final_text}\n\n[图片解析失败，已降级为仅文本提取：{exc}]"
-            finally:
-                gc.collect()
+            combined = f"{text_md}\n\n---\n\n[图片多模态解析（节选）]\n{images_md}"
+            if notes:
+                combined += "\n\n[" + "；".join(notes) + "]"
 
-        final_text, _ = _truncate_text(text_md, _PDF_CONTEXT_MAX_CHARS)
+        final_text, _ = _truncate_text(combined, _PDF_CONTEXT_MAX_CHARS)
         return final_text
     finally:
         if chunks_fp is not None:
             chunks_fp.close()
+            # 抽取结束顺手建好检索索引（pdf_search 首次查询不用再全量扫分片）
+            try:
+                _get_chunk_search_index(doc_id)
+                _update_vector_index(doc_id)
+            except Exception:
+                pass
+            if budgeted_parser is not None:
+                meta_fields: dict[str, Any] = {
+                    "image_caption_cache": {
+                        "hits": budgeted_parser.cache_hits,
+                        "misses": budgeted_parser.cache_misses,
+                    }
+                }
+                if dedup_parser is not None:
+                    meta_fields["image_dedup"] = {
+                        "duplicates": dedup_parser.duplicate_images,
+                        "boilerplate": dedup_parser.boilerplate_images,
+                    }
+                _update_extract_meta(doc_id, **meta_fields)
         if temp_dir_ctx is not None:
             temp_dir_ctx.__exit__(None, None, None)
+        gc.collect()
+
+
+# ==========================
+# 后台抽取任务
+# ==========================
+# 状态同时记在进程内（Future，用于判断任务是否还活着）和磁盘上
+# （storage/pdf_extracted/<doc_id>/ingest_state.json，便于读者/排障查看进度）。
+
+_pdf_ingest_executor: ThreadPoolExecutor | None = None
+_pdf_ingest_jobs: dict[str, Future] = {}
+_pdf_ingest_lock = threading.Lock()
+
+
+def _ingest_state_path(doc_id: str) -> Path:
+    return Path(_PDF_EXTRACT_DIR) / doc_id / "ingest_state.json"
+
+
+def _read_ingest_state(doc_id: str) -> dict[str, Any]:
+    path = _ingest_state_path(doc_id)
+    if not path.exists():
+        return {}
+    try:
+        obj = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+    return obj if isinstance(obj, dict) else {}
+
+
+def _write_ingest_state(doc_id: str, **fields: Any) -> None:
+    path = _ingest_state_path(doc_id)
+    state = _read_ingest_state(doc_id)
+    state.update(fields)
+    state["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{uuid4().hex}.tmp")
+        tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def _pdf_ingest_running(doc_id: str) -> bool:
+    """当前进程里该文档是否还有未结束的后台抽取任务。"""
+    with _pdf_ingest_lock:
+        future = _pdf_ingest_jobs.get(doc_id)
+        return future is not None and not future.done()
+
+
+def _run_pdf_ingest(doc_id: str, filename: str, pdf_path: Path, enable_images: bool, overwrite: bool) -> None:
+    """后台线程入口：完整抽取一份 PDF，并实时更新 ingest_state.json。"""
+    _write_ingest_state(doc_id, status="running", pages_done=0, total_pages=None, error=None)
+
+    def on_page(pages_done: int, total_pages: int) -> None:
+        _write_ingest_state(doc_id, pages_done=pages_done, total_pages=total_pages)
+
+    try:
+        _extract_pdf_markdown(
+            "",
+            filename,
+            enable_images=enable_images,
+            doc_id=doc_id,
+            persisted_pdf_path=pdf_path,
+            overwrite=overwrite,
+            on_page=on_page,
+        )
+    except Exception as exc:
+        attempts = int(_read_ingest_state(doc_id).get("failed_attempts") or 0) + 1
+        _write_ingest_state(
+            doc_id,
+            status="failed",
+            error=str(exc)[:500],
+            failed_attempts=attempts,
+            failed_at=time.time(),
+        )
+        _catalog_touch(doc_id, status="failed")
+        raise
+    _write_ingest_state(doc_id, status="done", failed_attempts=0, failed_at=None)
+
+
+def _ingest_retry_blocked(state: dict[str, Any]) -> bool:
+    """上次抽取失败且已达尝试上限 / 仍在退避窗口内：不再自动重抽（避免确定性失败每条消息都重跑）。"""
+    if state.get("status") != "failed":
+        return False
+    try:
+        attempts = int(state.get("failed_attempts") or 0)
+        failed_at = float(state.get("failed_at") or 0.0)
+    except (TypeError, ValueError):
+        return False
+    if attempts <= 0:
+        return False
+    if attempts >= max(1, _PDF_INGEST_MAX_ATTEMPTS):
+        return True
+    backoff = max(0.0, _PDF_INGEST_RETRY_SECONDS) * (2 ** (attempts - 1))
+    return time.time() - failed_at < backoff
+
+
+def _submit_pdf_ingest(doc_id: str, filename: str, pdf_path: Path, *, enable_images: bool, overwrite: bool) -> None:
+    """提交后台抽取任务（同一 doc_id 已在跑则不重复提交）。"""
+    global _pdf_ingest_executor
+
+    with _pdf_ingest_lock:
+        future = _pdf_ingest_jobs.get(doc_id)
+        if future is not None and not future.done():
+            return
+        if _pdf_ingest_executor is None:
+            _pdf_ingest_executor = ThreadPoolExecutor(
+                max_workers=max(1, _PDF_INGEST_WORKERS),
+                thread_name_prefix="pdf_ingest",
+            )
+        # 先落一个 queued 状态，避免读者在任务真正开始前误判为“已完成”
+        _write_ingest_state(doc_id, status="queued", error=None)
+        _pdf_ingest_jobs[doc_id] = _pdf_ingest_executor.submit(
+            _run_pdf_ingest, doc_id, filename, pdf_path, enable_images, overwrite
+        )
+
+
+def _ingest_pdf_in_background(
+    doc_id: str,
+    filename: str,
+    pdf_path: Path,
+    *,
+    enable_images: bool,
+) -> tuple[str, bool]:
+    """异步抽取入口：返回 (注入上下文的文本, 抽取是否已完成)。
+
+    - 已有完整的落盘分片：直接返回节选；
+    - 否则提交/复用后台任务，立刻返回“解析中”占位 + 已完成页面的节选。
+    """
+    if not _pdf_ingest_running(doc_id):
+        state = _read_ingest_state(doc_id)
+        status = state.get("status")
+        if _ingest_retry_blocked(state):
+            attempts = state.get("failed_attempts")
+            final = attempts >= max(1, _PDF_INGEST_MAX_ATTEMPTS)
+            hint = "已达重试上限，不再自动重抽" if final else "稍后会自动重试"
+            return f"[PDF 解析失败（第 {attempts} 次，{hint}）；DOC_ID: {doc_id}。错误：{state.get('error') or '未知'}]", final
+        # 磁盘上是 queued/running/failed 但本进程没有存活任务：上次抽取被中断，分片不完整，需要重抽
+        interrupted = status in {"queued", "running", "failed"}
+        reusable = _PDF_REUSE_EXTRACTED and not _PDF_OVERWRITE_EXTRACTED and _extracted_ready(doc_id)
+        if reusable and not interrupted:
+            md = _build_context_excerpt_from_chunks(doc_id)
+            if not md:
+                md = "[已存在落盘分片，但未能生成节选，请使用 pdf_analyze_doc(DOC_ID, question)]"
+            return md, True
+        _submit_pdf_ingest(
+            doc_id,
+            filename,
+            pdf_path,
+            enable_images=enable_images,
+            overwrite=interrupted or _PDF_OVERWRITE_EXTRACTED,
+        )
+
+    state = _read_ingest_state(doc_id)
+    pages_done = state.get("pages_done") or 0
+    total_pages = state.get("total_pages")
+    progress = f"{pages_done}/{total_pages}" if total_pages else f"{pages_done}"
+    placeholder = (
+        f"[PDF 正在后台解析（已完成 {progress} 页）；DOC_ID: {doc_id}。"
+        f"可以直接调用 pdf_analyze_doc(DOC_ID, question)：工具会边解析边读取已完成的分片。]"
+    )
+    excerpt = _build_context_excerpt_from_chunks(doc_id) if pages_done else ""
+    return (f"{placeholder}\n\n{excerpt}" if excerpt else placeholder), False
+
 
+def _replace_pdf_file_blocks_with_text(content: Any) -> tuple[str | None, bool, bool]:
+    """把 HumanMessage.content 中的 PDF file 块替换成可读文本。
 
-def _replace_pdf_file_blocks_with_text(content: Any) -> tuple[str | None, bool]:
-    """把 HumanMessage.content 中的 PDF file 块替换成可读文本。"""
+    返回 (新文本, 是否替换过, 是否为最终结果)；后台抽取尚未完成时“最终结果”为 False。
+    """
     if not isinstance(content, list):
-        return None, False
+        return None, False, True
 
     user_text_parts: list[str] = []
     for block in content:
@@ -1132,6 +3309,7 @@ def _replace_pdf_file_blocks_with_text(content: Any) -> tuple[str | None, bool]:
 
     text_chunks: list[str] = []
     replaced_any = False
+    complete = True
 
     for block in content:
         if isinstance(block, str):
@@ -1166,17 +3344,24 @@ def _replace_pdf_file_blocks_with_text(content: Any) -> tuple[str | None, bool]:
 
         replaced_any = True
         try:
-            pdf_bytes = _decode_base64(data)
-            doc_id, persisted_pdf_path = _persist_pdf_upload(pdf_bytes, filename)
+            doc_id, persisted_pdf_path = _persist_pdf_upload(data, filename)
 
-            if doc_id is not None and _PDF_REUSE_EXTRACTED and not _PDF_OVERWRITE_EXTRACTED and _extracted_ready(doc_id):
-                # 已经抽取过：直接复用落盘分片，避免重复解析导致“从头再来”
+            if doc_id is not None and persisted_pdf_path is not None and _PDF_ASYNC_INGEST and _PDF_STORE_CHUNKS:
+                md, finished = _ingest_pdf_in_background(
+                    doc_id,
+                    filename,
+                    persisted_pdf_path,
+                    enable_images=enable_images,
+                )
+                complete = complete and finished
+            elif doc_id is not None and _PDF_REUSE_EXTRACTED and not _PDF_OVERWRITE_EXTRACTED and _extracted_ready(doc_id):
+                # 已经抽取过：直接复用落盘分片，避免重复解析导致“从头再来”
                 md = _build_context_excerpt_from_chunks(doc_id)
                 if not md:
                     md = "[已存在落盘分片，但未能生成节选，请使用 pdf_analyze_doc(DOC_ID, question)]"
             else:
                 md = _extract_pdf_markdown(
-                    pdf_bytes,
+                    data,
                     filename,
                     enable_images=enable_images,
                     doc_id=doc_id,
@@ -1200,83 +3385,1239 @@ def _replace_pdf_file_blocks_with_text(content: Any) -> tuple[str | None, bool]:
             text_chunks.append(f"[附件 {filename} 解析失败：{exc}]")
 
     if not replaced_any:
-        return None, False
+        return None, False, True
+
+    return "\n\n".join(text_chunks).strip(), True, complete
 
-    return "\n\n".join(text_chunks).strip(), True
+
+# before_model 每次调用模型都会扫描整段历史；同一条消息里的同一份附件只需处理一次。
+# key = message.id + 附件块摘要，value = 替换后的文本内容（进程内 LRU，条目数上限可调）。
+_PDF_MESSAGE_MEMO_MAX: int = _env_int("PDF_MESSAGE_MEMO_MAX", 256)
+_pdf_message_memo: OrderedDict[str, str] = OrderedDict()
+_pdf_message_memo_lock = threading.Lock()
+
+# 摘要只取 base64 首尾片段 + 长度，不需要整串解码/哈希
+_PDF_BLOCK_DIGEST_SAMPLE_CHARS = 4096
+
+
+def _pdf_blocks_digest(content: Any) -> str | None:
+    """对含 PDF 附件的 content 做轻量摘要；不含 PDF 附件时返回 None（无需处理）。"""
+    if not isinstance(content, list):
+        return None
+
+    hasher = hashlib.sha1()
+    has_pdf = False
+    for block in content:
+        if isinstance(block, str):
+            hasher.update(b"s:" + block.encode("utf-8", errors="ignore"))
+            continue
+        if not isinstance(block, dict):
+            continue
+        block_type = block.get("type")
+        if block_type == "text":
+            text = block.get("text", "")
+            if isinstance(text, str):
+                hasher.update(b"t:" + text.encode("utf-8", errors="ignore"))
+            continue
+        if block_type != "file":
+            continue
+        if (block.get("mime_type") or "").lower() != "application/pdf":
+            continue
+        has_pdf = True
+        data = block.get("data") or ""
+        if not isinstance(data, str):
+            data = ""
+        filename = (block.get("metadata") or {}).get("filename") or ""
+        sample = _PDF_BLOCK_DIGEST_SAMPLE_CHARS
+        hasher.update(f"f:{filename}:{block.get('source_type')}:{len(data)}:".encode("utf-8", errors="ignore"))
+        hasher.update(data[:sample].encode("ascii", errors="ignore"))
+        hasher.update(data[-sample:].encode("ascii", errors="ignore"))
+
+    return hasher.hexdigest() if has_pdf else None
 
 
 def build_pdf_message_updates(messages: list[Any]) -> list[Any]:
-    """扫描 messages，把含 PDF 附件的 HumanMessage 更新为“文本版”。"""
+    """扫描 messages，把含 PDF 附件的 HumanMessage 更新为“文本版”。
+
+    已处理过的（message.id + 附件摘要）直接复用上次的结果，不会在每个 agent step
+    里重复解码/哈希/读取分片。
+    """
     updated_messages: list[Any] = []
 
     for msg in messages:
         content = getattr(msg, "content", None)
-        new_content, replaced = _replace_pdf_file_blocks_with_text(content)
-        if replaced and new_content is not None:
-            if getattr(msg, "id", None) is None:
-                msg.id = str(uuid4())
-            updated_messages.append(msg.model_copy(update={"content": new_content}))
+        digest = _pdf_blocks_digest(content)
+        if digest is None:
+            continue
+
+        if getattr(msg, "id", None) is None:
+            msg.id = str(uuid4())
+        memo_key = f"{msg.id}:{digest}"
+
+        with _pdf_message_memo_lock:
+            new_content = _pdf_message_memo.get(memo_key)
+            if new_content is not None:
+                _pdf_message_memo.move_to_end(memo_key)
+
+        if new_content is None:
+            new_content, replaced, complete = _replace_pdf_file_blocks_with_text(content)
+            if not replaced or new_content is None:
+                continue
+            # 后台抽取中的“占位+部分节选”不进 memo：替换后的消息按 id 覆盖原消息、不再含 PDF 块，
+            # 这里只避免同一原始消息被再次处理（如重放历史）时复用过期的占位文本
+            if complete and _PDF_MESSAGE_MEMO_MAX > 0:
+                with _pdf_message_memo_lock:
+                    _pdf_message_memo[memo_key] = new_content
+                    while len(_pdf_message_memo) > _PDF_MESSAGE_MEMO_MAX:
+                        _pdf_message_memo.popitem(last=False)
+
+        updated_messages.append(msg.model_copy(update={"content": new_content}))
 
     return updated_messages
 
 
 def _read_pdf_chunks_jsonl(doc_id: str) -> list[dict[str, Any]]:
-    """读取落盘的 chunks.jsonl 并返回 chunks 列表（按写入顺序）。"""
+    """读取落盘的分片并返回 chunks 列表（按写入顺序）。"""
     doc_id = _normalize_doc_id(doc_id)
-    chunks_path = Path(_PDF_EXTRACT_DIR) / doc_id / "chunks.jsonl"
-    if not chunks_path.exists():
-        raise FileNotFoundError(f"未找到分片文件：{chunks_path.as_posix()}")
+    if not _chunks_available(doc_id):
+        raise FileNotFoundError(f"未找到分片文件：{_chunks_jsonl_path(doc_id).as_posix()}")
 
     chunks: list[dict[str, Any]] = []
+    for _, line in _iter_doc_chunks(doc_id, dedup=_PDF_DEDUP_CHUNKS):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = json.loads(line)
+        except Exception:
+            continue
+        if isinstance(obj, dict):
+            chunks.append(obj)
+    return chunks
+
+
+_DOC_ID_HEX_RE = re.compile(r"[0-9a-fA-F]{64}")
+
+
+def _normalize_doc_id(value: Any) -> str:
+    """把多种“doc_id 传参形式”统一成 64 位 hex（小写）。
+
+    兼容以下输入：
+    - 纯哈希：ed8c...（64位）
+    - 带前缀：DOC_ID: ed8c...
+    - 老格式：doc_id=ed8c...
+
+    这样可以避免：
+    - 模型/前端把 DOC_ID 连同前缀一起传进来，导致找不到落盘目录；
+    - 用户复制粘贴时带上多余字符，导致“看起来像从头开始”。
+    """
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("DOC_ID 不能为空，请传入 64 位十六进制哈希。")
+
+    m = _DOC_ID_HEX_RE.search(value.strip())
+    if not m:
+        raise ValueError(
+            "无效 DOC_ID：未在入参中找到 64 位十六进制哈希。"
+            "示例：DOC_ID: ed8c506c...（共 64 位）"
+        )
+    return m.group(0).lower()
+
+
+_CJK_CHAR_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+_PACKED_NOTE_MARK_RE = re.compile(r"^[ \t#*]*<<<\s*分片\s*(\d+)\s*>>>.*$", re.MULTILINE)
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略估算 token 数（不依赖 tokenizer）：CJK 字符约 1 字 1 token，其余约 4 字符 1 token。"""
+    if not text:
+        return 0
+    cjk = len(_CJK_CHAR_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# 词法检索的分词：CJK 连续字串切成相邻两字的 bigram（单字串保留单字），其余按字母数字词切分并小写
+_LEXICAL_TOKEN_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[a-z0-9]+(?:[._\-][a-z0-9]+)*"
+)
+
+
+def _lexical_tokens(text: str) -> list[str]:
+    """CJK 友好的分词（不依赖分词词典，离线可用）。"""
+    tokens: list[str] = []
+    for m in _LEXICAL_TOKEN_RE.finditer((text or "").lower()):
+        run = m.group(0)
+        if _CJK_CHAR_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class _BM25Index:
+    """小型 BM25 倒排索引：term -> {条目号: 词频}，支持增量 add。
+
+    条目号就是 add 的顺序（从 0 开始），调用方自己维护条目号到原文的映射。
+    """
+
+    def __init__(self, *, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[int, int]] = {}
+        self.doc_lens: list[int] = []
+        self.total_len = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lens)
+
+    def add(self, text: str) -> int:
+        terms = _lexical_tokens(text)
+        doc_no = len(self.doc_lens)
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, {})[doc_no] = tf
+        self.doc_lens.append(len(terms))
+        self.total_len += len(terms)
+        return doc_no
+
+    def scores(self, query_terms: Iterable[str]) -> dict[int, float]:
+        """对包含任一查询词的条目打 BM25 分；不含任何查询词的条目不出现在结果里。"""
+        n = len(self.doc_lens)
+        if n == 0:
+            return {}
+        avg_len = (self.total_len / n) or 1.0
+        out: dict[int, float] = {}
+        for term in set(query_terms):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            df = len(posting)
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            for doc_no, tf in posting.items():
+                norm = tf + self.k1 * (1.0 - self.b + self.b * self.doc_lens[doc_no] / avg_len)
+                out[doc_no] = out.get(doc_no, 0.0) + idf * tf * (self.k1 + 1.0) / norm
+        return out
+
+    def search(self, query: str, k: int) -> list[tuple[int, float]]:
+        """返回得分最高的 k 个 (条目号, 得分)，按得分降序。"""
+        scored = self.scores(_lexical_tokens(query))
+        return heapq.nlargest(max(0, k), scored.items(), key=lambda item: (item[1], -item[0]))
+
+
+def _split_packed_notes(text: str, chunk_numbers: list[int]) -> dict[int, str]:
+    """把打包调用的输出按 <<<分片 编号>>> 标记拆回各分片的增量。
+
+    只认本组内的编号；第一个标记之前的内容并入第一个分片。没有任何标记时返回空 dict。
+    """
+    wanted = set(chunk_numbers)
+    marks = [m for m in _PACKED_NOTE_MARK_RE.finditer(text) if int(m.group(1)) in wanted]
+    if not marks:
+        return {}
+
+    out: dict[int, str] = {}
+    preamble = text[: marks[0].start()].strip()
+    for i, m in enumerate(marks):
+        end = marks[i + 1].start() if i + 1 < len(marks) else len(text)
+        body = text[m.end() : end].strip()
+        if i == 0 and preamble:
+            body = f"{preamble}\n\n{body}".strip()
+        number = int(m.group(1))
+        out[number] = f"{out[number]}\n\n{body}".strip() if number in out else body
+    return out
+
+
+_NOTE_SECTION_RE = re.compile(r"(?m)^(?=## 分片 )")
+_NOTE_META_LINE_RE = re.compile(r"^- (kind|page|part|分片 \d+):")
+_NOTE_LINE_MARKER_RE = re.compile(r"^[\s\-*+>#|]*(\d+[.)、]\s*)?")
+
+
+def _dedup_note_sections(notes: str) -> list[str]:
+    """把 notes.md 按“## 分片”切成小节，并删掉在更早小节里已经出现过的相同条目（本地、零成本的去重）。"""
+    sections = [s.strip() for s in _NOTE_SECTION_RE.split(notes) if s.strip()]
     seen: set[str] = set()
-    with open(chunks_path, "r", encoding="utf-8") as fp:
-        for line in fp:
+    out: list[str] = []
+    for section in sections:
+        kept: list[str] = []
+        body_lines = 0
+        for line in section.splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith("## ") or _NOTE_META_LINE_RE.match(stripped):
+                kept.append(line)
+                continue
+            key = re.sub(r"\s+", " ", _NOTE_LINE_MARKER_RE.sub("", stripped)).lower()
+            # 太短的行（表头分隔线、单个词）不参与去重，避免误删结构
+            if len(key) >= 8:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.append(line)
+            body_lines += 1
+        if body_lines:
+            out.append("\n".join(kept).strip())
+    return out
+
+
+def _reduce_analysis_notes(
+    notes: str,
+    *,
+    call_model: "_ModelCall",
+    analysis_goal: str,
+    max_tokens: int,
+    workers: int,
+) -> str:
+    """mapreduce 的 reduce 步骤：先本地删除重复条目，再按 token 预算分批让模型合并去重。
+
+    各批并发调用、按原顺序拼接；某一批调用失败时保留本地去重后的原文，不丢信息。
+    """
+    sections = _dedup_note_sections(notes)
+    if not sections:
+        return ""
+
+    batches: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for section in sections:
+        tokens = _estimate_tokens(section)
+        if current and max_tokens > 0 and current_tokens + tokens > max_tokens:
+            batches.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(section)
+        current_tokens += tokens
+    if current:
+        batches.append("\n\n".join(current))
+
+    system = SystemMessage(
+        content=(
+            "你是一个严谨的文档笔记整理助手。你会收到按分片并行整理出的笔记，其中可能有重复或相互补充的条目。\n"
+            "要求：\n"
+            "1) 合并重复条目、把分散在多个分片里的同一主题归到一起；\n"
+            "2) 不得删除任何具体的规则/数字/字段/优先级/埋点等细节，宁可冗长也不要遗漏；\n"
+            "3) 保留每条信息来源的分片编号（如“（分片 12）”）；\n"
+            "4) 只输出整理后的 Markdown 笔记，不要输出额外说明。\n"
+        )
+    )
+
+    def merge(batch: str) -> str:
+        prompt = HumanMessage(content=f"分析目标：\n{analysis_goal}\n\n待合并的笔记：\n{batch}")
+        try:
+            resp = call_model([system, prompt])
+        except Exception:
+            return batch
+        text = resp.content if isinstance(resp.content, str) else str(resp.content)
+        return text.strip() or batch
+
+    if len(batches) == 1 or workers <= 1:
+        merged = [merge(b) for b in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(batches)), thread_name_prefix="pdf-reduce") as pool:
+            merged = list(pool.map(merge, batches))
+    return "\n\n".join(merged).strip() + "\n"
+
+
+def _read_file_tail(path: Path, max_chars: int) -> str:
+    """只读文件尾部（最后 64KB），避免大文件把内存/上下文撑爆。"""
+    if max_chars <= 0 or not path.exists():
+        return ""
+    try:
+        with open(path, "rb") as fp:
+            fp.seek(0, os.SEEK_END)
+            size = fp.tell()
+            fp.seek(max(0, size - 64 * 1024))
+            tail_bytes = fp.read()
+        tail_text = tail_bytes.decode("utf-8", errors="ignore")
+        if len(tail_text) <= max_chars:
+            return tail_text.strip()
+        return tail_text[-max_chars:].lstrip().strip()
+    except Exception:
+        return ""
+
+
+class _NotesTail:
+    """notes.md 的进程内视图：滚动的尾部缓冲 + 文件字节数计数。
+
+    续跑时从磁盘取一次尾部和大小，之后每一步只剩一次追加写：
+    去重用的末尾节选、超限判断都直接读内存，不再每步 stat + seek + 读 64KB + 解码。
+    """
+
+    def __init__(self, path: Path, keep_chars: int) -> None:
+        self.path = path
+        self._keep = max(0, keep_chars)
+        try:
+            self.size_bytes = path.stat().st_size
+        except OSError:
+            self.size_bytes = 0
+        self._buf = ""
+        if self.size_bytes and self._keep:
+            try:
+                with open(path, "rb") as fp:
+                    fp.seek(max(0, self.size_bytes - 64 * 1024))
+                    self._buf = fp.read().decode("utf-8", errors="ignore")[-self._keep :]
+            except OSError:
+                pass
+
+    def append(self, text: str) -> None:
+        if not text:
+            return
+        # 按字节追加：计数与落盘字节一致（文本模式在 Windows 上会把 \n 写成 \r\n）
+        data = text.encode("utf-8")
+        with open(self.path, "ab") as out_fp:
+            out_fp.write(data)
+        self.size_bytes += len(data)
+        # 缓冲攒到两倍再截断，摊薄字符串拷贝；keep_chars=0 时不保留尾部
+        self._buf += text
+        if len(self._buf) > 2 * self._keep:
+            self._buf = self._buf[-self._keep :] if self._keep else ""
+
+    def tail(self, max_chars: int) -> str:
+        """与 _read_file_tail 相同的截取规则（max_chars 不超过构造时的 keep_chars）。"""
+        if max_chars <= 0:
+            return ""
+        if len(self._buf) <= max_chars:
+            return self._buf.strip()
+        return self._buf[-max_chars:].lstrip().strip()
+
+
+def _notes_gz_path(notes_path: Path) -> Path:
+    return notes_path.with_name(notes_path.name + ".gz")
+
+
+def _open_text_stream(path: Path) -> TextIO:
+    """统一的文本流读取入口：有明文文件读明文，否则读同名 .gz（PDF_NOTES_COMPRESS 压缩后的笔记）。"""
+    if path.exists():
+        return open(path, "r", encoding="utf-8", errors="replace")
+    gz_path = _notes_gz_path(path)
+    if gz_path.exists():
+        return gzip.open(gz_path, "rt", encoding="utf-8", errors="replace")
+    raise FileNotFoundError(path.as_posix())
+
+
+def _read_notes_text(notes_path: Path) -> str:
+    try:
+        with _open_text_stream(notes_path) as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return ""
+
+
+_NOTES_GZ_INDEX_VERSION = 1
+# 每个 gzip member 的字符数：分页读取最多多解压这么多字符
+_NOTES_GZ_MEMBER_CHARS = 64 * 1024
+
+
+def _notes_gz_index_path(gz_path: Path) -> Path:
+    return gz_path.with_name(gz_path.name + ".members.json")
+
+
+def _compress_notes(notes_path: Path) -> None:
+    """分析完成后把 notes.md 压成 notes.md.gz（之后只读；重新分析前会先解压回来）。
+
+    每 _NOTES_GZ_MEMBER_CHARS 个字符压成一个独立的 gzip member 并记下压缩偏移；
+    多个 member 首尾相接仍是合法的 gzip 文件，整份解压（gzip.open）不受影响。
+    字符按 surrogateescape 解码计数，与 _TextOffsetIndex 一致。
+    """
+    if not notes_path.exists():
+        return
+    gz_path = _notes_gz_path(notes_path)
+    tmp = gz_path.with_suffix(f".{uuid4().hex}.tmp")
+    step = _NOTES_GZ_MEMBER_CHARS
+    members: list[int] = []
+    total = 0
+    try:
+        with open(notes_path, "rb") as src, open(tmp, "wb") as dst:
+            decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+            pending = ""
+
+            def emit(text: str) -> None:
+                members.append(dst.tell())
+                dst.write(gzip.compress(text.encode("utf-8", "surrogateescape"), compresslevel=6, mtime=0))
+
+            while True:
+                block = src.read(1024 * 1024)
+                pending += decoder.decode(block, final=not block)
+                while len(pending) >= step:
+                    emit(pending[:step])
+                    pending = pending[step:]
+                    total += step
+                if not block:
+                    break
+            if pending or not members:
+                emit(pending)
+                total += len(pending)
+        os.replace(tmp, gz_path)
+        st = gz_path.stat()
+        index = {
+            "version": _NOTES_GZ_INDEX_VERSION,
+            "step": step,
+            "total_chars": total,
+            "members": members,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+        }
+        index_tmp = tmp.with_suffix(".json.tmp")
+        index_tmp.write_text(json.dumps(index, separators=(",", ":")), encoding="utf-8")
+        os.replace(index_tmp, _notes_gz_index_path(gz_path))
+        notes_path.unlink()
+    except OSError:
+        tmp.unlink(missing_ok=True)
+
+
+def _restore_notes(notes_path: Path) -> None:
+    """续写笔记前：只有压缩版时先解压回 notes.md（追加写和尾部缓冲都基于明文文件）。"""
+    gz_path = _notes_gz_path(notes_path)
+    if notes_path.exists() or not gz_path.exists():
+        return
+    tmp = notes_path.with_suffix(f".{uuid4().hex}.tmp")
+    with gzip.open(gz_path, "rb") as src, open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, notes_path)
+    gz_path.unlink(missing_ok=True)
+    _notes_gz_index_path(gz_path).unlink(missing_ok=True)
+
+
+# ==========================
+# 分片检索（pdf_search）
+# ==========================
+# 每个文档一份 BM25 倒排索引，落盘在 storage/pdf_extracted/<doc_id>/search_index.json：
+# 抽取结束时构建；后台抽取途中或旧数据（没有索引）被检索时，按 next_line 增量补齐后再落盘。
+
+_SEARCH_INDEX_VERSION = 1
+_SEARCH_INDEX_CACHE_MAX = 8
+_search_index_cache: "OrderedDict[str, tuple[int, _ChunkSearchIndex]]" = OrderedDict()
+# 全局锁只保护缓存字典和按文档的锁表；加载/补齐/落盘在各文档自己的锁下进行，不同文档互不阻塞
+_search_index_lock = threading.Lock()
+_search_index_doc_locks: dict[str, threading.Lock] = {}
+
+
+def _search_index_doc_lock(doc_id: str) -> threading.Lock:
+    with _search_index_lock:
+        lock = _search_index_doc_locks.get(doc_id)
+        if lock is None:
+            lock = _search_index_doc_locks[doc_id] = threading.Lock()
+        return lock
+
+
+def _search_index_path(doc_id: str) -> Path:
+    return Path(_PDF_EXTRACT_DIR) / doc_id / "search_index.json"
+
+
+class _ChunkSearchIndex:
+    """单个文档的分片检索索引：BM25 倒排表 + 条目号到 (行号, page, part, kind) 的映射。"""
+
+    def __init__(self, doc_id: str) -> None:
+        self.doc_id = doc_id
+        self.bm25 = _BM25Index()
+        self.entries: list[tuple[int, Any, Any, str]] = []
+        self.next_line = 0
+
+    @classmethod
+    def load(cls, doc_id: str) -> "_ChunkSearchIndex | None":
+        try:
+            data = json.loads(_search_index_path(doc_id).read_text(encoding="utf-8"))
+        except Exception:
+            return None
+        if not isinstance(data, dict) or data.get("version") != _SEARCH_INDEX_VERSION:
+            return None
+        index = cls(doc_id)
+        index.next_line = int(data.get("next_line", 0))
+        index.entries = [tuple(e) for e in data.get("entries", [])]
+        index.bm25.doc_lens = list(data.get("doc_lens", []))
+        index.bm25.total_len = sum(index.bm25.doc_lens)
+        # postings 落盘成扁平数组 [条目号, 词频, 条目号, 词频, ...]，比嵌套对象小得多
+        index.bm25.postings = {
+            term: dict(zip(flat[0::2], flat[1::2])) for term, flat in (data.get("postings") or {}).items()
+        }
+        if len(index.entries) != len(index.bm25.doc_lens):
+            return None
+        return index
+
+    def save(self) -> None:
+        path = _search_index_path(self.doc_id)
+        payload = {
+            "version": _SEARCH_INDEX_VERSION,
+            "doc_id": self.doc_id,
+            "next_line": self.next_line,
+            "entries": self.entries,
+            "doc_lens": self.bm25.doc_lens,
+            "postings": {
+                term: [v for pair in posting.items() for v in pair] for term, posting in self.bm25.postings.items()
+            },
+        }
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(payload, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def catch_up(self) -> int:
+        """把 next_line 之后新写入的分片加进索引，返回新增条目数。"""
+        added = 0
+        for line_no, line in _iter_doc_chunks(self.doc_id, self.next_line, dedup=_PDF_DEDUP_CHUNKS):
+            self.next_line = line_no + 1
             line = line.strip()
             if not line:
                 continue
-            if _PDF_DEDUP_CHUNKS:
-                sig = hashlib.sha1(line.encode("utf-8")).hexdigest()
-                if sig in seen:
-                    continue
-                seen.add(sig)
             try:
-                obj = json.loads(line)
+                chunk = json.loads(line)
             except Exception:
                 continue
-            if isinstance(obj, dict):
-                chunks.append(obj)
-    return chunks
+            if not isinstance(chunk, dict):
+                continue
+            content = chunk.get("content")
+            if not isinstance(content, str) or not content.strip():
+                continue
+            self.bm25.add(content)
+            self.entries.append((line_no, chunk.get("page"), chunk.get("part_index"), str(chunk.get("kind", "text"))))
+            added += 1
+        return added
+
+    def search(self, query: str, k: int) -> list[tuple[float, tuple[int, Any, Any, str]]]:
+        """返回 [(得分, (行号, page, part, kind))]；同一页同一部分的 text/images 分片只保留得分高的一条。"""
+        hits: list[tuple[float, tuple[int, Any, Any, str]]] = []
+        seen: set[tuple[Any, Any]] = set()
+        for entry_no, score in self.bm25.search(query, max(k, 1) * 3):
+            entry = self.entries[entry_no]
+            key = (entry[1], entry[2])
+            if entry[1] is not None and key in seen:
+                continue
+            seen.add(key)
+            hits.append((score, entry))
+            if len(hits) >= k:
+                break
+        return hits
+
+
+def _get_chunk_search_index(doc_id: str) -> _ChunkSearchIndex:
+    """取文档的检索索引：内存缓存 -> 磁盘 -> 从分片重建；有新分片时增量补齐并落盘。"""
+    with _search_index_doc_lock(doc_id):
+        path = _search_index_path(doc_id)
+        with _search_index_lock:
+            cached = _search_index_cache.get(doc_id)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            mtime = -1
+        index = cached[1] if cached is not None and cached[0] == mtime else None
+        if index is None:
+            index = _ChunkSearchIndex.load(doc_id) or _ChunkSearchIndex(doc_id)
+
+        # 分片被重写过（行数比索引记录的少）：丢弃旧索引整份重建
+        if index.next_line > _count_doc_chunks(doc_id):
+            index = _ChunkSearchIndex(doc_id)
+        if index.catch_up() or mtime < 0:
+            try:
+                index.save()
+                mtime = path.stat().st_mtime_ns
+            except OSError:
+                pass
+
+        with _search_index_lock:
+            _search_index_cache[doc_id] = (mtime, index)
+            _search_index_cache.move_to_end(doc_id)
+            while len(_search_index_cache) > _SEARCH_INDEX_CACHE_MAX:
+                _search_index_cache.popitem(last=False)
+        return index
+
+
+def _invalidate_chunk_search_index(doc_id: str) -> None:
+    """分片被整份重写前调用：删掉旧索引，避免检索命中已经不存在的行。"""
+    with _search_index_doc_lock(doc_id):
+        with _search_index_lock:
+            _search_index_cache.pop(doc_id, None)
+        _search_index_path(doc_id).unlink(missing_ok=True)
+    with _vector_index_lock:
+        for path in _vector_index_paths(doc_id):
+            path.unlink(missing_ok=True)
+
+
+def _read_doc_chunk(doc_id: str, line_no: int) -> dict[str, Any] | None:
+    """按行号取单条分片（jsonl 走行号索引 seek，sqlite 走主键）。"""
+    store = _get_chunk_store()
+    if store is not None:
+        rows = store.query(doc_id, lines=(line_no, line_no + 1))
+        return rows[0] if rows else None
+    for found, line in _iter_doc_chunks(doc_id, line_no):
+        if found != line_no:
+            return None
+        try:
+            obj = json.loads(line)
+        except Exception:
+            return None
+        return obj if isinstance(obj, dict) else None
+    return None
+
+
+def _search_snippet(content: str, query: str, max_chars: int) -> str:
+    """截取命中词附近的一段原文（找不到命中位置时取开头）。"""
+    content = content.strip()
+    if max_chars <= 0 or len(content) <= max_chars:
+        return content
+    lowered = content.lower()
+    positions = [lowered.find(t) for t in _lexical_tokens(query)]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - max_chars // 4) if positions else 0
+    start = min(start, len(content) - max_chars)
+    snippet = content[start : start + max_chars].strip()
+    return ("…" if start > 0 else "") + snippet + ("…" if start + max_chars < len(content) else "")
+
+
+# ==========================
+# 分片向量索引（离线语义召回 + 与 BM25 混合排序）
+# ==========================
+# 每个文档两份文件：
+# - vectors.f32：float32 行向量矩阵（已 L2 归一化，按行追加），检索时在锁内 np.fromfile 读入内存
+#   （不做 memmap：重建时文件会被截断/替换，映射着的文件在 Linux 上会 SIGBUS，在 Windows 上无法截断/删除）；
+# - vectors.json：embedder 名称/维度、next_line，以及每行对应的 (行号, page, part, kind)。
+# embedder 或维度变了就整份重建；有新分片时只对新增部分做 embedding 并追加。
+#
+# 可选配置：
+# - PDF_EMBEDDER=hashing            默认的本地 hashing 向量（不联网）；也可以写 "模块:工厂函数"
+#                                   接入自定义 embedder（需提供 name / dim / embed(texts) -> (n, dim) 数组）
+# - PDF_EMBED_DIM=512               hashing 向量维度
+# - PDF_SEARCH_MODE=hybrid          hybrid（默认，没装 numpy 时自动退化为 lexical）/ lexical / vector
+# - PDF_SEARCH_HYBRID_ALPHA=0.5     混合排序时向量得分的权重（其余给 BM25）
+
+_PDF_EMBEDDER = (os.getenv("PDF_EMBEDDER", "hashing") or "hashing").strip()
+_PDF_EMBED_DIM: int = _env_int("PDF_EMBED_DIM", 512)
+_PDF_SEARCH_MODE: str = (os.getenv("PDF_SEARCH_MODE", "hybrid") or "hybrid").strip().lower()
+_PDF_SEARCH_HYBRID_ALPHA: float = _env_float("PDF_SEARCH_HYBRID_ALPHA", 0.5)
+
+_VECTOR_INDEX_VERSION = 1
+_VECTOR_EMBED_BATCH = 64
+# 可重入：_vector_search 在同一把锁里先增量更新、再读出矩阵
+_vector_index_lock = threading.RLock()
+
+
+class _HashingEmbedder:
+    """本地 hashing 向量：分词后按 crc32 把每个词投到固定维度（带符号），相当于对词袋做随机投影。
+
+    词频取 1 + log(tf)，最后 L2 归一化；不需要模型文件，也不联网。
+    """
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = max(16, dim)
+        self.name = f"hashing-{self.dim}"
+
+    def embed(self, texts: list[str]) -> Any:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term, tf in Counter(_lexical_tokens(text)).items():
+                h = zlib.crc32(term.encode("utf-8"))
+                out[row, h % self.dim] += (1.0 + math.log(tf)) * (1.0 if (h >> 16) & 1 else -1.0)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+_embedder: Any = None
+
+
+def _get_embedder() -> Any:
+    """按 PDF_EMBEDDER 创建（并缓存）embedder；没装 numpy 时返回 None。"""
+    global _embedder
+    if np is None:
+        return None
+    if _embedder is None:
+        if _PDF_EMBEDDER == "hashing":
+            _embedder = _HashingEmbedder(_PDF_EMBED_DIM)
+        else:
+            module_name, _, factory_name = _PDF_EMBEDDER.partition(":")
+            factory = getattr(importlib.import_module(module_name), factory_name or "create_embedder")
+            _embedder = factory()
+    return _embedder
+
+
+def _vector_index_paths(doc_id: str) -> tuple[Path, Path]:
+    base_dir = Path(_PDF_EXTRACT_DIR) / doc_id
+    return base_dir / "vectors.f32", base_dir / "vectors.json"
+
+
+def _update_vector_index(doc_id: str) -> dict[str, Any] | None:
+    """增量更新文档的向量索引并返回元数据；没装 numpy / 没有 embedder 时返回 None。"""
+    embedder = _get_embedder()
+    if embedder is None:
+        return None
+
+    vec_path, meta_path = _vector_index_paths(doc_id)
+    with _vector_index_lock:
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except Exception:
+            meta = None
+        dim = int(embedder.dim)
+        if (
+            not isinstance(meta, dict)
+            or meta.get("version") != _VECTOR_INDEX_VERSION
+            or meta.get("embedder") != embedder.name
+            or meta.get("dim") != dim
+            or int(meta.get("next_line", 0)) > _count_doc_chunks(doc_id)
+            or not vec_path.exists()
+            or vec_path.stat().st_size != len(meta.get("rows", [])) * dim * 4
+        ):
+            meta = {"version": _VECTOR_INDEX_VERSION, "embedder": embedder.name, "dim": dim, "next_line": 0, "rows": []}
+            vec_path.write_bytes(b"")
+
+        rows: list[Any] = meta["rows"]
+        pending_rows: list[list[Any]] = []
+        pending_texts: list[str] = []
+        added = 0
+
+        def flush() -> None:
+            nonlocal added
+            if not pending_texts:
+                return
+            vectors = np.asarray(embedder.embed(pending_texts), dtype=np.float32).reshape(len(pending_texts), dim)
+            with open(vec_path, "ab") as fp:
+                fp.write(vectors.tobytes())
+            rows.extend(pending_rows)
+            added += len(pending_rows)
+            pending_rows.clear()
+            pending_texts.clear()
+
+        for line_no, line in _iter_doc_chunks(doc_id, int(meta["next_line"]), dedup=_PDF_DEDUP_CHUNKS):
+            meta["next_line"] = line_no + 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                chunk = json.loads(line)
+            except Exception:
+                continue
+            if not isinstance(chunk, dict):
+                continue
+            content = chunk.get("content")
+            if not isinstance(content, str) or not content.strip():
+                continue
+            pending_rows.append([line_no, chunk.get("page"), chunk.get("part_index"), str(chunk.get("kind", "text"))])
+            pending_texts.append(content)
+            if len(pending_texts) >= _VECTOR_EMBED_BATCH:
+                flush()
+        flush()
+
+        if added or not meta_path.exists():
+            tmp_path = meta_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(meta, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp_path, meta_path)
+        return meta
+
+
+def _vector_search(doc_id: str, query: str, k: int) -> list[tuple[float, tuple[int, Any, Any, str]]]:
+    """余弦相似度 top-k（向量已归一化，一次矩阵乘法 + argpartition）。"""
+    if k <= 0:
+        return []
+    vec_path, _ = _vector_index_paths(doc_id)
+    with _vector_index_lock:
+        meta = _update_vector_index(doc_id)
+        if not meta or not meta["rows"]:
+            return []
+        dim = int(meta["dim"])
+        n_rows = len(meta["rows"])
+        # 只读元数据记录的行数，之后其它线程追加/重建都不影响这份拷贝
+        try:
+            matrix = np.fromfile(vec_path, dtype=np.float32, count=n_rows * dim)
+        except (OSError, ValueError):
+            return []
+    if matrix.size != n_rows * dim:
+        return []
+    matrix = matrix.reshape(n_rows, dim)
+    embedder = _get_embedder()
+    query_vec = np.asarray(embedder.embed([query]), dtype=np.float32).reshape(dim)
+    scores = matrix @ query_vec
+    k = min(k, scores.shape[0])
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(float(scores[i]), tuple(meta["rows"][i])) for i in top if scores[i] > 0]
+
+
+def _hybrid_search(doc_id: str, query: str, k: int) -> list[tuple[float, tuple[int, Any, Any, str]]]:
+    """BM25 与向量召回按 alpha 加权融合；同一页同一部分只保留得分高的一条。"""
+    mode = _PDF_SEARCH_MODE if np is not None else "lexical"
+    candidates = max(k, 1) * 4
+    lexical = _get_chunk_search_index(doc_id).search(query, candidates) if mode != "vector" else []
+    vector = _vector_search(doc_id, query, candidates) if mode != "lexical" else []
+
+    alpha = 1.0 if mode == "vector" else 0.0 if mode == "lexical" else min(1.0, max(0.0, _PDF_SEARCH_HYBRID_ALPHA))
+    # BM25 得分没有上界，按本次最高分归一化；余弦本身就在 [0, 1]，直接用原值，
+    # 这样查询词一个都没命中时，hashing 碰撞带来的弱相似不会被放大成高分
+    fused: dict[int, list[Any]] = {}
+    top_lexical = max((score for score, _ in lexical), default=0.0)
+    for score, entry in lexical:
+        slot = fused.setdefault(entry[0], [0.0, entry])
+        slot[0] += (1.0 - alpha) * score / top_lexical
+    for score, entry in vector:
+        slot = fused.setdefault(entry[0], [0.0, entry])
+        slot[0] += alpha * min(1.0, score)
+
+    ranked = sorted(fused.values(), key=lambda item: (-item[0], item[1][0]))
+    out: list[tuple[float, tuple[int, Any, Any, str]]] = []
+    seen: set[tuple[Any, Any]] = set()
+    for score, entry in ranked:
+        key = (entry[1], entry[2])
+        if entry[1] is not None and key in seen:
+            continue
+        seen.add(key)
+        out.append((score, tuple(entry)))
+        if len(out) >= k:
+            break
+    return out
+
+
+_QUESTION_NOISE_RE = re.compile(r"doc[_\s]*id\s*[:：=]?|[0-9a-f]{64}|[\s\W_]+", re.IGNORECASE)
+
+
+def _normalize_question(text: str) -> str:
+    """问题归一化（用于答案缓存的 key）：全半角统一、小写、去掉 DOC_ID/空白/标点。"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _QUESTION_NOISE_RE.sub("", text)
+
+
+def _model_identity(model: Any) -> str:
+    """模型标识（用于缓存 key）：优先取 model_name / model 字段，取不到用类名。"""
+    for attr in ("model_name", "model"):
+        value = getattr(model, attr, None)
+        if isinstance(value, str) and value:
+            return value
+    return type(model).__name__
+
+
+class _AnswerCache:
+    """最终报告的答案缓存：storage/pdf_extracted/<doc_id>/answer_cache/<key>.json。
+
+    - key = sha256(doc_id + 归一化问题 + 模型标识 + 提示词版本 + 笔记摘要)：
+      同一份 PRD 被不同会话重复上传、问近似问题时直接复用，笔记/提示词/模型变了自动失效；
+    - 条目超过 TTL（按写入时间）即失效；目录总大小超限时按最近访问时间（mtime）淘汰最旧的条目。
+    """
+
+    def __init__(self, root: Path, *, ttl_seconds: float, max_bytes: int) -> None:
+        self._root = root
+        self._ttl = ttl_seconds
+        self._max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(*, doc_id: str, question: str, model_id: str, prompt_version: str, notes_digest: str) -> str:
+        raw = "\n".join([doc_id, _normalize_question(question), model_id, prompt_version, notes_digest])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self._root / f"{key}.json"
+
+    def _expired(self, created_at: Any) -> bool:
+        return self._ttl > 0 and (not isinstance(created_at, (int, float)) or time.time() - created_at > self._ttl)
+
+    def get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or not isinstance(entry.get("answer"), str):
+            return None
+        if self._expired(entry.get("created_at")):
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["answer"]
+
+    def put(self, key: str, answer: str, **info: Any) -> None:
+        path = self._path(key)
+        entry = {**info, "answer": answer, "created_at": time.time()}
+        try:
+            self._root.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{uuid4().hex}.tmp")
+            tmp.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError:
+            return
+        self._evict()
+
+    def _evict(self) -> None:
+        """删掉过期条目；仍超过大小上限时按 mtime 从旧到新淘汰。"""
+        entries: list[tuple[float, int, Path]] = []
+        for p in self._root.glob("*.json"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            # mtime 会被命中刷新，过期仍按条目里记录的写入时间判断
+            if self._ttl > 0 and st.st_mtime < time.time() - self._ttl:
+                try:
+                    created_at = json.loads(p.read_text(encoding="utf-8")).get("created_at")
+                except (OSError, ValueError, AttributeError):
+                    created_at = None
+                if self._expired(created_at):
+                    p.unlink(missing_ok=True)
+                    continue
+            entries.append((st.st_mtime, st.st_size, p))
+        if self._max_bytes <= 0:
+            return
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in entries:
+            if total <= self._max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+
+# ==========================
+# 模型响应缓存（SQLite，按总大小 LRU 淘汰）
+# ==========================
+
+
+class _LLMResponseCache:
+    """磁盘上的模型响应缓存：key = sha256(模型标识 + 每条消息的类型与内容)。
+
+    “从头/重来”或笔记被清空后重跑时，系统提示词、分析目标、分片内容都没变，
+    命中缓存即可跳过 deepseek 调用。命中时刷新 last_used，写入后总大小超限时按 last_used 从旧到新淘汰。
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key       TEXT    PRIMARY KEY,
+            model     TEXT    NOT NULL,
+            content   TEXT    NOT NULL,
+            bytes     INTEGER NOT NULL,
+            last_used REAL    NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used);
+    """
+
+    def __init__(self, db_path: Path, *, max_bytes: int) -> None:
+        self.db_path = db_path
+        self._max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._total_bytes: int | None = None
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model_id: str, messages: list[Any]) -> str:
+        h = hashlib.sha256(model_id.encode("utf-8"))
+        for msg in messages:
+            content = getattr(msg, "content", msg)
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+            h.update(b"\x00")
+            h.update(str(getattr(msg, "type", "")).encode("utf-8"))
+            h.update(b"\x00")
+            h.update(content.encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error:
+            return None
+        return row[0]
+
+    def put(self, key: str, model_id: str, content: str) -> None:
+        size = len(content.encode("utf-8"))
+        conn = self._connect()
+        try:
+            with conn:
+                old = conn.execute("SELECT bytes FROM responses WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, content, bytes, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, model_id, content, size, time.time()),
+                )
+        except sqlite3.Error:
+            return
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_total_bytes()
+            else:
+                self._total_bytes += size - (old[0] if old else 0)
+            if self._max_bytes > 0 and self._total_bytes > self._max_bytes:
+                self._evict()
+
+    def _scan_total_bytes(self) -> int:
+        row = self._connect().execute("SELECT COALESCE(SUM(bytes), 0) FROM responses").fetchone()
+        return int(row[0])
+
+    def _evict(self) -> None:
+        """淘汰到上限的 90%（与图片缓存一致），避免每次写入都触发一次淘汰。"""
+        conn = self._connect()
+        target = int(self._max_bytes * 0.9)
+        total = self._scan_total_bytes()
+        doomed: list[str] = []
+        for key, size in conn.execute("SELECT key, bytes FROM responses ORDER BY last_used"):
+            if total <= target:
+                break
+            doomed.append(key)
+            total -= size
+        try:
+            with conn:
+                conn.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k in doomed])
+        except sqlite3.Error:
+            total = self._scan_total_bytes()
+        self._total_bytes = total
+
+
+class _CachedChatModel:
+    """包一层 get_default_model() 返回的模型：invoke/ainvoke 先查响应缓存，其余属性原样转发。
+
+    单次调用可传 use_cache=False 跳过缓存（既不读也不写），例如最终报告需要重新生成时。
+    已经用 peek 查过且未命中时，把 peek 返回的 key 作为 cache_key 传入，不再重复哈希和查库；
+    也可以直接调用底层模型，再用 store(key, resp) 写回（分析流程的异步路径就是这样做的）。
+    只缓存纯文本的非空回复；带 tool_calls 的回复不缓存。
+    """
+
+    def __init__(self, model: Any, cache: _LLMResponseCache | None) -> None:
+        self._model = model
+        self._cache = cache
+        self._model_id = _model_identity(model)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._model, name)
+
+    def _lookup(self, messages: list[Any], use_cache: bool) -> tuple[str | None, Any]:
+        if self._cache is None or not use_cache:
+            return None, None
+        key = self._cache.make_key(self._model_id, messages)
+        cached = self._cache.get(key)
+        return key, (AIMessage(content=cached) if cached is not None else None)
+
+    def store(self, key: str | None, resp: Any) -> None:
+        """把回复写进缓存（key 为 peek 返回的 key；为 None 时什么也不做）。"""
+        if key is None or self._cache is None:
+            return
+        content = getattr(resp, "content", None)
+        if isinstance(content, str) and content.strip() and not getattr(resp, "tool_calls", None):
+            self._cache.put(key, self._model_id, content)
+
+    def peek(self, messages: list[Any], *, use_cache: bool = True) -> tuple[str | None, Any]:
+        """只查缓存不调用模型：返回 (key, 命中的 AIMessage 或 None)；命中时不必再占限流令牌。"""
+        return self._lookup(messages, use_cache)
+
+    def invoke(
+        self,
+        messages: list[Any],
+        *args: Any,
+        use_cache: bool = True,
+        cache_key: str | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        key = cache_key
+        if key is None:
+            key, hit = self._lookup(messages, use_cache)
+            if hit is not None:
+                return hit
+        resp = self._model.invoke(messages, *args, **kwargs)
+        self.store(key, resp)
+        return resp
+
+    async def ainvoke(
+        self,
+        messages: list[Any],
+        *args: Any,
+        use_cache: bool = True,
+        cache_key: str | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        if self._cache is None or not use_cache:
+            return await self._model.ainvoke(messages, *args, **kwargs)
+        key = cache_key
+        if key is None:
+            key, hit = await asyncio.to_thread(self._lookup, messages, use_cache)
+            if hit is not None:
+                return hit
+        resp = await self._model.ainvoke(messages, *args, **kwargs)
+        await asyncio.to_thread(self.store, key, resp)
+        return resp
+
+
+_llm_cache: _LLMResponseCache | None = None
+_llm_cache_lock = threading.Lock()
+
+
+def _get_llm_cache() -> _LLMResponseCache | None:
+    """PDF_LLM_CACHE=1 时返回共享的响应缓存；关闭时返回 None。"""
+    global _llm_cache
+    if not _PDF_LLM_CACHE:
+        return None
+    if _llm_cache is None:
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                _llm_cache = _LLMResponseCache(Path(_PDF_LLM_CACHE_DB), max_bytes=_PDF_LLM_CACHE_MAX_BYTES)
+    return _llm_cache
+
 
+def _get_analysis_model() -> _CachedChatModel:
+    """分析流程用的模型：get_default_model() + 响应缓存（缓存关闭时仅透传，use_cache 参数照样可用）。"""
+    return _CachedChatModel(get_default_model(), _get_llm_cache())
 
-_DOC_ID_HEX_RE = re.compile(r"[0-9a-fA-F]{64}")
 
+# 分析流程里所有的模型调用都走这个入口：call_model(messages, **kwargs) -> AIMessage（阻塞直到返回）。
+# 同步工具直接 invoke；异步工具把 ainvoke 投递回事件循环，流程本身在工作线程里跑（文件 I/O 不占事件循环）。
+# kwargs 原样传给 invoke/ainvoke（如 use_cache=False）。
+_ModelCall = Callable[..., Any]
 
-def _normalize_doc_id(value: Any) -> str:
-    """把多种“doc_id 传参形式”统一成 64 位 hex（小写）。
 
-    兼容以下输入：
-    - 纯哈希：ed8c...（64位）
-    - 带前缀：DOC_ID: ed8c...
-    - 老格式：doc_id=ed8c...
+def _peek_cached_response(model: Any, messages: list[Any], kwargs: dict[str, Any]) -> Any:
+    """进限流器之前先查一次缓存：命中直接返回；未命中把 key 塞进 kwargs（cache_key），调用时不再重复查。"""
+    if not isinstance(model, _CachedChatModel):
+        return None
+    key, hit = model.peek(messages, use_cache=kwargs.get("use_cache", True))
+    if hit is None and key is not None:
+        kwargs["cache_key"] = key
+    return hit
 
-    这样可以避免：
-    - 模型/前端把 DOC_ID 连同前缀一起传进来，导致找不到落盘目录；
-    - 用户复制粘贴时带上多余字符，导致“看起来像从头开始”。
-    """
-    if not isinstance(value, str) or not value.strip():
-        raise ValueError("DOC_ID 不能为空，请传入 64 位十六进制哈希。")
 
-    m = _DOC_ID_HEX_RE.search(value.strip())
-    if not m:
-        raise ValueError(
-            "无效 DOC_ID：未在入参中找到 64 位十六进制哈希。"
-            "示例：DOC_ID: ed8c506c...（共 64 位）"
-        )
-    return m.group(0).lower()
+def _sync_model_call(model: Any, limiter: _ProviderRateLimiter) -> _ModelCall:
+    def call(messages: list[Any], **kwargs: Any) -> Any:
+        hit = _peek_cached_response(model, messages, kwargs)
+        if hit is not None:
+            return hit
+        return limiter.call(lambda: model.invoke(messages, **kwargs))
+
+    return call
+
+
+def _async_model_call(model: Any, limiter: _ProviderRateLimiter, loop: asyncio.AbstractEventLoop) -> _ModelCall:
+    """在工作线程里调用：把 limiter.acall(model.ainvoke) 投递到 loop 上执行并等待结果。
 
+    响应缓存的查/写都在当前工作线程里同步完成，投递到 loop 上的协程只调用底层模型：
+    工作线程本身来自默认线程池（asyncio.to_thread），若协程里再 await to_thread 查缓存，
+    并发会话数达到线程池大小时所有会话互相等待、永远卡住。
+    """
 
-@tool
-def pdf_analyze_doc(doc_id: str, question: str) -> str:
+    def call(messages: list[Any], **kwargs: Any) -> Any:
+        use_cache = kwargs.pop("use_cache", True)
+        kwargs.pop("cache_key", None)
+        raw_model, key = model, None
+        if isinstance(model, _CachedChatModel):
+            key, hit = model.peek(messages, use_cache=use_cache)
+            if hit is not None:
+                return hit
+            raw_model = model._model
+        future = asyncio.run_coroutine_threadsafe(limiter.acall(lambda: raw_model.ainvoke(messages, **kwargs)), loop)
+        resp = future.result()
+        if key is not None:
+            model.store(key, resp)
+        return resp
+
+    return call
+
+
+def _pdf_analyze_doc(doc_id: str, question: str) -> str:
     """对指定 doc_id 的 PDF 分片做“逐片完整阅读 + 汇总回答”。
 
     设计目标：
@@ -1286,10 +4627,31 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
     关键点：
     - 断点续跑：中途被打断不会从头来（状态落盘在 analysis_state.json）
     - 追加拼接：每次只生成“本分片增量笔记”，直接追加到 notes.md（避免把整份笔记反复塞进模型导致 400）
+    - 分片打包：连续的短分片按 token 预算合成一次调用（PDF_ANALYZE_PACK_TOKENS），notes.md 仍按分片分节
+    - 并行模式：PDF_ANALYZE_MODE=mapreduce 时多组并发分析、按序提交，最后合并去重成 notes_merged.md
     - 产物落盘：storage/pdf_extracted/<DOC_ID>/notes.md 与 answer.md
     """
+    model = _get_analysis_model()
+    call_model = _sync_model_call(model, _get_rate_limiter("deepseek"))
+    return _run_pdf_analysis(doc_id, question, call_model, model_id=_model_identity(model))
+
+
+async def _apdf_analyze_doc(doc_id: str, question: str) -> str:
+    """pdf_analyze_doc 的异步实现：模型调用走 ainvoke，分片读取/笔记落盘等文件 I/O 放到工作线程。"""
+    loop = asyncio.get_running_loop()
+    model = _get_analysis_model()
+    call_model = _async_model_call(model, _get_rate_limiter("deepseek"), loop)
+    return await asyncio.to_thread(
+        _run_pdf_analysis, doc_id, question, call_model, model_id=_model_identity(model)
+    )
+
+
+def _run_pdf_analysis(doc_id: str, question: str, call_model: _ModelCall, *, model_id: str = "") -> str:
+    """pdf_analyze_doc 的主流程（同步/异步两种工具共用）。
+
+    model_id 只用于答案缓存的 key（换模型后不复用旧答案）。
+    """
     doc_id = _normalize_doc_id(doc_id)
-    model = get_default_model()
 
     max_steps = _env_int("PDF_ANALYZE_MAX_STEPS", 5000)
     max_seconds = _env_float("PDF_ANALYZE_MAX_SECONDS", 90.0)
@@ -1298,47 +4660,56 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
     notes_tail_chars = _env_int("PDF_ANALYZE_NOTES_TAIL_CHARS", 2000)
     # 防御性上限：避免极端情况下写爆磁盘；需要“尽量不漏”可以调大，或设为 0 代表不限。
     notes_max_chars = _env_int("PDF_ANALYZE_NOTES_MAX_CHARS", 300000)
+    # 打包：把连续的短分片（短页/图片描述）凑到约 N token 再调用一次模型；<=0 表示每个分片单独调用
+    pack_tokens = _env_int("PDF_ANALYZE_PACK_TOKENS", 3000)
+    # 分析模式：
+    # - sequential：逐组顺序调用，每次带 notes.md 末尾节选去重（默认）
+    # - mapreduce：各组互不依赖、PDF_ANALYZE_WORKERS 个并发调用，按序提交后再做一次合并去重（reduce）
+    map_reduce = (os.getenv("PDF_ANALYZE_MODE", "sequential") or "").strip().lower() in {"mapreduce", "map_reduce", "parallel"}
+    analyze_workers = _env_int("PDF_ANALYZE_WORKERS", 4)
+    reduce_tokens = _env_int("PDF_ANALYZE_REDUCE_TOKENS", 6000)
+    # 最终报告各章节并发生成的上限（每章完成即落盘，失败重试时只补缺失的章节）
+    section_workers = _env_int("PDF_ANALYZE_SECTION_WORKERS", 3)
 
     final_sections_max_chars = _env_int("PDF_ANALYZE_FINAL_MAX_CHARS", 20000)
     final_input_max_chars = _env_int("PDF_ANALYZE_FINAL_INPUT_MAX_CHARS", 90000)
     chat_return_max_chars = _env_int("PDF_CHAT_RETURN_MAX_CHARS", 6000)
 
     chunks_path = Path(_PDF_EXTRACT_DIR) / doc_id / "chunks.jsonl"
-    if not chunks_path.exists():
+    # 后台抽取刚提交时分片文件可能还没创建：在本轮时间预算内等一等
+    wait_deadline = time.monotonic() + max(0.0, max_seconds)
+    while not _chunks_available(doc_id) and _pdf_ingest_running(doc_id) and time.monotonic() < wait_deadline:
+        time.sleep(_PDF_INGEST_POLL_SECONDS)
+    if not _chunks_available(doc_id):
+        if _pdf_ingest_running(doc_id):
+            return (
+                f"[PDF 仍在后台解析中，尚未产出分片] DOC_ID: {doc_id}\n"
+                f"请稍后发送：继续解析 DOC_ID: {doc_id}"
+            )
         raise FileNotFoundError(f"未找到分片文件：{chunks_path.as_posix()}")
+    _catalog_touch(doc_id, thread_id=_current_thread_id())
 
     out_dir = Path(_PDF_EXTRACT_DIR) / doc_id
     out_dir.mkdir(parents=True, exist_ok=True)
     notes_path = out_dir / "notes.md"
     answer_path = out_dir / "answer.md"
     state_path = out_dir / "analysis_state.json"
+    # mapreduce 模式：已完成但尚未按序提交的 map 结果 / 合并去重后的笔记
+    spool_dir = out_dir / "notes_parts"
+    merged_path = out_dir / "notes_merged.md"
+    # 最终报告的分章节断点：report_sections/section_XX.md + manifest.json（记录生成这些章节时的输入指纹）
+    sections_dir = out_dir / "report_sections"
 
     def wants_reset(text: str) -> bool:
         """判断用户是否明确想“重新从头分析”。"""
         t = (text or "").strip()
         return any(k in t for k in ("从头", "重来", "重新", "清空", "reset"))
 
-    def _read_tail(path: Path, max_chars: int) -> str:
-        """只读文件尾部，避免大文件把内存/上下文撑爆。"""
-        if max_chars <= 0 or not path.exists():
-            return ""
-        try:
-            with open(path, "rb") as fp:
-                fp.seek(0, os.SEEK_END)
-                size = fp.tell()
-                fp.seek(max(0, size - 64 * 1024))
-                tail_bytes = fp.read()
-            tail_text = tail_bytes.decode("utf-8", errors="ignore")
-            if len(tail_text) <= max_chars:
-                return tail_text.strip()
-            return tail_text[-max_chars:].lstrip().strip()
-        except Exception:
-            return ""
-
     analysis_goal = (question or "").strip()
     line_offset = 0
     steps = 0
     done = False
+    reduced = False
     start_ts = time.monotonic()
 
     if state_path.exists():
@@ -1350,6 +4721,7 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
             line_offset = int(state.get("line_offset", 0) or 0)
             steps = int(state.get("steps", 0) or 0)
             done = bool(state.get("done", False))
+            reduced = bool(state.get("reduced", False))
 
             prev_goal = state.get("analysis_goal", "")
             if isinstance(prev_goal, str) and prev_goal.strip() and not done and not wants_reset(question):
@@ -1357,7 +4729,12 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
 
             # 兼容旧版：旧版把 notes 塞进 state.json，升级后先迁移到 notes.md，避免丢失。
             legacy_notes = state.get("notes")
-            if isinstance(legacy_notes, str) and legacy_notes.strip() and not notes_path.exists():
+            if (
+                isinstance(legacy_notes, str)
+                and legacy_notes.strip()
+                and not notes_path.exists()
+                and not _notes_gz_path(notes_path).exists()
+            ):
                 notes_path.write_text(legacy_notes, encoding="utf-8")
 
     def flush_state(*, done_flag: bool) -> None:
@@ -1367,6 +4744,7 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
             "line_offset": line_offset,
             "steps": steps,
             "done": done_flag,
+            "reduced": reduced,
             "updated_at": datetime.now().isoformat(timespec="seconds"),
             "notes_path": notes_path.as_posix(),
             "answer_path": answer_path.as_posix(),
@@ -1378,8 +4756,15 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
         line_offset = 0
         steps = 0
         done = False
+        reduced = False
         if notes_path.exists():
             notes_path.write_text("", encoding="utf-8")
+        _notes_gz_path(notes_path).unlink(missing_ok=True)
+        merged_path.unlink(missing_ok=True)
+        for stale_dir in (spool_dir, sections_dir):
+            if stale_dir.is_dir():
+                for part in stale_dir.iterdir():
+                    part.unlink(missing_ok=True)
         flush_state(done_flag=False)
 
     system = SystemMessage(
@@ -1394,128 +4779,297 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
     )
 
     if not done:
-        try:
-            total_lines = sum(1 for _ in open(chunks_path, "r", encoding="utf-8"))
-        except Exception:
-            total_lines = None
-
-        seen: set[str] = set()
-        with open(chunks_path, "r", encoding="utf-8") as fp:
-            for idx, line in enumerate(fp):
-                if idx < line_offset:
-                    continue
-                if max_steps > 0 and steps >= max_steps:
-                    break
-                if max_seconds > 0 and (time.monotonic() - start_ts) >= max_seconds:
-                    break
-
-                line = line.strip()
-                if not line:
-                    line_offset = idx + 1
-                    continue
-
-                if _PDF_DEDUP_CHUNKS:
-                    sig = hashlib.sha1(line.encode("utf-8")).hexdigest()
-                    if sig in seen:
-                        line_offset = idx + 1
-                        continue
-                    seen.add(sig)
-
-                try:
-                    chunk = json.loads(line)
-                except Exception:
-                    line_offset = idx + 1
-                    continue
-                if not isinstance(chunk, dict):
-                    line_offset = idx + 1
-                    continue
-
-                content = chunk.get("content", "")
-                if not isinstance(content, str) or not content.strip():
-                    line_offset = idx + 1
-                    continue
-
-                kind = chunk.get("kind", "text")
-                page = chunk.get("page")
-                part_index = chunk.get("part_index")
-                part_total = chunk.get("part_total")
+        # notes.md 的尾部与大小只在这里从磁盘取一次，之后随追加在内存里滚动更新
+        _restore_notes(notes_path)
+        notes_view = _NotesTail(notes_path, max(notes_tail_chars, preview_chars))
+        # 总行数直接从 chunks.idx / 分片库得到（不再为了统计进度把整份分片扫两遍）
+        total_lines: int | None = _count_doc_chunks(doc_id)
+        committed_groups = 0
+
+        def over_budget() -> bool:
+            if max_steps > 0 and steps >= max_steps:
+                return True
+            return max_seconds > 0 and (time.monotonic() - start_ts) >= max_seconds
+
+        def note_header(idx: int, chunk: dict[str, Any]) -> str:
+            return (
+                f"\n\n## 分片 {idx + 1}\n"
+                f"- kind: {chunk.get('kind', 'text')}\n"
+                f"- page: {chunk.get('page')}\n"
+                f"- part: {chunk.get('part_index')}/{chunk.get('part_total')}\n\n"
+            )
 
-                steps += 1
-                notes_tail = _read_tail(notes_path, notes_tail_chars)
+        def build_prompt(group: list[tuple[int, dict[str, Any]]], notes_tail: str | None) -> HumanMessage:
+            """单个分片沿用原提示词；多个分片打包时用 <<<分片 编号>>> 标出边界。
 
-                prompt = HumanMessage(
+            notes_tail=None 表示不带累计笔记节选（并行 map 模式下各组互不依赖）。
+            """
+            tail_part = (
+                "已记录的累计笔记（末尾节选，仅用于去重，不代表全部）：\n" f"{notes_tail}\n\n"
+                if notes_tail is not None
+                else ""
+            )
+            if len(group) == 1:
+                idx, chunk = group[0]
+                return HumanMessage(
                     content=(
                         f"分析目标：\n{analysis_goal}\n\n"
-                        f"当前分片：kind={kind} page={page} part={part_index}/{part_total}\n"
-                        f"{content}\n\n"
-                        "已记录的累计笔记（末尾节选，仅用于去重，不代表全部）：\n"
-                        f"{notes_tail}\n\n"
+                        f"当前分片：kind={chunk.get('kind', 'text')} page={chunk.get('page')} "
+                        f"part={chunk.get('part_index')}/{chunk.get('part_total')}\n"
+                        f"{chunk['content']}\n\n"
+                        f"{tail_part}"
                         "请输出：只写【本分片新增的关键信息】（增量），不要复述上面的节选。"
                     )
                 )
 
-                try:
-                    result = model.invoke([system, prompt])
-                except Exception as exc:
-                    flush_state(done_flag=False)
-                    preview = _read_tail(notes_path, preview_chars)
-                    progress = str(line_offset)
-                    if total_lines:
-                        pct = (line_offset / total_lines) * 100
-                        progress = f"{line_offset}/{total_lines}（{pct:.1f}%）"
-                    return (
-                        f"[已断点保存] DOC_ID: {doc_id}\n"
-                        f"- 已处理到分片行号：{progress}\n"
-                        f"- 本轮累计 steps：{steps}\n"
-                        f"- 当前进度已落盘：{state_path.as_posix()}\n\n"
-                        f"[本次调用遇到错误]\n{exc}\n\n"
-                        f"[累计笔记预览]\n{preview}\n\n"
-                        f"如需继续，请发送：继续解析 DOC_ID: {doc_id}"
-                    )
+            blocks = [
+                f"<<<分片 {idx + 1}>>> kind={chunk.get('kind', 'text')} page={chunk.get('page')} "
+                f"part={chunk.get('part_index')}/{chunk.get('part_total')}\n{chunk['content']}"
+                for idx, chunk in group
+            ]
+            return HumanMessage(
+                content=(
+                    f"分析目标：\n{analysis_goal}\n\n"
+                    f"本次共 {len(group)} 个连续分片，每个分片以一行 <<<分片 编号>>> 开头：\n\n"
+                    + "\n\n".join(blocks)
+                    + "\n\n"
+                    + tail_part
+                    + "请输出：按分片分别写【该分片新增的关键信息】（增量），不要复述上面的节选。\n"
+                    "格式：每个分片先单独一行 <<<分片 编号>>>（编号与输入一致），下面写该分片的增量；"
+                    "没有新增信息的分片可以省略。"
+                )
+            )
 
-                delta = result.content if isinstance(result.content, str) else str(result.content)
-                delta = (delta or "").strip()
-                if delta:
-                    header = (
-                        f"\n\n## 分片 {idx + 1}\n"
-                        f"- kind: {kind}\n"
-                        f"- page: {page}\n"
-                        f"- part: {part_index}/{part_total}\n\n"
-                    )
-                    to_write = header + delta + "\n"
+        def render_notes(group: list[tuple[int, dict[str, Any]]], delta: str) -> str:
+            """把一次调用的增量渲染成 notes.md 片段：每个分片一个小节。"""
+            delta = (delta or "").strip()
+            if not delta:
+                return ""
+            if len(group) == 1:
+                return note_header(*group[0]) + delta + "\n"
+
+            # 按分片拆回增量，notes.md 里仍然保持“每个分片一个小节”
+            per_chunk = _split_packed_notes(delta, [idx + 1 for idx, _ in group])
+            if per_chunk:
+                return "".join(
+                    note_header(idx, chunk) + per_chunk[idx + 1] + "\n"
+                    for idx, chunk in group
+                    if per_chunk.get(idx + 1)
+                )
+            # 模型没按格式分节：整段记在这一组分片下，不丢内容
+            first, last = group[0][0] + 1, group[-1][0] + 1
+            return (
+                f"\n\n## 分片 {first}-{last}\n"
+                + "".join(
+                    f"- 分片 {idx + 1}: kind={chunk.get('kind', 'text')} page={chunk.get('page')} "
+                    f"part={chunk.get('part_index')}/{chunk.get('part_total')}\n"
+                    for idx, chunk in group
+                )
+                + "\n"
+                + delta
+                + "\n"
+            )
+
+        def append_notes(to_write: str) -> None:
+            if not to_write:
+                return
+            if notes_max_chars > 0 and notes_view.size_bytes > notes_max_chars:
+                to_write = (
+                    "\n\n[警告] notes.md 已超过上限，后续增量将不再写入。"
+                    "如需继续写入，请调大 PDF_ANALYZE_NOTES_MAX_CHARS 或设置为 0。\n"
+                )
+            notes_view.append(to_write)
+
+        def commit_group(group_end: int) -> None:
+            """断点只落在“整组处理完”的边界上。"""
+            nonlocal line_offset, committed_groups
+            line_offset = group_end
+            committed_groups += 1
+            if flush_every_steps > 0 and committed_groups % flush_every_steps == 0:
+                flush_state(done_flag=False)
+
+        def checkpoint_error(exc: Exception) -> str:
+            flush_state(done_flag=False)
+            preview = notes_view.tail(preview_chars)
+            progress = str(line_offset)
+            if total_lines:
+                pct = (line_offset / total_lines) * 100
+                progress = f"{line_offset}/{total_lines}（{pct:.1f}%）"
+            return (
+                f"[已断点保存] DOC_ID: {doc_id}\n"
+                f"- 已处理到分片行号：{progress}\n"
+                f"- 本轮累计 steps：{steps}\n"
+                f"- 当前进度已落盘：{state_path.as_posix()}\n\n"
+                f"[本次调用遇到错误]\n{exc}\n\n"
+                f"[累计笔记预览]\n{preview}\n\n"
+                f"如需继续，请发送：继续解析 DOC_ID: {doc_id}"
+            )
 
-                    if notes_max_chars > 0 and notes_path.exists():
-                        try:
-                            if notes_path.stat().st_size > notes_max_chars:
-                                to_write = (
-                                    "\n\n[警告] notes.md 已超过上限，后续增量将不再写入。"
-                                    "如需继续写入，请调大 PDF_ANALYZE_NOTES_MAX_CHARS 或设置为 0。\n"
-                                )
-                        except Exception:
-                            pass
+        def iter_groups(start_line: int):
+            """从 start_line 起把当前已落盘的分片按 token 预算打包，产出 (group, group_end)。
 
-                    with open(notes_path, "a", encoding="utf-8") as out_fp:
-                        out_fp.write(to_write)
+            group 为空表示这一段只有空行/坏行/空内容，直接把进度推进到 group_end 即可。
+            续跑时借助索引直接 seek 到 start_line；重复分片由读取层按内容哈希跳过。
+            """
+            group: list[tuple[int, dict[str, Any]]] = []
+            group_tokens = 0
+            group_end = start_line
+            for idx, line in _iter_doc_chunks(doc_id, start_line, dedup=_PDF_DEDUP_CHUNKS):
+                chunk: Any = None
+                line = line.strip()
+                if line:
+                    try:
+                        chunk = json.loads(line)
+                    except Exception:
+                        chunk = None
+                if not isinstance(chunk, dict) or not isinstance(chunk.get("content"), str) or not chunk["content"].strip():
+                    group_end = idx + 1
+                    if not group:
+                        yield [], group_end
+                    continue
 
-                line_offset = idx + 1
-                if flush_every_steps > 0 and steps % flush_every_steps == 0:
-                    flush_state(done_flag=False)
+                tokens = _estimate_tokens(chunk["content"])
+                if group and group_tokens + tokens > pack_tokens:
+                    yield group, group_end
+                    group, group_tokens = [], 0
+                group.append((idx, chunk))
+                group_tokens += tokens
+                group_end = idx + 1
+                if pack_tokens <= 0 or group_tokens >= pack_tokens:
+                    yield group, group_end
+                    group, group_tokens = [], 0
+            # 读到当前末尾：凑了一半的组也交出去（不为凑满预算去等后台抽取）
+            if group:
+                yield group, group_end
+
+        def run_sequential_pass() -> tuple[bool, str | None]:
+            """顺序模式：逐组调用，每次带上 notes.md 末尾节选去重。返回 (预算是否耗尽, 断点提示)。"""
+            nonlocal steps, line_offset
+            for group, group_end in iter_groups(line_offset):
+                if not group:
+                    line_offset = group_end
+                    continue
+                if over_budget():
+                    return True, None
 
-            else:
-                done = True
+                steps += 1
+                prompt = build_prompt(group, notes_view.tail(notes_tail_chars))
+                try:
+                    result = call_model([system, prompt])
+                except Exception as exc:
+                    return False, checkpoint_error(exc)
+                delta = result.content if isinstance(result.content, str) else str(result.content)
+                append_notes(render_notes(group, delta))
+                commit_group(group_end)
+            return False, None
+
+        def spool_path(group: list[tuple[int, dict[str, Any]]], group_end: int) -> Path:
+            return spool_dir / f"{group[0][0]:08d}-{group_end:08d}.md"
+
+        def map_group(group: list[tuple[int, dict[str, Any]]], group_end: int) -> str:
+            """map 任务：独立分析一组分片，结果先落到 notes_parts/ 下的 spool 文件（可乱序完成）。"""
+            prompt = build_prompt(group, None)
+            result = call_model([system, prompt])
+            delta = result.content if isinstance(result.content, str) else str(result.content)
+            path = spool_path(group, group_end)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(delta, encoding="utf-8")
+            os.replace(tmp_path, path)
+            return delta
+
+        def run_mapreduce_pass(pool: ThreadPoolExecutor) -> tuple[bool, str | None]:
+            """并行 map 模式：最多 workers 个组同时在途，结果按分片顺序提交到 notes.md。
+
+            已完成但尚未提交的组留在 spool 文件里：中途出错/超时后续跑，直接复用不再重复调用模型。
+            """
+            nonlocal steps
+            spool_dir.mkdir(parents=True, exist_ok=True)
+            pending: deque[tuple[list[tuple[int, dict[str, Any]]], int, Future | None]] = deque()
+            max_pending = max(1, analyze_workers) * 2
+
+            def commit_head() -> str | None:
+                group, group_end, fut = pending.popleft()
+                if fut is not None:
+                    try:
+                        delta = fut.result()
+                    except Exception as exc:
+                        for _, _, other in pending:
+                            if other is not None:
+                                other.cancel()
+                        pending.clear()
+                        return checkpoint_error(exc)
+                    append_notes(render_notes(group, delta))
+                    spool_path(group, group_end).unlink(missing_ok=True)
+                commit_group(group_end)
+                return None
+
+            exhausted = False
+            for group, group_end in iter_groups(line_offset):
+                fut: Future | None = None
+                if group:
+                    if over_budget():
+                        exhausted = True
+                        break
+                    cached = spool_path(group, group_end)
+                    if cached.exists():
+                        fut = Future()
+                        fut.set_result(cached.read_text(encoding="utf-8"))
+                    else:
+                        steps += 1
+                        fut = pool.submit(map_group, group, group_end)
+                pending.append((group, group_end, fut))
+
+                # 队首完成了就按序提交；在途过多时阻塞等队首
+                while pending and (
+                    len(pending) >= max_pending or pending[0][2] is None or pending[0][2].done()
+                ):
+                    error = commit_head()
+                    if error is not None:
+                        return False, error
+
+            while pending:
+                error = commit_head()
+                if error is not None:
+                    return False, error
+            return exhausted, None
+
+        pool = (
+            ThreadPoolExecutor(max_workers=max(1, analyze_workers), thread_name_prefix="pdf-analyze")
+            if map_reduce
+            else None
+        )
+        try:
+            while True:
+                # 先记下抽取是否在跑：本轮读完后如果抽取已经结束，说明确实读到了最终的末尾
+                ingest_running = _pdf_ingest_running(doc_id)
+                if pool is not None:
+                    budget_exhausted, error = run_mapreduce_pass(pool)
+                else:
+                    budget_exhausted, error = run_sequential_pass()
+                if error is not None:
+                    return error
+                if budget_exhausted:
+                    break
+                # 读到了当前末尾：抽取还在跑就等新分片，否则整份文档已读完
+                if not ingest_running:
+                    done = True
+                    break
+                if over_budget():
+                    break
+                time.sleep(_PDF_INGEST_POLL_SECONDS)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
 
         if not done:
-            try:
-                total_lines = sum(1 for _ in open(chunks_path, "r", encoding="utf-8"))
-            except Exception:
-                total_lines = None
-            if total_lines is not None and line_offset >= total_lines:
+            total_lines = _count_doc_chunks(doc_id)
+            if total_lines is not None and line_offset >= total_lines and not _pdf_ingest_running(doc_id):
                 done = True
 
         flush_state(done_flag=done)
 
         if not done:
-            preview = _read_tail(notes_path, preview_chars)
+            preview = notes_view.tail(preview_chars)
             progress = str(line_offset)
             if total_lines:
                 pct = (line_offset / total_lines) * 100
@@ -1528,11 +5082,33 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
                 f"[累计笔记预览]\n{preview}\n\n"
                 f"如需继续，请发送：继续解析 DOC_ID: {doc_id}\n"
                 f"（提示：可调 PDF_ANALYZE_MAX_SECONDS / PDF_ANALYZE_MAX_STEPS 让单次跑更久）"
+                + ("\n（PDF 仍在后台解析中，总分片数还会继续增长）" if _pdf_ingest_running(doc_id) else "")
             )
 
     # 已完成：生成最终报告（尽量长，但避免一次输出把前端卡死）
     flush_state(done_flag=True)
-    notes = notes_path.read_text(encoding="utf-8") if notes_path.exists() else ""
+    notes = _read_notes_text(notes_path)
+    if _PDF_NOTES_COMPRESS:
+        # 笔记已定稿（重新分析前会先解压回来）
+        _compress_notes(notes_path)
+
+    # mapreduce 模式：各组笔记互不知情，先合并去重一次（结果落盘，之后直接复用）
+    if map_reduce and notes.strip():
+        if reduced and merged_path.exists():
+            notes = merged_path.read_text(encoding="utf-8")
+        else:
+            notes = _reduce_analysis_notes(
+                notes,
+                call_model=call_model,
+                analysis_goal=analysis_goal,
+                max_tokens=reduce_tokens,
+                workers=analyze_workers,
+            )
+            tmp_path = merged_path.with_suffix(".tmp")
+            tmp_path.write_text(notes, encoding="utf-8")
+            os.replace(tmp_path, merged_path)
+            reduced = True
+            flush_state(done_flag=True)
 
     final_system = SystemMessage(
         content=(
@@ -1551,22 +5127,36 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
             return text
         return text[:final_sections_max_chars].rstrip()
 
-    def select_notes_excerpt(all_notes: str, keywords: set[str]) -> str:
-        if not all_notes.strip():
-            return ""
+    # 笔记段落的倒排索引：整份报告只建一次，各章节按关键词 BM25 打分取段落
+    note_paras = [p.strip() for p in notes.split("\n\n") if p.strip()]
+    note_index = _BM25Index()
+    for para in note_paras:
+        note_index.add(para)
 
-        paras = [p.strip() for p in all_notes.split("\n\n") if p.strip()]
-        head = paras[:40]
+    def select_notes_excerpt(keywords: set[str]) -> str:
+        """按关键词相关度从高到低取段落直到预算用完，剩余预算用文档开头的段落补足；输出保持原文顺序。"""
+        if not note_paras:
+            return ""
 
-        picked: list[str] = []
-        for p in paras:
-            if any(k in p for k in keywords):
-                picked.append(p)
+        scored = note_index.scores(term for k in keywords for term in _lexical_tokens(k))
+        ranked = sorted(scored, key=lambda i: (-scored[i], i))
+        # 不限预算时沿用旧口径：开头 40 段 + 全部命中段落
+        if final_input_max_chars <= 0:
+            return "\n\n".join(note_paras[i] for i in sorted(set(range(min(40, len(note_paras)))) | set(ranked)))
 
-        text = "\n\n".join(head + picked).strip()
-        if final_input_max_chars <= 0 or len(text) <= final_input_max_chars:
-            return text
-        return text[:final_input_max_chars].rstrip()
+        picked: set[int] = set()
+        used = 0
+        for i in ranked + list(range(len(note_paras))):
+            if i in picked:
+                continue
+            cost = len(note_paras[i]) + 2
+            if used + cost > final_input_max_chars:
+                if not picked:
+                    return note_paras[i][:final_input_max_chars].rstrip()
+                continue
+            picked.add(i)
+            used += cost
+        return "\n\n".join(note_paras[i] for i in sorted(picked))
 
     section_specs: list[dict[str, Any]] = [
         {
@@ -1599,39 +5189,623 @@ def pdf_analyze_doc(doc_id: str, question: str) -> str:
         },
     ]
 
-    parts: list[str] = []
-    for idx, spec in enumerate(section_specs, start=1):
-        section_notes = select_notes_excerpt(notes, set(spec.get("keywords") or set()))
+    def section_path(idx: int) -> Path:
+        return sections_dir / f"section_{idx:02d}.md"
+
+    def report_fingerprint(report_question: str) -> str:
+        return hashlib.sha1(
+            "\x00".join(
+                [report_question, hashlib.sha1(notes.encode("utf-8")).hexdigest()]
+                + [str(spec.get("task")) for spec in section_specs]
+            ).encode("utf-8")
+        ).hexdigest()
+
+    # 章节断点只在“同一个问题 + 同一份笔记 + 同一套章节任务”下复用，输入变了就整体重算。
+    # 上一份报告还没生成完时（例如用户发“继续解析”），沿用当时的问题，只补缺失的章节。
+    sections_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = sections_dir / "manifest.json"
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except Exception:
+        manifest = {}
+    if not isinstance(manifest, dict):
+        manifest = {}
+    report_question = question or ""
+    prev_question = manifest.get("question")
+    if (
+        isinstance(prev_question, str)
+        and manifest.get("fingerprint") == report_fingerprint(prev_question)
+        and not all(section_path(i).exists() for i in range(1, len(section_specs) + 1))
+    ):
+        report_question = prev_question
+    fingerprint = report_fingerprint(report_question)
+    if manifest.get("fingerprint") != fingerprint:
+        for stale in sections_dir.glob("section_*.md"):
+            stale.unlink(missing_ok=True)
+        manifest_path.write_text(
+            json.dumps(
+                {"fingerprint": fingerprint, "question": report_question, "sections": len(section_specs)},
+                ensure_ascii=False,
+                indent=2,
+            ),
+            encoding="utf-8",
+        )
+
+    def generate_section(idx: int, spec: dict[str, Any]) -> None:
+        """生成第 idx 章并立即落盘（先写临时文件再 rename，半截结果不会被当成已完成）。"""
+        section_notes = select_notes_excerpt(set(spec.get("keywords") or set()))
         user = HumanMessage(
             content=(
-                f"用户问题：\n{question}\n\n"
+                f"用户问题：\n{report_question}\n\n"
                 f"本章任务（第{idx}章）：\n{spec.get('task')}\n\n"
                 f"累计笔记节选（来自 DOC_ID: {doc_id}）：\n{section_notes}"
             )
         )
-        resp = model.invoke([final_system, user])
+        # 报告章节不走响应缓存：相同问题的复用由答案缓存负责，“重来”时要真正重新生成
+        resp = call_model([final_system, user], use_cache=False)
         part_text = resp.content if isinstance(resp.content, str) else str(resp.content)
-        parts.append(clamp(part_text))
+        path = section_path(idx)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(clamp(part_text), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def finish(answer_text: str) -> str:
+        answer_path.write_text(answer_text, encoding="utf-8")
+        _catalog_touch(doc_id, status="analyzed")
+
+        chat_text = answer_text
+        if chat_return_max_chars > 0 and len(chat_text) > chat_return_max_chars:
+            chat_text = (
+                chat_text[:chat_return_max_chars].rstrip()
+                + "\n\n[提示] 聊天窗口已截断输出，完整报告已落盘，请查看："
+                f"{answer_path.as_posix()}"
+            )
+
+        return f"{chat_text}\n\n[已落盘：笔记={notes_path.as_posix()}；回答={answer_path.as_posix()}]"
+
+    # 答案缓存：提示词版本取系统提示词 + 章节任务的摘要，改了提示词自动失效
+    answer_cache: _AnswerCache | None = None
+    answer_key = ""
+    if _PDF_ANSWER_CACHE:
+        answer_cache = _AnswerCache(
+            out_dir / "answer_cache",
+            ttl_seconds=_PDF_ANSWER_CACHE_TTL_SECONDS,
+            max_bytes=_PDF_ANSWER_CACHE_MAX_BYTES,
+        )
+        prompt_version = hashlib.sha1(
+            "\x00".join([str(final_system.content)] + [str(spec.get("task")) for spec in section_specs]).encode("utf-8")
+        ).hexdigest()
+        answer_key = _AnswerCache.make_key(
+            doc_id=doc_id,
+            question=report_question,
+            model_id=model_id,
+            prompt_version=prompt_version,
+            notes_digest=hashlib.sha1(notes.encode("utf-8")).hexdigest(),
+        )
+        cached_answer = None if wants_reset(question) else answer_cache.get(answer_key)
+        if cached_answer is not None:
+            return finish(cached_answer)
+
+    missing = [(idx, spec) for idx, spec in enumerate(section_specs, start=1) if not section_path(idx).exists()]
+    failures: dict[int, Exception] = {}
+    if missing:
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(section_workers, len(missing))), thread_name_prefix="pdf-report"
+        ) as pool:
+            futures = {pool.submit(generate_section, idx, spec): idx for idx, spec in missing}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                except Exception as exc:
+                    failures[futures[fut]] = exc
+
+    if failures:
+        finished = len(section_specs) - len(failures)
+        errors = "\n".join(f"- 第{idx}章：{failures[idx]}" for idx in sorted(failures))
+        return (
+            f"[报告已部分生成] DOC_ID: {doc_id}\n"
+            f"- 已完成章节：{finished}/{len(section_specs)}（已落盘：{sections_dir.as_posix()}）\n\n"
+            f"[本次调用遇到错误]\n{errors}\n\n"
+            f"如需继续，请发送：继续解析 DOC_ID: {doc_id}（只会补生成失败的章节）"
+        )
 
+    # 全部章节就绪：按章节顺序拼出 answer.md
+    parts = [section_path(idx).read_text(encoding="utf-8") for idx in range(1, len(section_specs) + 1)]
     answer_text = "\n\n---\n\n".join([p for p in parts if p.strip()]).strip()
     if not answer_text:
         answer_text = "未能生成报告（模型未返回内容），请重试。"
+    elif answer_cache is not None:
+        answer_cache.put(answer_key, answer_text, question=report_question, model=model_id)
+
+    return finish(answer_text)
+
+
+# 同时提供同步 / 异步实现：异步图（langgraph dev 服务）走 coroutine，不再阻塞事件循环
+pdf_analyze_doc = StructuredTool.from_function(
+    func=_pdf_analyze_doc,
+    coroutine=_apdf_analyze_doc,
+    name="pdf_analyze_doc",
+)
+
+
+# ==========================
+# 存储配额（按保留层级 + 最近访问时间淘汰）
+# ==========================
+# 上传的 PDF 与抽取产物默认永久保留；设置 PDF_STORAGE_QUOTA_BYTES 后，超出配额时按层级逐层淘汰，
+# 同一层级内按文档最近活动时间（文档目录的 last_activity，没有则取文件 mtime）从旧到新：
+#   originals：原始 PDF（上传目录）+ 图片解析缓存            —— 最先淘汰（分片已经抽出来了）
+#   derived：  检索/向量/偏移索引、map 暂存、报告章节、答案缓存 —— 都能从分片/笔记重建
+#   notes：    notes.md / notes_merged.md + analysis_state.json —— 删笔记同时删进度，下次从头分析
+#   core：     整个文档目录（chunks.jsonl、answer.md 等）+ 目录/分片库记录 —— 最后淘汰
+# 分析进行中（analysis_state.json 的 done=false）或抽取中的文档一律跳过。
+
+_STORAGE_TIERS = ("originals", "derived", "notes", "core")
+_STORAGE_DERIVED_NAMES = (
+    "search_index.json",
+    "vectors.f32",
+    "vectors.json",
+    "chunks.idx",
+    "chunks.pages.idx",
+    "notes_parts",
+    "report_sections",
+    "answer_cache",
+)
+_STORAGE_NOTES_NAMES = (
+    "notes.md",
+    "notes.md.gz",
+    "notes.md.gz.members.json",
+    "notes_merged.md",
+    "analysis_state.json",
+)
+_storage_sweep_lock = threading.Lock()
+_storage_sweeper: threading.Thread | None = None
+_storage_sweeper_lock = threading.Lock()
+
+
+def _tree_bytes(path: Path) -> int:
+    """文件或目录（递归）的总字节数；不存在时为 0。"""
+    try:
+        if path.is_file():
+            return path.stat().st_size
+        total = 0
+        for p in path.rglob("*"):
+            try:
+                if p.is_file():
+                    total += p.stat().st_size
+            except OSError:
+                continue
+        return total
+    except OSError:
+        return 0
+
+
+def _remove_tree(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _storage_protected(doc_id: str) -> bool:
+    """分析进行中 / 抽取中的文档不参与淘汰。"""
+    if _pdf_ingest_running(doc_id):
+        return True
+    if _read_ingest_state(doc_id).get("status") in {"queued", "running"}:
+        return True
+    state_path = Path(_PDF_EXTRACT_DIR) / doc_id / "analysis_state.json"
+    if not state_path.exists():
+        return False
+    try:
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+    except Exception:
+        # 读不出来（可能正被改写）：保守起见按进行中处理
+        return True
+    return isinstance(state, dict) and not state.get("done", False)
+
+
+def _doc_last_access(doc_id: str, catalog: _DocCatalog | None) -> float:
+    if catalog is not None:
+        try:
+            entry = catalog.get(doc_id)
+        except sqlite3.Error:
+            entry = None
+        if entry is not None:
+            return float(entry["last_activity"])
+    ts = 0.0
+    for base in (Path(_PDF_EXTRACT_DIR) / doc_id, Path(_PDF_UPLOAD_DIR) / doc_id):
+        try:
+            for p in base.iterdir():
+                ts = max(ts, p.stat().st_mtime)
+        except OSError:
+            continue
+    return ts
+
+
+def _drop_doc_records(doc_id: str) -> None:
+    """整个文档被淘汰：清掉分片库/目录里的记录和进程内索引缓存。"""
+    store = _get_chunk_store()
+    if store is not None:
+        store.delete_doc(doc_id)
+    # 按文档的建索引锁不删：可能还有检索线程持有它，删掉后新来的检索会拿到另一把锁、与之并发写 search_index.json
+    with _search_index_lock:
+        _search_index_cache.pop(doc_id, None)
+    catalog = _get_doc_catalog()
+    if catalog is not None:
+        try:
+            catalog.forget(doc_id)
+        except sqlite3.Error:
+            pass
+
+
+def _storage_candidates(tier: str, doc_ids: list[str], catalog: _DocCatalog | None) -> list[tuple[float, str, list[Path]]]:
+    """某一层级的淘汰候选：(最近访问时间, 标签, 要删除的路径)。"""
+    out: list[tuple[float, str, list[Path]]] = []
+    if tier == "originals":
+        for doc_id in doc_ids:
+            upload_dir = Path(_PDF_UPLOAD_DIR) / doc_id
+            if upload_dir.is_dir():
+                out.append((_doc_last_access(doc_id, catalog), f"{doc_id} originals", [upload_dir]))
+        # 图片解析缓存跨文档共享：逐条按自身的最近命中时间（mtime）参与排序
+        for p in Path(_PDF_IMAGE_CACHE_DIR).glob("*/*.md"):
+            try:
+                out.append((p.stat().st_mtime, f"image cache {p.name[:16]}", [p]))
+            except OSError:
+                continue
+        return out
+
+    for doc_id in doc_ids:
+        doc_dir = Path(_PDF_EXTRACT_DIR) / doc_id
+        if tier == "derived":
+            paths = [doc_dir / name for name in _STORAGE_DERIVED_NAMES] + list(doc_dir.glob("*.offsets.json"))
+        elif tier == "notes":
+            paths = [doc_dir / name for name in _STORAGE_NOTES_NAMES]
+        else:
+            paths = [doc_dir]
+        paths = [p for p in paths if p.exists()]
+        if paths:
+            out.append((_doc_last_access(doc_id, catalog), f"{doc_id} {tier}", paths))
+    return out
+
+
+def pdf_storage_usage() -> int:
+    """上传目录 + 抽取目录 + 图片缓存的总字节数。"""
+    return sum(_tree_bytes(Path(d)) for d in (_PDF_UPLOAD_DIR, _PDF_EXTRACT_DIR, _PDF_IMAGE_CACHE_DIR))
+
 
-    answer_path.write_text(answer_text, encoding="utf-8")
+def sweep_pdf_storage(quota_bytes: int | None = None, *, dry_run: bool = False) -> tuple[int, int, list[tuple[str, int]]]:
+    """超出配额时按层级淘汰，返回 (淘汰前用量, 淘汰后用量, [(标签, 释放字节数)])。
 
-    chat_text = answer_text
-    if chat_return_max_chars > 0 and len(chat_text) > chat_return_max_chars:
-        chat_text = (
-            chat_text[:chat_return_max_chars].rstrip()
-            + "\n\n[提示] 聊天窗口已截断输出，完整报告已落盘，请查看："
-            f"{answer_path.as_posix()}"
+    与图片缓存一致，一旦触发就淘汰到配额的 90%，避免每次扫描都只删一点点。
+    quota_bytes<=0 表示不限制；dry_run=True 只计算不删除。
+    """
+    quota = _PDF_STORAGE_QUOTA_BYTES if quota_bytes is None else quota_bytes
+    with _storage_sweep_lock:
+        usage = pdf_storage_usage()
+        before = usage
+        evicted: list[tuple[str, int]] = []
+        if quota <= 0 or usage <= quota:
+            return before, usage, evicted
+
+        target = int(quota * 0.9)
+        catalog = _get_doc_catalog()
+        base = Path(_PDF_EXTRACT_DIR)
+        doc_ids = sorted(
+            {
+                child.name
+                for root in (base, Path(_PDF_UPLOAD_DIR))
+                if root.exists()
+                for child in root.iterdir()
+                if child.is_dir() and _DOC_ID_HEX_RE.fullmatch(child.name)
+            }
         )
+        doc_ids = [doc_id for doc_id in doc_ids if not _storage_protected(doc_id)]
+
+        for tier in _STORAGE_TIERS:
+            for _, label, paths in sorted(_storage_candidates(tier, doc_ids, catalog), key=lambda c: c[0]):
+                if usage <= target:
+                    return before, usage, evicted
+                freed = sum(_tree_bytes(p) for p in paths)
+                if not dry_run:
+                    doc_id = label.split(" ", 1)[0]
+                    # 删之前再确认一次：扫描期间可能刚开始分析
+                    if _DOC_ID_HEX_RE.fullmatch(doc_id) and _storage_protected(doc_id):
+                        continue
+                    for p in paths:
+                        _remove_tree(p)
+                    if tier == "core":
+                        _drop_doc_records(doc_id)
+                usage -= freed
+                evicted.append((label, freed))
+        return before, usage, evicted
+
+
+def _ensure_storage_sweeper() -> None:
+    """配置了配额时启动后台定期清理线程（进程内只启动一个）。"""
+    global _storage_sweeper
+    if _PDF_STORAGE_QUOTA_BYTES <= 0 or _PDF_STORAGE_SWEEP_SECONDS <= 0:
+        return
+    with _storage_sweeper_lock:
+        if _storage_sweeper is not None and _storage_sweeper.is_alive():
+            return
+
+        def loop() -> None:
+            while True:
+                try:
+                    sweep_pdf_storage()
+                except Exception:
+                    pass
+                time.sleep(_PDF_STORAGE_SWEEP_SECONDS)
+
+        _storage_sweeper = threading.Thread(target=loop, name="pdf_storage_sweep", daemon=True)
+        _storage_sweeper.start()
+
+
+# ==========================
+# 分段读取（pdf_read_report）
+# ==========================
+# 长文件（notes.md 可达数十万字）按“字符偏移 -> 字节偏移”的检查点索引分页：
+# 每隔 _TEXT_INDEX_STEP 个字符记一个字节偏移，读一页 = 一次 seek + 有界读取，不再整份 read_text。
+# 索引落盘在 <文件名>.offsets.json；文件只追加增长时（notes.md）从最后一个检查点接着补。
+
+_TEXT_INDEX_VERSION = 1
+_TEXT_INDEX_STEP = 4096
+_TEXT_INDEX_READ_BLOCK = 64 * 1024
+# 尾部探针：判断文件是“原样追加”还是被整体改写（改写则重建索引）
+_TEXT_INDEX_PROBE_BYTES = 64
+
+
+class _TextOffsetIndex:
+    """UTF-8 文本文件的字符偏移检查点索引。
+
+    字符按 surrogateescape 解码计数：非法字节各算一个字符，编码回去与原字节一一对应，字节偏移不会漂移。
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.size = 0
+        self.mtime_ns = 0
+        self.total_chars = 0
+        self.offsets: list[int] = [0]  # offsets[k] = 第 k * _TEXT_INDEX_STEP 个字符的字节偏移
+        self.probe = ""
+
+    @property
+    def _sidecar(self) -> Path:
+        return self.path.with_name(self.path.name + ".offsets.json")
+
+    @classmethod
+    def load(cls, path: Path) -> "_TextOffsetIndex":
+        index = cls(path)
+        try:
+            obj = json.loads(index._sidecar.read_text(encoding="utf-8"))
+        except (FileNotFoundError, OSError, ValueError):
+            return index
+        if (
+            isinstance(obj, dict)
+            and obj.get("version") == _TEXT_INDEX_VERSION
+            and obj.get("step") == _TEXT_INDEX_STEP
+            and isinstance(obj.get("offsets"), list)
+            and obj["offsets"]
+        ):
+            index.size = int(obj.get("size", 0))
+            index.mtime_ns = int(obj.get("mtime_ns", 0))
+            index.total_chars = int(obj.get("total_chars", 0))
+            index.offsets = [int(v) for v in obj["offsets"]]
+            index.probe = str(obj.get("probe", ""))
+        return index
+
+    def save(self) -> None:
+        payload = {
+            "version": _TEXT_INDEX_VERSION,
+            "step": _TEXT_INDEX_STEP,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "total_chars": self.total_chars,
+            "offsets": self.offsets,
+            "probe": self.probe,
+        }
+        try:
+            tmp = self._sidecar.with_suffix(f".{uuid4().hex}.tmp")
+            tmp.write_text(json.dumps(payload, separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp, self._sidecar)
+        except OSError:
+            pass
+
+    def _read_probe(self, fp: Any, size: int) -> str:
+        fp.seek(max(0, size - _TEXT_INDEX_PROBE_BYTES))
+        return fp.read(min(size, _TEXT_INDEX_PROBE_BYTES)).hex()
+
+    def refreshed(self) -> "_TextOffsetIndex | None":
+        """与文件当前状态对齐：没有变化返回 None，否则返回一份新索引（需要落盘）。
+
+        不原地修改 self：别的线程可能正拿着这份索引读，改到一半的 offsets/size/total_chars 会读出截断页或越界。
+        """
+        st = self.path.stat()
+        if st.st_size == self.size and st.st_mtime_ns == self.mtime_ns:
+            return None
+        fresh = _TextOffsetIndex(self.path)
+        with open(self.path, "rb") as fp:
+            appended = st.st_size > self.size > 0 and self._read_probe(fp, self.size) == self.probe
+            if appended:
+                fresh.total_chars = self.total_chars
+                fresh.offsets = list(self.offsets)
+            fresh._extend(fp, st.st_size)
+            fresh.probe = fresh._read_probe(fp, st.st_size)
+        fresh.size = st.st_size
+        fresh.mtime_ns = st.st_mtime_ns
+        return fresh
+
+    def _extend(self, fp: Any, size: int) -> None:
+        """从最后一个检查点开始顺序解码到文件末尾，补齐检查点与总字符数。"""
+        last = len(self.offsets) - 1
+        chars = last * _TEXT_INDEX_STEP
+        byte_pos = self.offsets[last]
+        del self.offsets[last + 1 :]
+        decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+        fp.seek(byte_pos)
+        # 下一个检查点距离当前已解码位置还差多少字符
+        need = _TEXT_INDEX_STEP
+        remaining = size - byte_pos
+        while remaining > 0:
+            block = fp.read(min(_TEXT_INDEX_READ_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            text = decoder.decode(block, final=remaining <= 0)
+            pos = 0
+            while len(text) - pos >= need:
+                byte_pos += len(text[pos : pos + need].encode("utf-8", "surrogateescape"))
+                pos += need
+                chars += need
+                self.offsets.append(byte_pos)
+                need = _TEXT_INDEX_STEP
+            tail = text[pos:]
+            byte_pos += len(tail.encode("utf-8", "surrogateescape"))
+            chars += len(tail)
+            need -= len(tail)
+        self.total_chars = chars
+
+    def read(self, start: int, limit: int) -> str:
+        """读取 [start, start + limit) 个字符（limit <= 0 读到末尾）：一次 seek + 有界读取。"""
+        start = max(0, min(start, self.total_chars))
+        k = start // _TEXT_INDEX_STEP
+        skip = start - k * _TEXT_INDEX_STEP
+        want = (self.total_chars - start) if limit <= 0 else min(limit, self.total_chars - start)
+        decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+        parts: list[str] = []
+        got = 0
+        with open(self.path, "rb") as fp:
+            fp.seek(self.offsets[k])
+            remaining = self.size - self.offsets[k]
+            while got < skip + want and remaining > 0:
+                # UTF-8 每个字符最多 4 字节：按还差的字符数估一个足够的读取量
+                block = fp.read(min(remaining, max(4 * (skip + want - got), 1024)))
+                if not block:
+                    break
+                remaining -= len(block)
+                text = decoder.decode(block, final=remaining <= 0)
+                parts.append(text)
+                got += len(text)
+        text = "".join(parts)[skip : skip + want]
+        return text.encode("utf-8", "surrogateescape").decode("utf-8", errors="replace")
+
+
+_text_index_cache: "OrderedDict[str, _TextOffsetIndex]" = OrderedDict()
+_text_index_lock = threading.Lock()
+
+
+class _StreamTextReader:
+    """没有明文、只有 .gz 的文件（压缩后的 notes.md）的分页读取：与 _TextOffsetIndex 接口一致。
+
+    有 member 索引（_compress_notes 写的 .members.json，且与 .gz 的大小/mtime 对得上）时，
+    按 start 定位到所在 member、seek 过去再解压，一页最多多解压一个 member；
+    旧版单 member 的 .gz 没有索引，只能从头按流跳过 start 个字符，总字符数按文件版本缓存。
+    """
+
+    _totals: "OrderedDict[str, tuple[int, int, int]]" = OrderedDict()
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.gz_path = _notes_gz_path(path)
+        self.step = 0
+        self.members: list[int] = [0]
+        st = self.gz_path.stat()
+        try:
+            obj = json.loads(_notes_gz_index_path(self.gz_path).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            obj = None
+        if (
+            isinstance(obj, dict)
+            and obj.get("version") == _NOTES_GZ_INDEX_VERSION
+            and (obj.get("size"), obj.get("mtime_ns")) == (st.st_size, st.st_mtime_ns)
+            and int(obj.get("step") or 0) > 0
+            and obj.get("members")
+        ):
+            self.step = int(obj["step"])
+            self.members = [int(v) for v in obj["members"]]
+            self.total_chars = int(obj.get("total_chars", 0))
+            return
+
+        key = self.gz_path.as_posix()
+        with _text_index_lock:
+            cached = self._totals.get(key)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            self.total_chars = cached[2]
+            return
+        total = 0
+        decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+        with gzip.open(self.gz_path, "rb") as fp:
+            while True:
+                block = fp.read(_TEXT_INDEX_READ_BLOCK)
+                total += len(decoder.decode(block, final=not block))
+                if not block:
+                    break
+        self.total_chars = total
+        with _text_index_lock:
+            self._totals[key] = (st.st_size, st.st_mtime_ns, total)
+            while len(self._totals) > _SEARCH_INDEX_CACHE_MAX:
+                self._totals.popitem(last=False)
+
+    def read(self, start: int, limit: int) -> str:
+        """读取 [start, start + limit) 个字符（limit <= 0 读到末尾）。"""
+        start = max(0, min(start, self.total_chars))
+        k = min(start // self.step, len(self.members) - 1) if self.step else 0
+        skip = start - k * self.step
+        want = (self.total_chars - start) if limit <= 0 else min(limit, self.total_chars - start)
+        decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+        parts: list[str] = []
+        got = 0
+        with open(self.gz_path, "rb") as raw:
+            raw.seek(self.members[k])
+            # GzipFile 从当前位置开始解压，并顺着后面的 member 继续读
+            with gzip.GzipFile(fileobj=raw, mode="rb") as fp:
+                while got < skip + want:
+                    block = fp.read(min(_TEXT_INDEX_READ_BLOCK, max(4 * (skip + want - got), 1024)))
+                    text = decoder.decode(block, final=not block)
+                    parts.append(text)
+                    got += len(text)
+                    if not block:
+                        break
+        text = "".join(parts)[skip : skip + want]
+        return text.encode("utf-8", "surrogateescape").decode("utf-8", errors="replace")
+
+
+def _get_text_offset_index(path: Path) -> _TextOffsetIndex:
+    """取文件的偏移索引（进程内 LRU + 落盘 sidecar），文件变化时增量补齐或重建。"""
+    key = path.as_posix()
+    with _text_index_lock:
+        index = _text_index_cache.pop(key, None)
+        if index is None:
+            index = _TextOffsetIndex.load(path)
+        # 有变化时换成新对象，调用方拿到的都是不会再变的快照（读取在锁外进行）
+        fresh = index.refreshed()
+        if fresh is not None:
+            index = fresh
+            index.save()
+        _text_index_cache[key] = index
+        while len(_text_index_cache) > _SEARCH_INDEX_CACHE_MAX:
+            _text_index_cache.popitem(last=False)
+        return index
+
+
+def _current_thread_id() -> str:
+    """当前 LangGraph 会话的 thread_id；不在图里运行（脚本/基准）时返回 "default"。"""
+    if get_config is None:
+        return "default"
+    try:
+        configurable = get_config().get("configurable") or {}
+    except RuntimeError:
+        return "default"
+    thread_id = configurable.get("thread_id")
+    return str(thread_id) if thread_id else "default"
 
-    return f"{chat_text}\n\n[已落盘：笔记={notes_path.as_posix()}；回答={answer_path.as_posix()}]"
 
+def _report_read_state_path(out_dir: Path, thread_id: str) -> Path:
+    """每个会话一份阅读进度：report_read_state/<thread 哈希>.json（并发阅读互不覆盖）。"""
+    digest = hashlib.sha1(thread_id.encode("utf-8")).hexdigest()[:16]
+    return out_dir / "report_read_state" / f"{digest}.json"
 
-@tool
-def pdf_read_report(
+
+def _pdf_read_report(
     doc_id: str,
     kind: str = "answer",
     offset: int = -1,
@@ -1647,55 +5821,25 @@ def pdf_read_report(
     参数说明：
     - doc_id：
       - 支持 `DOC_ID: <hash>` / 纯 hash / 老格式 `doc_id=<hash>`（会自动归一化）
-      - 也支持 `auto` / `latest` 或空字符串：自动选择最近一次落盘的 DOC_ID（最省事，但可能选错文档）
+      - 也支持 `auto` / `latest` 或空字符串：自动选择本会话最近用过、且已有对应产物（answer.md / notes.md）的 DOC_ID
+        （没有则取全局最近的此类文档）
     - kind：`answer`（默认）读取最终报告；`notes` 读取累计笔记。
     - offset：从第 offset 个字符开始读取。
-      - `-1`（默认）：自动从“上次输出位置”继续（无需用户自己传 offset）。
+      - `-1`（默认）：自动从“本会话上次输出位置”继续（无需用户自己传 offset）。
       - `0`：从头开始输出（重置）。
     - max_chars：本次最多返回多少字符；<=0 表示“尽量全读”（不推荐，容易卡）。
     """
-    def auto_pick_latest_doc_id() -> str:
-        """自动选择最近一次落盘的 DOC_ID（按文件修改时间）。"""
-        base = Path(_PDF_EXTRACT_DIR)
-        if not base.exists():
-            raise FileNotFoundError(f"未找到目录：{base.as_posix()}")
-
-        best_doc_id: str | None = None
-        best_ts: float = -1.0
-
-        for child in base.iterdir():
-            if not child.is_dir():
-                continue
-            name = child.name
-            if not _DOC_ID_HEX_RE.fullmatch(name):
-                continue
-
-            candidates = [
-                child / "answer.md",
-                child / "notes.md",
-                child / "analysis_state.json",
-                child / "report_read_state.json",
-            ]
-            ts = -1.0
-            for p in candidates:
-                if p.exists():
-                    try:
-                        ts = max(ts, p.stat().st_mtime)
-                    except Exception:
-                        continue
-            if ts > best_ts:
-                best_ts = ts
-                best_doc_id = name
-
-        if best_doc_id is None:
-            raise FileNotFoundError(
-                f"未发现任何可用的 DOC_ID（{base.as_posix()} 下没有落盘产物）。"
-            )
-        return best_doc_id
-
+    thread_id = _current_thread_id()
     raw_doc_id = (doc_id or "").strip()
     if not raw_doc_id or raw_doc_id.lower() in {"auto", "latest"}:
-        normalized = auto_pick_latest_doc_id()
+        # 文档目录按索引查：优先本会话最近用过的文档，其次全局最近
+        wanted = "answer.md" if (kind or "").strip().lower() == "answer" else "notes.md"
+        latest = _latest_doc_id(thread_id, require=(wanted, wanted + ".gz"))
+        if latest is None:
+            raise FileNotFoundError(
+                f"未发现任何可用的 DOC_ID（{Path(_PDF_EXTRACT_DIR).as_posix()} 下没有落盘产物）。"
+            )
+        normalized = latest
     else:
         normalized = _normalize_doc_id(raw_doc_id)
 
@@ -1708,19 +5852,21 @@ def pdf_read_report(
 
     out_dir = Path(_PDF_EXTRACT_DIR) / normalized
     path = out_dir / ("answer.md" if safe_kind == "answer" else "notes.md")
-    progress_path = out_dir / "report_read_state.json"
-    if not path.exists():
+    progress_path = _report_read_state_path(out_dir, thread_id)
+    compressed = not path.exists() and _notes_gz_path(path).exists()
+    if not path.exists() and not compressed:
         return (
             f"未找到落盘文件：{path.as_posix()}\n"
             f"请先运行 pdf_analyze_doc('DOC_ID: {normalized}', question) 生成产物。"
         )
+    _catalog_touch(normalized, thread_id=thread_id)
 
     try:
-        text = path.read_text(encoding="utf-8")
+        index = _StreamTextReader(path) if compressed else _get_text_offset_index(path)
     except Exception as exc:
         return f"读取失败：{path.as_posix()}：{exc}"
 
-    total = len(text)
+    total = index.total_chars
 
     def load_resume_state() -> tuple[int, bool]:
         if not progress_path.exists():
@@ -1756,6 +5902,7 @@ def pdf_read_report(
             "total": int(total),
             "updated_at": datetime.now().isoformat(timespec="seconds"),
         }
+        progress_path.parent.mkdir(parents=True, exist_ok=True)
         progress_path.write_text(
             json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8"
         )
@@ -1783,15 +5930,87 @@ def pdf_read_report(
     except Exception:
         limit = 6000
 
-    if limit <= 0:
-        chunk = text[start:]
-        next_offset = total
-    else:
-        chunk = text[start : start + limit]
-        next_offset = start + len(chunk)
+    try:
+        chunk = index.read(start, limit)
+    except Exception as exc:
+        return f"读取失败：{path.as_posix()}：{exc}"
+    next_offset = total if limit <= 0 else min(total, start + limit)
 
     done = next_offset >= total
     save_resume_offset(next_offset, done=done)
 
     # 只返回“正文内容”，不输出额外状态信息（用户要在前端界面直接看到正文）。
     return chunk
+
+
+async def _apdf_read_report(
+    doc_id: str,
+    kind: str = "answer",
+    offset: int = -1,
+    max_chars: int = 6000,
+) -> str:
+    """pdf_read_report 的异步实现：纯文件读取，整体放到工作线程执行。"""
+    return await asyncio.to_thread(_pdf_read_report, doc_id, kind, offset, max_chars)
+
+
+pdf_read_report = StructuredTool.from_function(
+    func=_pdf_read_report,
+    coroutine=_apdf_read_report,
+    name="pdf_read_report",
+)
+
+
+def _pdf_search(doc_id: str, query: str, k: int = 5) -> str:
+    """在指定 PDF 的分片里做本地检索（BM25 + 本地向量混合排序，离线、毫秒级），返回最相关的 k 个分片及所在页码。
+
+    适用场景：
+    - 用户针对一份大 PDF 提一个具体问题（某个字段/规则/数字在哪里、怎么规定的），
+      先用本工具定位相关页面，再基于检索结果回答；不必为此跑一遍完整的 pdf_analyze_doc。
+
+    参数说明：
+    - doc_id：DOC_ID 后面的 64 位哈希（支持带 `DOC_ID:` 前缀，会自动归一化）
+    - query：检索词/问题原文（中文按字切分，不需要分词）
+    - k：返回条数（默认 5，最多 20）
+    """
+    doc_id = _normalize_doc_id(doc_id)
+    if not _chunks_available(doc_id):
+        if _pdf_ingest_running(doc_id):
+            return f"[PDF 仍在后台解析中，尚未产出分片] DOC_ID: {doc_id}，请稍后再检索。"
+        raise FileNotFoundError(f"未找到分片文件：{_chunks_jsonl_path(doc_id).as_posix()}")
+    _catalog_touch(doc_id, thread_id=_current_thread_id())
+
+    snippet_chars = _env_int("PDF_SEARCH_SNIPPET_CHARS", 800)
+    try:
+        k = max(1, min(int(k), 20))
+    except Exception:
+        k = 5
+
+    start = time.perf_counter()
+    hits = _hybrid_search(doc_id, query or "", k)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    if not hits:
+        return f"[pdf_search] DOC_ID: {doc_id} 未检索到与“{query}”相关的分片（{elapsed_ms:.1f}ms）。"
+
+    lines = [f"[pdf_search] DOC_ID: {doc_id} 命中 {len(hits)} 条（{elapsed_ms:.1f}ms）"]
+    for rank, (score, (line_no, page, part_index, kind)) in enumerate(hits, start=1):
+        chunk = _read_doc_chunk(doc_id, line_no) or {}
+        page_label = f"第 {page + 1} 页" if isinstance(page, int) else "页码未知"
+        lines.append(
+            f"\n### {rank}. {page_label}（kind={kind} part={part_index}/{chunk.get('part_total')} "
+            f"分片行号={line_no} score={score:.2f}）\n"
+            + _search_snippet(str(chunk.get("content", "")), query or "", snippet_chars)
+        )
+    return "\n".join(lines)
+
+
+async def _apdf_search(doc_id: str, query: str, k: int = 5) -> str:
+    """pdf_search 的异步实现：索引加载/读分片放到工作线程。"""
+    return await asyncio.to_thread(_pdf_search, doc_id, query, k)
+
+
+pdf_search = StructuredTool.from_function(
+    func=_pdf_search,
+    coroutine=_apdf_search,
+    name="pdf_search",
+)